@@ -1,32 +1,119 @@
 import boto3
+import botocore.config
+import botocore.loaders
+import botocore.session
+import cassette
+import hashlib
+import json
 import os
+import scheduler
+import threading
+import time
+import tracing
+
+# Location of the on-disk account ID cache (override with AWS_BUDDY_CACHE_DIR)
+CACHE_DIR = os.getenv('AWS_BUDDY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'aws-buddy'))
+ACCOUNT_CACHE_FILE = os.path.join(CACHE_DIR, 'accounts.json')
+
+# Number of seconds a cached account ID is trusted before STS is asked again
+ACCOUNT_CACHE_TTL = 24 * 60 * 60
+
+# Size of the HTTP connection pool for each client
+MAX_POOL_CONNECTIONS = 25
+
+# Identifies the calls of the env configuration to the scheduler and tracer, in place of a profile name
+ENV_ACCOUNT_KEY = "(env)"
+
+# Access key and secret key of the sessions that replay the cassettes
+REPLAY_CREDENTIALS = "replay"
+
+_account_cache_lock = threading.Lock()
+
+_shared_loader = None
+_shared_loader_lock = threading.Lock()
+
+# Search path list that ignores paths it already contains (boto3 appends its data path
+# to the loader of every session it creates, which would grow the shared loader's list)
+class _SearchPaths(list):
+    def append(self, path):
+        if (path not in self):
+            super().append(path)
+
+# Returns the botocore data loader shared by every session created in this process. The
+# loader caches the JSON service models it reads, so each model is parsed once per run
+# rather than once per profile.
+def shared_loader():
+    global _shared_loader
+
+    with _shared_loader_lock:
+        if (_shared_loader is None):
+            # Honour AWS_DATA_PATH, as botocore's own loader does
+            data_paths = [os.path.expanduser(os.path.expandvars(path))
+                          for path in os.getenv('AWS_DATA_PATH', '').split(os.pathsep) if (path != '')]
+
+            _shared_loader = botocore.loaders.Loader(extra_search_paths=_SearchPaths(data_paths))
+
+        return _shared_loader
+
+# Returns a new botocore session that uses the shared data loader
+def create_botocore_session():
+    session = botocore.session.get_session()
+    session.register_component('data_loader', shared_loader())
+
+    return session
+
+# Returns a session for replaying the cassettes: it has static credentials (they are never sent)
+# and ignores AWS_PROFILE, so no AWS configuration is needed
+def create_replay_session(region_name):
+    botocore_session = botocore.session.Session(session_vars={'profile': (None, None, None, None)})
+    botocore_session.register_component('data_loader', shared_loader())
+
+    return boto3.session.Session(botocore_session=botocore_session, region_name=region_name,
+                                 aws_access_key_id=REPLAY_CREDENTIALS, aws_secret_access_key=REPLAY_CREDENTIALS)
 
 class Account:
     _profile_name = ''
     _session = None
     _user_groups_cache = None
+    _clients_lock = None
+    _clients = None
+    _account_id = None
+    _account_id_lock = None
+    _enabled_regions = None
 
-    def __init__(self, profile_name, region_name):
+    # If a session is given (e.g. with assumed role credentials), it is used instead of one for the
+    # profile or the env configuration
+    def __init__(self, profile_name, region_name, session=None):
         self._user_groups_cache = {}
+        self._clients_lock = threading.Lock()
+        self._clients = {}
+        self._account_id_lock = threading.Lock()
         self.profile_name = profile_name
 
-        if (self.profile_name is None):
+        if (session is not None):
+            self._region_name = region_name
+            self.session = session
+        elif (cassette.DEFAULT_CASSETTES.replaying):
+            # The profile (or env configuration) is only used to find the recorded account, and the
+            # region is the one it was recorded with unless another one is given
+            self._region_name = region_name or cassette.DEFAULT_CASSETTES.region_name(self.cache_key)
+            self.session = create_replay_session(self._region_name)
+        elif (self.profile_name is None):
             # Get credentials from env config settings
             self._region_name = region_name
 
             self.session = boto3.session.Session(
+                botocore_session=create_botocore_session(),
                 region_name=self._region_name,
                 aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
                 aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
         else:
             # Use the pre-defined AWS connection settings
             self._region_name = region_name
-            self.session = boto3.session.Session(profile_name=profile_name,
+            self.session = boto3.session.Session(botocore_session=create_botocore_session(),
+                                                 profile_name=profile_name,
                                                  region_name=self._region_name)
 
-        sts = self.session.client("sts")
-        self._account_id = sts.get_caller_identity()["Account"]
-
     @property
     def profile_name(self):
         return self._profile_name
@@ -43,10 +130,130 @@ class Account:
     def session(self, value):
         self._session = value
 
+    # Resolved on first use, from the cassettes when replaying, from the on-disk cache if possible
+    # (otherwise from STS). The on-disk cache is only used when the credentials can be identified.
     @property
     def account_id(self):
-        return self._account_id
+        with self._account_id_lock:
+            if (self._account_id is None):
+                cache_key = self.cache_key
+                self._account_id = cassette.DEFAULT_CASSETTES.account_id(cache_key)
+
+                if (self._account_id is None and cache_key is not None):
+                    self._account_id = read_cached_account_id(cache_key)
+
+                if (self._account_id is None):
+                    # The STS call is rate limited and traced like any other
+                    sts = scheduler.DEFAULT_SCHEDULER.attach(self.session.client("sts"), self.account_key)
+                    sts = tracing.DEFAULT_TRACER.attach(sts, self.account_key)
+
+                    self._account_id = sts.get_caller_identity()["Account"]
+
+                    if (cache_key is not None):
+                        write_cached_account_id(cache_key, self._account_id)
+
+                cassette.DEFAULT_CASSETTES.add_account(cache_key, self._account_id, self.region_name)
+
+            return self._account_id
+
+    # Identifies the credentials in use: the profile name (given, or from AWS_PROFILE), or a
+    # fingerprint of the access key. None if the env configuration has neither (e.g. SSO, or an
+    # instance or container role), as those credentials cannot be told apart.
+    @property
+    def cache_key(self):
+        if (self.profile_name is not None):
+            return "profile:{0}".format(self.profile_name)
+
+        access_key = os.getenv('AWS_ACCESS_KEY_ID')
+
+        if (access_key):
+            return "key:{0}".format(hashlib.sha256(access_key.encode('utf-8')).hexdigest()[:16])
+
+        if (os.getenv('AWS_PROFILE')):
+            return "profile:{0}".format(os.getenv('AWS_PROFILE'))
+
+        return None
+
+    # Identifies the account's calls to the scheduler and tracer without looking up the account ID:
+    # the profile name (or "(env)" for the env configuration)
+    @property
+    def account_key(self):
+        return self.profile_name or ENV_ACCOUNT_KEY
 
     @property
     def region_name(self):
-        return self._region_name
\ No newline at end of file
+        return self._region_name or self.session.region_name
+
+    # Function returning the account's credentials (as botocore credential metadata, refreshed
+    # when they are about to expire) for clients that are not created from the session (e.g. by
+    # aiofanout). None for a profile or the env configuration, which the clients find themselves.
+    @property
+    def credential_source(self):
+        return None
+
+    # Returns the (sorted) names of all regions enabled for this account
+    @property
+    def enabled_regions(self):
+        if (self._enabled_regions is None):
+            response = self.client('ec2').describe_regions()
+            self._enabled_regions = sorted([r['RegionName'] for r in response['Regions']])
+
+        return self._enabled_regions
+
+    # Returns the client for the given service and region, creating it on first use from
+    # this account's session so that every region shares the same credentials. Client
+    # creation from a single session is not thread-safe, but the returned clients are.
+    # Calls made through the client are rate limited (and retried when throttled) by the
+    # shared scheduler, recorded by the shared tracer when --trace is used, and recorded to (or
+    # answered from) the shared cassettes when --record (or --replay) is used.
+    def client(self, service_name, region_name=None):
+        key = (service_name, region_name or self.region_name)
+
+        with self._clients_lock:
+            if (key not in self._clients):
+                client = self.session.client(
+                    service_name, region_name=key[1],
+                    config=botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+                # The account ID is only looked up (which may call STS) if the cassettes need it
+                client = scheduler.DEFAULT_SCHEDULER.attach(client, self.account_key)
+                client = tracing.DEFAULT_TRACER.attach(client, self.account_key)
+                self._clients[key] = cassette.DEFAULT_CASSETTES.attach(client, lambda: self.account_id)
+
+            return self._clients[key]
+
+# Returns the account ID cached for the key, or None if it is missing or has expired
+def read_cached_account_id(cache_key):
+    with _account_cache_lock:
+        entry = _read_account_cache().get(cache_key)
+
+    if (entry is None or time.time() - entry.get('cached_at', 0) > ACCOUNT_CACHE_TTL):
+        return None
+
+    return entry.get('account_id')
+
+# Saves the account ID for the key in the on-disk cache
+def write_cached_account_id(cache_key, account_id):
+    with _account_cache_lock:
+        cache = _read_account_cache()
+        cache[cache_key] = {'account_id': account_id, 'cached_at': time.time()}
+
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+
+            # Write to a temporary file first so a crash never leaves a partial cache behind
+            temp_file = '{0}.{1}.tmp'.format(ACCOUNT_CACHE_FILE, os.getpid())
+
+            with open(temp_file, 'w') as f:
+                json.dump(cache, f)
+
+            os.replace(temp_file, ACCOUNT_CACHE_FILE)
+        except OSError:
+            pass # The cache is only an optimization
+
+def _read_account_cache():
+    try:
+        with open(ACCOUNT_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
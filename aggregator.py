@@ -0,0 +1,108 @@
+import json
+
+# aggregator
+# Org-wide inventory from an AWS Config aggregator. Rather than calling the describe_* APIs in every
+# account and region, the configuration items recorded by AWS Config for all of the accounts and
+# regions of an aggregator are listed with a few select_aggregate_resource_config (advanced query)
+# calls. The items are returned in the shape of the describe_* responses, so the scripts build
+# their rows from them with the same functions they use for the API responses.
+
+# Number of configuration items requested per select_aggregate_resource_config call (max 100)
+DEFAULT_PAGE_SIZE = 100
+
+# Properties of the configuration items selected by default
+DEFAULT_PROPERTIES = ['accountId', 'awsRegion', 'resourceId', 'configuration', 'tags']
+
+# Returns an advanced query string literal for the value
+def _literal(value):
+    return "'{0}'".format(str(value).replace("'", "''"))
+
+# Returns an advanced query condition testing the property against the values (one or more)
+def condition(property_name, values):
+    if (len(values) == 1):
+        return "{0} = {1}".format(property_name, _literal(values[0]))
+
+    return "{0} IN ({1})".format(property_name, ", ".join([_literal(v) for v in values]))
+
+# Returns the advanced query conditions for EC2 describe_* Filters (as built by filters.ec2_filters),
+# where properties maps each filter name to the configuration item property it tests. Tag filters
+# are always supported. As with EC2, the conditions are ANDed and the values of each filter are ORed
+# (so the tag keys that must all be present each have a filter of their own). Raises ValueError for
+# a filter that has no property.
+def ec2_filter_conditions(ec2_filters, properties):
+    conditions = []
+
+    for ec2_filter in ec2_filters or []:
+        name = ec2_filter['Name']
+
+        if (name.startswith('tag:')):
+            conditions.append(condition('tags.tag', ["{0}={1}".format(name[4:], v) for v in ec2_filter['Values']]))
+        elif (name == 'tag-key'):
+            conditions.append(condition('tags.key', ec2_filter['Values']))
+        elif (name in properties):
+            conditions.append(condition(properties[name], ec2_filter['Values']))
+        else:
+            raise ValueError("the {0} filter cannot be used with an aggregator".format(name))
+
+    return conditions
+
+# Returns the advanced query selecting the properties (by default the account, region, ID,
+# configuration and tags) of every configuration item of the resource type (e.g. AWS::EC2::Volume)
+# in the accounts and regions (all of the aggregator's if None) that meets all of the conditions
+def build_query(resource_type, account_ids=None, regions=None, conditions=None, properties=DEFAULT_PROPERTIES):
+    where = [condition('resourceType', [resource_type])]
+
+    if (account_ids):
+        where.append(condition('accountId', account_ids))
+
+    if (regions):
+        where.append(condition('awsRegion', regions))
+
+    return "SELECT {0} WHERE {1}".format(", ".join(properties), " AND ".join(where + (conditions or [])))
+
+# Returns the value with the keys of every dictionary in it changed from the camelCase used by
+# AWS Config (volumeId, availableCapacity, ...) to the PascalCase of the EC2 APIs (VolumeId,
+# AvailableCapacity, ...). Null values are left out, as the EC2 APIs leave out unset fields.
+def to_api_shape(value):
+    if (isinstance(value, dict)):
+        return {key[:1].upper() + key[1:]: to_api_shape(v) for key, v in value.items() if v is not None}
+
+    if (isinstance(value, list)):
+        return [to_api_shape(v) for v in value]
+
+    return value
+
+# Yields the results of an advanced query run against the aggregator, one page at a time. Each
+# result is a dictionary of the selected properties.
+def select(client, aggregator_name, expression, page_size=DEFAULT_PAGE_SIZE):
+    paginator = client.get_paginator('select_aggregate_resource_config')
+
+    for result in paginator.paginate(Expression=expression, ConfigurationAggregatorName=aggregator_name,
+                                     PaginationConfig={'PageSize': page_size}).search('Results'):
+        yield json.loads(result)
+
+# Yields an (account ID, region, resource) tuple for every configuration item of the resource type
+# in the accounts and regions (all of the aggregator's if None) that meets all of the conditions.
+# Each resource is in the shape returned by the EC2 describe_* APIs (including its Tags).
+def get_resources(client, aggregator_name, resource_type, account_ids=None, regions=None, conditions=None,
+                  page_size=DEFAULT_PAGE_SIZE):
+    expression = build_query(resource_type, account_ids, regions, conditions)
+
+    for item in select(client, aggregator_name, expression, page_size):
+        resource = to_api_shape(item.get('configuration') or {})
+        resource['Tags'] = to_api_shape(item.get('tags') or [])
+
+        yield item['accountId'], item['awsRegion'], resource
+
+# Returns the rows (which must have account_id and region_name) grouped by account and region, in
+# (account ID, region) order. Each of the known scopes ((account ID, region) pairs, e.g. from an
+# inventory store) in the accounts and regions (all if None) gets a group, even if it has no rows,
+# so that the rows no longer present there can be detected.
+def group_rows(rows, known_scopes=(), account_ids=None, regions=None):
+    groups = {scope: [] for scope in known_scopes
+              if (not account_ids or scope[0] in account_ids) and (not regions or scope[1] in regions)}
+
+    for row in rows:
+        groups.setdefault((row.account_id, row.region_name), []).append(row)
+
+    return sorted(groups.items())
@@ -0,0 +1,250 @@
+import asyncio
+import contextlib
+import queue
+import threading
+
+import account
+import fanout
+import scheduler
+import tracing
+
+import botocore.credentials
+
+try:
+    import aiobotocore.config
+    import aiobotocore.credentials
+    import aiobotocore.session
+except ImportError:
+    aiobotocore = None # Optional: only needed for --async
+
+# aiofanout
+# asyncio counterpart of fanout, for runs covering hundreds of (account, region) pairs. Instead
+# of a thread per request, every request is made from a single event loop with aiobotocore
+# (an asyncio version of botocore), so thousands of requests can be in flight at once. The
+# number of requests in flight is limited both overall and for each account.
+
+DEFAULT_MAX_IN_FLIGHT = 256
+DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT = 32
+
+_DONE = object()
+
+# Returns True if the optional asyncio dependency (aiobotocore) is installed
+def available():
+    return aiobotocore is not None
+
+# Validates the --max-in-flight and --max-in-flight-per-account command-line values
+def max_in_flight_arg(value):
+    in_flight = int(value)
+
+    if (in_flight < 1):
+        raise ValueError("max in flight must be at least 1")
+
+    return in_flight
+
+# Provides the credentials of an account with a credential source (account.Account.credential_source,
+# e.g. an assumed role) to an aiobotocore session, refreshing them before they expire. The credential
+# source is called on a worker thread, as it may block (e.g. on AssumeRole).
+class _CredentialSourceProvider(botocore.credentials.CredentialProvider):
+    METHOD = 'credential-source'
+    CANONICAL_NAME = 'CredentialSource'
+
+    def __init__(self, credential_source):
+        super().__init__()
+        self._credential_source = credential_source
+
+    async def _refresh(self):
+        return await asyncio.to_thread(self._credential_source)
+
+    async def load(self):
+        return aiobotocore.credentials.AioRefreshableCredentials.create_from_metadata(
+            await self._refresh(), self._refresh, self.METHOD)
+
+# The aiobotocore clients used by a run, created on first use for each account (account.Account),
+# service and region and closed when the run ends. Every call made through the pool waits for a
+# free slot, both overall and for the account. Throttled calls are retried by botocore's adaptive
+# retry mode, which also slows the client down (the shared scheduler blocks, so it is not used).
+class ClientPool:
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_in_flight_per_account=DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT):
+        self._stack = contextlib.AsyncExitStack()
+        self._sessions = {}
+        self._clients = {}
+        self._lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._account_in_flight = {}
+        self._max_in_flight_per_account = max_in_flight_per_account
+        self._config = aiobotocore.config.AioConfig(
+            max_pool_connections=max(max_in_flight_per_account, account.MAX_POOL_CONNECTIONS),
+            retries={'mode': 'adaptive', 'max_attempts': scheduler.DEFAULT_MAX_ATTEMPTS})
+
+    # Returns the client for the account, service and region (the account's region by default)
+    async def client(self, aws_account, service_name, region_name=None):
+        key = (id(aws_account), service_name, region_name or aws_account.region_name)
+
+        async with self._lock:
+            if (key not in self._clients):
+                session = self._sessions.get(id(aws_account))
+
+                if (session is None):
+                    session = aiobotocore.session.AioSession(profile=aws_account.profile_name)
+                    session.register_component('data_loader', account.shared_loader())
+
+                    if (aws_account.credential_source is not None):
+                        session.get_component('credential_provider').insert_before(
+                            'env', _CredentialSourceProvider(aws_account.credential_source))
+
+                    self._sessions[id(aws_account)] = session
+
+                client = await self._stack.enter_async_context(
+                    session.create_client(service_name, region_name=key[2], config=self._config))
+
+                self._clients[key] = tracing.DEFAULT_TRACER.attach(client, aws_account.account_key)
+
+            return self._clients[key]
+
+    # Waits for a free slot, both overall and for the account
+    @contextlib.asynccontextmanager
+    async def _slot(self, aws_account):
+        account_in_flight = self._account_in_flight.get(aws_account.account_key)
+
+        if (account_in_flight is None):
+            account_in_flight = asyncio.Semaphore(self._max_in_flight_per_account)
+            self._account_in_flight[aws_account.account_key] = account_in_flight
+
+        async with account_in_flight:
+            async with self._in_flight:
+                yield
+
+    # Makes an API call (e.g. 'tag_resources') and returns its response
+    async def call(self, aws_account, service_name, region_name, operation_name, **parameters):
+        client = await self.client(aws_account, service_name, region_name)
+
+        async with self._slot(aws_account):
+            return await getattr(client, operation_name)(**parameters)
+
+    # Yields each page of a paginated API call (e.g. 'describe_volumes')
+    async def paginate(self, aws_account, service_name, region_name, operation_name, **parameters):
+        client = await self.client(aws_account, service_name, region_name)
+        pages = client.get_paginator(operation_name).paginate(**parameters).__aiter__()
+
+        while (True):
+            async with self._slot(aws_account):
+                try:
+                    page = await pages.__anext__()
+                except StopAsyncIteration:
+                    return
+
+            yield page
+
+    async def close(self):
+        await self._stack.aclose()
+
+# Runs task(pool, item) for every item concurrently, where task is a coroutine function and pool
+# a ClientPool shared by all of the items. Yields (item, result, error) tuples in the same order
+# the items were passed in, as fanout.run_all does (but only once every task has finished).
+def run_all(items, task, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            max_in_flight_per_account=DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT):
+    items = list(items)
+
+    async def run():
+        pool = ClientPool(max_in_flight, max_in_flight_per_account)
+
+        try:
+            return await asyncio.gather(*[task(pool, item) for item in items], return_exceptions=True)
+        finally:
+            await pool.close()
+
+    for item, result in zip(items, asyncio.run(run())):
+        if (isinstance(result, Exception)):
+            yield item, None, result
+        else:
+            yield item, result, None
+
+# Runs task(pool, item) for every item concurrently, where task returns an asynchronous iterable
+# of rows and pool is a ClientPool shared by all of the items. Works like fanout.stream_all:
+# yields (item, rows) tuples in the same order the items were passed in, where 'rows' yields each
+# row as soon as it has been produced, and each item may only get buffer_size chunks of
+# chunk_size rows ahead of the consumer. The event loop runs on a thread of its own.
+def stream_all(items, task, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               max_in_flight_per_account=DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT,
+               chunk_size=fanout.DEFAULT_CHUNK_SIZE, buffer_size=fanout.DEFAULT_BUFFER_SIZE):
+    items = list(items)
+    queues = [queue.Queue() for item in items]
+    credits = [None for item in items] # Free buffer slots of each item (created on the loop)
+    loop = asyncio.new_event_loop()
+
+    async def produce(pool, index, item):
+        q = queues[index]
+
+        try:
+            chunk = []
+
+            async for row in task(pool, item):
+                chunk.append(row)
+
+                if (len(chunk) >= chunk_size):
+                    await credits[index].acquire()
+                    q.put(chunk)
+                    chunk = []
+
+            if (len(chunk) > 0):
+                await credits[index].acquire()
+                q.put(chunk)
+
+            q.put(_DONE)
+        except Exception as e:
+            q.put(e)
+
+    async def run():
+        pool = ClientPool(max_in_flight, max_in_flight_per_account)
+
+        for index in range(len(items)):
+            credits[index] = asyncio.Semaphore(buffer_size)
+
+        try:
+            await asyncio.gather(*[produce(pool, index, item) for index, item in enumerate(items)])
+        finally:
+            await pool.close()
+
+    # Hands a buffer slot back to the item's producer (once the loop has finished, nobody is waiting)
+    def release(index):
+        try:
+            loop.call_soon_threadsafe(credits[index].release)
+        except RuntimeError:
+            pass
+
+    def consume(index):
+        while (True):
+            chunk = queues[index].get()
+
+            if (chunk is _DONE):
+                return
+            if (isinstance(chunk, Exception)):
+                raise chunk
+
+            release(index)
+            yield from chunk
+
+    main = loop.create_task(run())
+
+    def run_loop():
+        try:
+            loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run_loop, daemon=True)
+    thread.start()
+
+    try:
+        for index, item in enumerate(items):
+            yield item, consume(index)
+    finally:
+        # Stop any producers still running if the consumer has gone away
+        try:
+            loop.call_soon_threadsafe(main.cancel)
+        except RuntimeError:
+            pass
+
+        thread.join()
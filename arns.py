@@ -0,0 +1,147 @@
+import collections
+import fnmatch
+import functools
+import re
+
+# arns
+# Parsing and matching of Amazon Resource Names (ARNs). ARNs take the forms
+#   arn:partition:service:region:account-id:resource-id
+#   arn:partition:service:region:account-id:resource-type/resource-id
+#   arn:partition:service:region:account-id:resource-type:resource-id
+# where the resource ID may itself contain '/' or ':' (e.g. loadbalancer/app/my-lb/50dc6c495c0c9188).
+
+Arn = collections.namedtuple('Arn', ['partition', 'service', 'region', 'account_id', 'resource_type', 'resource_id'])
+
+# Number of parsed ARNs kept. An ARN is typically parsed several times in quick succession (when
+# it is matched, when its row is built and when each of its columns is written).
+ARN_CACHE_SIZE = 4096
+
+# Returns the parts of the ARN (an Arn), or None if it isn't an ARN
+@functools.lru_cache(maxsize=ARN_CACHE_SIZE)
+def parse(arn):
+    parts = arn.split(':', 5)
+
+    if (len(parts) != 6 or parts[0] != 'arn'):
+        return None
+
+    resource = parts[5]
+    slash = resource.find('/')
+    colon = resource.find(':')
+
+    # The resource type ends at whichever separator comes first
+    if (slash >= 0 and (colon < 0 or slash < colon)):
+        resource_type, resource_id = resource[:slash], resource[slash + 1:]
+    elif (colon >= 0):
+        resource_type, resource_id = resource[:colon], resource[colon + 1:]
+    else:
+        resource_type, resource_id = '', resource
+
+    return Arn(parts[1], parts[2], parts[3], parts[4], resource_type, resource_id)
+
+# Returns the regular expression source matching any of the literal strings. The strings are
+# arranged in a trie (so 'vol-1' and 'vol-2' become 'vol\-(?:1|2)'), which lets the regular
+# expression engine test thousands of them at each position without trying each one in turn.
+def _literal_trie(literals):
+    trie = {}
+
+    for literal in literals:
+        node = trie
+
+        for character in literal:
+            node = node.setdefault(character, {})
+
+        node[''] = None # End of a literal
+
+    def source(node):
+        if ('' in node):
+            # A shorter literal ends here, so whatever follows it is not needed for a match
+            return ''
+
+        branches = [re.escape(character) + source(child) for character, child in sorted(node.items())]
+
+        return branches[0] if (len(branches) == 1) else "(?:" + "|".join(branches) + ")"
+
+    return source(trie)
+
+# Returns a function testing whether a string matches any of the patterns (None if there are none).
+# Patterns starting with 're:' are regular expressions (searched for), patterns containing *, ?
+# or [ are globs (matching the whole ARN) and anything else is a case-sensitive substring. Only the
+# substrings are matched in a single pass however many there are (through the trie). The globs are
+# combined into one regular expression, but its alternatives are still tried one after another, and
+# each 're:' pattern is compiled and searched on its own (so that its groups, backreferences and
+# inline flags keep their meaning), so the cost per ARN grows with the number of globs and 're:'
+# patterns. Raises re.error (naming the pattern) for an invalid regular expression.
+def _compile_patterns(patterns):
+    literals = []
+    globs = []
+    searches = []
+
+    for pattern in patterns:
+        if (pattern.startswith('re:')):
+            try:
+                searches.append(re.compile(pattern[3:]).search)
+            except re.error as e:
+                raise re.error("{0} in {1}".format(e.msg, pattern))
+        elif (any(character in pattern for character in '*?[')):
+            globs.append("^(?:{0})".format(fnmatch.translate(pattern)))
+        elif (pattern != ''):
+            literals.append(pattern)
+
+    if (len(literals) > 0):
+        globs.append(_literal_trie(literals))
+
+    if (len(globs) > 0):
+        searches.insert(0, re.compile("|".join(globs)).search)
+
+    if (len(searches) == 0):
+        return None
+
+    if (len(searches) == 1):
+        return searches[0]
+
+    def search(string):
+        for pattern_search in searches:
+            match = pattern_search(string)
+
+            if (match is not None):
+                return match
+
+        return None
+
+    return search
+
+# Tests ARNs against any number of include and exclude patterns. An ARN matches if it matches any of
+# the include patterns (or there are none) and none of the exclude patterns.
+class ArnMatcher:
+    def __init__(self, include=None, exclude=None):
+        self._include = _compile_patterns(include or [])
+        self._exclude = _compile_patterns(exclude or [])
+
+    # Returns a matcher for the -f/--filter, --exclude and --filter-file command-line values. Lines
+    # of the file are include patterns, or exclude patterns if they start with '!' (blank lines and
+    # lines starting with '#' are ignored).
+    @classmethod
+    def from_args(cls, include=None, exclude=None, filter_file=None):
+        include = list(include or [])
+        exclude = list(exclude or [])
+
+        if (filter_file is not None):
+            with open(filter_file) as f:
+                for line in f:
+                    line = line.strip()
+
+                    if (line == '' or line.startswith('#')):
+                        continue
+
+                    if (line.startswith('!')):
+                        exclude.append(line[1:])
+                    else:
+                        include.append(line)
+
+        return cls(include, exclude)
+
+    def matches(self, arn):
+        if (self._include is not None and self._include(arn) is None):
+            return False
+
+        return self._exclude is None or self._exclude(arn) is None
@@ -0,0 +1,44 @@
+import argparse
+import importlib
+import sys
+
+# aws-buddy
+# Single entry point for all of the AWS Buddy scripts: aws-buddy <subcommand> [options]
+# Subcommands are only imported (along with boto3) once the one being run is known.
+
+# Subcommand name => (module, description)
+SUBCOMMANDS = {
+    'ebs': ('aws-list-ebs', 'Creates a comma-delimited (CSV) file listing all EBS volumes.'),
+    'hosts': ('aws-list-dedicated-hosts', 'Creates a comma-delimited (CSV) file listing all Dedicated Hosts.'),
+    'tag': ('aws-tag-resources', 'Tags all (taggable) resources based on the tag keys and values passed in.'),
+    'inventory': ('aws-inventory', 'Lists EBS volumes, Dedicated Hosts and/or all taggable resources in a single pass.'),
+    'serve': ('aws-inventory-server', 'Keeps the inventory in memory and answers lookups over a local HTTP API.')
+}
+
+# Setup command-line arguments
+def setup_cli_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='aws-buddy',
+        description='Runs one of the AWS Buddy scripts. Use "aws-buddy <subcommand> -h" for the options of each subcommand.',
+        epilog="subcommands:\n" + "\n".join(
+            ["  {0:<11}{1}".format(name, description) for name, (module, description) in SUBCOMMANDS.items()]),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        "subcommand", help="The script to run.", choices=SUBCOMMANDS.keys(), metavar="subcommand")
+
+    parser.add_argument(
+        "arguments", help="Options passed on to the subcommand.", nargs=argparse.REMAINDER)
+
+    return parser.parse_args(argv)
+
+# Runs the subcommand with the remaining command-line arguments
+def main(argv=None):
+    args = setup_cli_args(argv)
+
+    module = importlib.import_module(SUBCOMMANDS[args.subcommand][0])
+
+    return module.main(args.arguments, "aws-buddy {0}".format(args.subcommand))
+
+if (__name__ == "__main__"):
+    sys.exit(main())
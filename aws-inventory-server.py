@@ -0,0 +1,223 @@
+from datetime import datetime
+import argparse
+import cache
+import cli
+import collectors
+import fanout
+import http.server
+import json
+import organization
+import os
+import socketserver
+import urllib.parse
+
+# aws-inventory-server
+# Keeps the inventory of the specified accounts (EBS volumes, Dedicated Hosts and/or taggable
+# resources) in memory, refreshing each account and region in the background once it is older
+# than the TTL, and answers lookups over a local HTTP API (on a TCP port or a Unix socket):
+#   GET /instances/<instance ID>     GET /volumes/<volume ID>     GET /hosts/<host ID>
+#   GET /tags?key=<key>[&value=<value>]     GET /arns?prefix=<ARN prefix>[&limit=<ARNs>]
+#   GET /status
+# Lookups return JSON: {"count": ..., "results": [{"Collector": ..., <field>: <value>, ...}]}.
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Path => cache index looked up with the rest of the path
+ID_LOOKUPS = {'instances': 'instance', 'volumes': 'volume', 'hosts': 'host'}
+
+# Setup command-line arguments
+def setup_cli_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Keeps EBS volumes, Dedicated Hosts and/or all taggable resources in memory and answers lookups over a local HTTP API.',
+        epilog="collectors:\n" + "\n".join(
+            ["  {0:<11}{1}".format(name, collector.description) for name, collector in collectors.COLLECTORS.items()]),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        "-p", "--profile", dest="profile", help="A comma-separated list of profiles (from credentials file) to be used. If specifying more than one profile, they must be enclosed in quotes.")
+
+    parser.add_argument(
+        "-r", "--region", help="Set a region if not already included in profile.", dest="region")
+
+    parser.add_argument(
+        "-c", "--collectors", help="A comma-separated list of collectors to run (default: all).", dest="collectors",
+        default=",".join(collectors.COLLECTORS))
+
+    regions = parser.add_mutually_exclusive_group()
+
+    regions.add_argument(
+        "-a", "--all-regions", help="Query every region enabled for each account.", dest="all_regions", action="store_true")
+
+    regions.add_argument(
+        "--regions", help="A comma-separated list of regions to query in each account.", dest="regions")
+
+    parser.add_argument(
+        "-w", "--max-workers", help="The maximum number of profiles, regions and collectors to refresh in parallel.", dest="max_workers",
+        type=fanout.max_workers_arg, default=fanout.DEFAULT_MAX_WORKERS)
+
+    organization.add_arguments(parser)
+
+    parser.add_argument(
+        "-s", "--services", help="A comma-separated list of AWS Services (e.g. s3) or resource types (e.g. ec2:volume) listed by the resources collector.", dest="services")
+
+    parser.add_argument(
+        "--ttl", help="The number of seconds after which each account and region is refreshed (default: {0}).".format(cache.DEFAULT_TTL), dest="ttl",
+        type=cache.ttl_arg, default=cache.DEFAULT_TTL)
+
+    parser.add_argument(
+        "--host", help="The address to listen on (default: {0}).".format(DEFAULT_HOST), dest="host", default=DEFAULT_HOST)
+
+    parser.add_argument(
+        "--port", help="The port to listen on (default: {0}).".format(DEFAULT_PORT), dest="port", type=int, default=DEFAULT_PORT)
+
+    parser.add_argument(
+        "--socket", help="Listen on this Unix socket instead of a TCP port.", dest="socket")
+
+    args = parser.parse_args(argv)
+
+    organization.check_arguments(parser, args)
+
+    args.collectors = [c.strip() for c in args.collectors.split(',')]
+
+    for name in args.collectors:
+        if (name not in collectors.COLLECTORS):
+            parser.error("unknown collector: {0} (choose from {1})".format(name, ", ".join(collectors.COLLECTORS)))
+
+    if (args.services is not None):
+        args.services = [s.strip() for s in args.services.split(',')]
+
+    if (args.socket is not None and not hasattr(socketserver, 'UnixStreamServer')):
+        parser.error("--socket is not supported on this platform")
+
+    return args
+
+# Displays startup parameters
+def display_startup_parameters(args):
+    print("*******************************************")
+    cli.display_target_parameters(args)
+
+    print("  Collectors: {0}".format(", ".join(args.collectors)))
+    print("  Workers:    {0}".format(args.max_workers))
+    print("  TTL:        {0} seconds".format(args.ttl))
+    print("  Date:       {0}".format(datetime.now().strftime("%c")))
+
+    if (args.socket is not None):
+        print("  Listening:  {0}".format(args.socket))
+    else:
+        print("  Listening:  http://{0}:{1}/".format(args.host, args.port))
+
+    print("*******************************************")
+
+# Returns the row of the collector as a dictionary keyed by field name
+def row_result(collector, row):
+    result = {'Collector': collector.name}
+    result.update(zip(collector.field_names, row))
+
+    return result
+
+# Answers the lookups of the HTTP API from the inventory cache (the server's inventory_cache)
+class LookupHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/', 1)]
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        inventory_cache = self.server.inventory_cache
+
+        if (path == ['status']):
+            self._send(200, inventory_cache.status())
+        elif (len(path) == 2 and path[0] in ID_LOOKUPS and path[1] != ''):
+            self._send_results(inventory_cache.lookup(ID_LOOKUPS[path[0]], path[1]))
+        elif (path == ['tags'] and 'key' in query):
+            if ('value' in query):
+                self._send_results(inventory_cache.lookup('tag', (query['key'], query['value'])))
+            else:
+                self._send_results(inventory_cache.lookup('tag-key', query['key']))
+        elif (path == ['arns'] and 'prefix' in query):
+            try:
+                limit = int(query['limit']) if ('limit' in query) else None
+            except ValueError:
+                self._send(400, {'error': "limit must be a number"})
+                return
+
+            self._send_results(inventory_cache.lookup_arn_prefix(query['prefix'], limit))
+        else:
+            self._send(404, {'error': "unknown lookup: {0}".format(url.path)})
+
+    def _send_results(self, results):
+        self._send(200, {'count': len(results), 'results': [row_result(collector, row) for collector, row in results]})
+
+    def _send(self, status_code, body):
+        content = json.dumps(body).encode('utf-8')
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if (isinstance(self.client_address, tuple)) else self.server.server_address
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Returns the HTTP server for the command-line arguments (on a Unix socket, or a TCP port)
+def create_server(args, inventory_cache):
+    if (args.socket is not None):
+        # Remove the socket left behind by a previous run
+        if (os.path.exists(args.socket)):
+            os.remove(args.socket)
+
+        server = ThreadingUnixHTTPServer(args.socket, LookupHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), LookupHandler)
+
+    server.inventory_cache = inventory_cache
+
+    return server
+
+# Runs the script with the given command-line arguments (defaults to sys.argv)
+def main(argv=None, prog=None):
+    # Load the environment variables and get command-line arguments
+    args = cli.parse_args(setup_cli_args, argv, prog)
+
+    # Get the list of comma-delimited profiles (or the member accounts of the organization)
+    profiles = cli.get_profiles(args)
+
+    display_startup_parameters(args)
+
+    # Resolve all AWS profiles (and the regions to query for each) in parallel
+    targets = cli.resolve_targets(profiles, args, "Serving...")
+
+    collector_list = [collectors.COLLECTORS[name](args) for name in args.collectors]
+
+    inventory_cache = cache.InventoryCache(targets, collector_list, args.ttl, args.max_workers)
+
+    try:
+        server = create_server(args, inventory_cache)
+    except OSError as e:
+        print("Failed to listen on {0}: {1}".format(args.socket or "{0}:{1}".format(args.host, args.port), e))
+        exit(1)
+
+    # Answer lookups straight away (from whatever has been loaded so far; see /status)
+    inventory_cache.start()
+
+    print("")
+    print("Loading the inventory in the background. Press Ctrl+C to stop.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        inventory_cache.stop()
+
+        if (args.socket is not None and os.path.exists(args.socket)):
+            os.remove(args.socket)
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,242 @@
+from datetime import datetime
+import aiofanout
+import argparse
+import cassette
+import cli
+import collectors
+import summary
+import fanout
+import inventory
+import organization
+import os
+import tracing
+import writers
+
+# aws-inventory
+# Runs any number of collectors (EBS volumes, Dedicated Hosts, taggable resources) against the
+# specified AWS accounts in a single concurrent pass. Each account is authenticated once, and its
+# clients are shared by every collector; each collector's rows are streamed to their own file.
+
+# Setup command-line arguments
+def setup_cli_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Lists EBS volumes, Dedicated Hosts and/or all taggable resources in the specified accounts in a single pass.',
+        epilog="collectors:\n" + "\n".join(
+            ["  {0:<11}{1}".format(name, collector.description) for name, collector in collectors.COLLECTORS.items()]),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        "-p", "--profile", dest="profile", help="A comma-separated list of profiles (from credentials file) to be used. If specifying more than one profile, they must be enclosed in quotes.")
+
+    parser.add_argument(
+        "-r", "--region", help="Set a region if not already included in profile.", dest="region")
+
+    parser.add_argument(
+        "-c", "--collectors", help="A comma-separated list of collectors to run (default: all).", dest="collectors",
+        default=",".join(collectors.COLLECTORS))
+
+    parser.add_argument(
+        "-d", "--output-dir", help="Directory the output files (one per collector) are written to.", dest="output_dir", default=".")
+
+    regions = parser.add_mutually_exclusive_group()
+
+    regions.add_argument(
+        "-a", "--all-regions", help="Query every region enabled for each account.", dest="all_regions", action="store_true")
+
+    regions.add_argument(
+        "--regions", help="A comma-separated list of regions to query in each account.", dest="regions")
+
+    parser.add_argument(
+        "-w", "--max-workers", help="The maximum number of profiles, regions and collectors to process in parallel.", dest="max_workers",
+        type=fanout.max_workers_arg, default=fanout.DEFAULT_MAX_WORKERS)
+
+    organization.add_arguments(parser)
+
+    parser.add_argument(
+        "--async", help="Make every API call from a single asyncio event loop (requires aiobotocore) instead of a pool of worker threads.", dest="use_async", action="store_true")
+
+    parser.add_argument(
+        "--max-in-flight", help="With --async, the maximum number of API calls in progress at once (default: {0}).".format(aiofanout.DEFAULT_MAX_IN_FLIGHT), dest="max_in_flight",
+        type=aiofanout.max_in_flight_arg, default=aiofanout.DEFAULT_MAX_IN_FLIGHT)
+
+    parser.add_argument(
+        "--max-in-flight-per-account", help="With --async, the maximum number of API calls in progress at once for each account (default: {0}).".format(aiofanout.DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT), dest="max_in_flight_per_account",
+        type=aiofanout.max_in_flight_arg, default=aiofanout.DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT)
+
+    parser.add_argument(
+        "-s", "--services", help="A comma-separated list of AWS Services (e.g. s3) or resource types (e.g. ec2:volume) listed by the resources collector.", dest="services")
+
+    parser.add_argument(
+        "--summary", help="Also write the totals of the ebs and hosts collectors (as the --summary of aws-list-ebs and aws-list-dedicated-hosts) next to their output (e.g. volumes.summary.csv).", dest="summary", action="store_true")
+
+    parser.add_argument(
+        "--store", help="A SQLite file in which to keep the inventory between runs (default with --diff: {0}).".format(inventory.DEFAULT_STORE), dest="store")
+
+    parser.add_argument(
+        "--diff", help="Only output the rows that were added, removed or changed since the last run recorded in the store.", dest="diff", action="store_true")
+
+    parser.add_argument(
+        "--format", help="Output format (default: csv).", dest="format", choices=writers.FORMATS, default="csv")
+
+    parser.add_argument(
+        "--trace", help="Display per-operation API latencies and local timings when done, and optionally write them to a Chrome trace (JSON) file.",
+        dest="trace", nargs='?', const=True, metavar="FILE")
+
+    cassette.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    organization.check_arguments(parser, args)
+    cassette.check_arguments(parser, args)
+
+    args.collectors = [c.strip() for c in args.collectors.split(',')]
+
+    for name in args.collectors:
+        if (name not in collectors.COLLECTORS):
+            parser.error("unknown collector: {0} (choose from {1})".format(name, ", ".join(collectors.COLLECTORS)))
+
+    if (args.services is not None):
+        args.services = [s.strip() for s in args.services.split(',')]
+
+    if (args.use_async and not aiofanout.available()):
+        parser.error("--async requires aiobotocore (pip install aiobotocore)")
+
+    if (args.format == 'parquet' and not writers.parquet_available()):
+        parser.error("Parquet output requires pyarrow (pip install pyarrow)")
+
+    # A diff needs a previous snapshot to compare against
+    if (args.diff and args.store is None):
+        args.store = inventory.DEFAULT_STORE
+
+    return args
+
+# Displays startup parameters
+def display_startup_parameters(args):
+    print("*******************************************")
+    cli.display_target_parameters(args)
+
+    print("  Collectors: {0}".format(", ".join(args.collectors)))
+    if (args.use_async):
+        print("  In flight:  {0} ({1} per account)".format(args.max_in_flight, args.max_in_flight_per_account))
+    else:
+        print("  Workers:    {0}".format(args.max_workers))
+    print("  Date:       {0}".format(datetime.now().strftime("%c")))
+    print("  Output:     {0}".format(args.output_dir))
+
+    if (args.store is not None):
+        print("  Store:      {0}{1}".format(args.store, " (changes only)" if args.diff else ""))
+
+    print("*******************************************")
+
+# Returns the rows of one collector for a single account and region (runs on a worker thread)
+def process_target(collector, aws_account, region_name):
+    return tracing.DEFAULT_TRACER.timed_rows(collector.collect(aws_account, region_name),
+                                             'build rows ({0})'.format(collector.name))
+
+# Runs every collector for every (account, region) pair in parallel (on worker threads, or on an
+# event loop with --async), writing each collector's rows to its own file in profile/region order
+# as they arrive (and adding them to the collector's summary, if it has one). Returns the number of
+# rows written for each collector.
+def write_rows(targets, collector_list, args, outputs, stores, summaries):
+    row_counts = {collector.name: 0 for collector in collector_list}
+    writes = {name: tracing.DEFAULT_TRACER.timed(writer.write, 'write rows') for name, writer in outputs.items()}
+    items = [(collector, aws_account, region_name)
+             for aws_account, region_name in targets for collector in collector_list]
+
+    if (args.use_async):
+        streams = aiofanout.stream_all(items, lambda pool, item: item[0].collect_async(pool, *item[1:]),
+                                       args.max_in_flight, args.max_in_flight_per_account)
+    else:
+        streams = fanout.stream_all(items, lambda item: process_target(*item), args.max_workers)
+
+    for (collector, aws_account, region_name), rows in streams:
+        row_count = 0
+        write = writes[collector.name]
+
+        if (collector.name in summaries):
+            rows = summaries[collector.name].tap(rows)
+
+        if (collector.name in stores):
+            rows = stores[collector.name].track(rows, aws_account.account_id, region_name, args.diff)
+
+        try:
+            for row in rows:
+                write(row)
+                row_count += 1
+        except Exception as e:
+            print("Failed to collect {0} for account {1} in {2} after {3} rows: {4}\r\n".format(
+                collector.name, aws_account.account_id, region_name, row_count, e))
+            continue
+        finally:
+            row_counts[collector.name] += row_count
+
+        print("{0} {1} rows processed for account {2} in {3}.".format(
+            row_count, collector.name, aws_account.account_id, region_name))
+
+    return row_counts
+
+# Runs the script with the given command-line arguments (defaults to sys.argv)
+def main(argv=None, prog=None):
+    # Load the environment variables and get command-line arguments
+    args = cli.parse_args(setup_cli_args, argv, prog)
+
+    # Start tracing, and record the AWS API responses (or answer the calls from those recorded before)
+    cli.start(args)
+
+    # Get the list of comma-delimited profiles (or the member accounts of the organization)
+    profiles = cli.get_profiles(args)
+
+    display_startup_parameters(args)
+
+    # Resolve all AWS profiles (and the regions to query for each) in parallel, once for all collectors
+    targets = cli.resolve_targets(profiles, args)
+
+    collector_list = [collectors.COLLECTORS[name](args) for name in args.collectors]
+
+    # Open an output file (and inventory store) for each collector
+    filenames = {collector.name: os.path.join(args.output_dir, "{0}.{1}".format(collector.output, args.format))
+                 for collector in collector_list}
+    outputs = {}
+    stores = {}
+    summaries = {}
+
+    try:
+        for collector in collector_list:
+            field_names = (['Change'] if args.diff else []) + collector.field_names
+
+            outputs[collector.name] = writers.open_writer(filenames[collector.name], field_names, args.format)
+
+            if (args.store is not None):
+                stores[collector.name] = inventory.InventoryStore(args.store, collector.name, collector.key)
+
+            if (args.summary and collector.name in summary.SUMMARIES):
+                summaries[collector.name] = summary.SUMMARIES[collector.name]()
+
+        row_counts = write_rows(targets, collector_list, args, outputs, stores, summaries)
+
+        for name, collector_summary in summaries.items():
+            collector_summary.write(filenames[name], args.format)
+    except OSError as e:
+        print('An error occurred when writing the output: {0}'.format(e))
+        row_counts = None
+    finally:
+        for writer in outputs.values():
+            writer.close()
+
+        for store in stores.values():
+            store.close()
+
+    print("")
+
+    if (row_counts is not None):
+        for collector in collector_list:
+            print("{0} rows successfully saved to {1}".format(row_counts[collector.name], filenames[collector.name]))
+
+        print("")
+
+    # Display the API call counts and timings
+    cli.finish(args)
+
+if (__name__ == "__main__"):
+    main()
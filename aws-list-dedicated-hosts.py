@@ -1,16 +1,37 @@
-# from datetime import datetime
 import account
+import aggregator
 import argparse
-import dotenv
-import csv
+import cassette
+import cli
+import collections
+import summary
+import fanout
+import filters
+import inventory
+import organization
+import records
+import tracing
+import writers
 import datetime
-from json import JSONEncoder
 
 # Generates a comma-delimited (CSV) file listing all Dedicated Hosts within the specified AWS account.
 
+# Number of hosts requested per describe_hosts call (max 500)
+HOST_PAGE_SIZE = 500
+
+# Number of instance IDs resolved per batch of describe_instances calls (max 200 filter values)
+INSTANCE_BATCH_SIZE = 200
+
+FIELD_NAMES = ['Account ID', 'Region', 'Host ID', 'Host Name', 'Host Reservation ID',
+               'Availability Zone', 'Total Instance Capacity',
+               'Available Instance Capacity', 'Instance Type',
+               'Available vCPUs', 'EC2 Instance ID', 'EC2 ARN', 'EC2 Name',
+               'EC2 Instance Type']
+
 # Setup command-line arguments
-def setup_cli_args():
+def setup_cli_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Creates a comma-delimited (CSV) file listing all Dedicated Hosts in the specified account.')
 
     parser.add_argument(
@@ -20,143 +41,179 @@ def setup_cli_args():
         "-r", "--region", help="Set a region if not already included in profile.", dest="region")
 
     parser.add_argument(
-        "-o", "--output", help="Output (CSV) filename.", dest="output", default="volumes.csv")
+        "-o", "--output", help="Output filename.", dest="output", default="volumes.csv")
+
+    regions = parser.add_mutually_exclusive_group()
+
+    regions.add_argument(
+        "-a", "--all-regions", help="Query every region enabled for each account.", dest="all_regions", action="store_true")
+
+    regions.add_argument(
+        "--regions", help="A comma-separated list of regions to query in each account.", dest="regions")
+
+    parser.add_argument(
+        "-w", "--max-workers", help="The maximum number of profiles (and regions) to process in parallel.", dest="max_workers",
+        type=fanout.max_workers_arg, default=fanout.DEFAULT_MAX_WORKERS)
+
+    organization.add_arguments(parser)
+
+    parser.add_argument(
+        "--aggregator", help="Read the Dedicated Hosts of every account and region from this AWS Config aggregator (in the account and region of the profile) instead of querying each account.", dest="aggregator")
+
+    parser.add_argument(
+        "--accounts", help="With --aggregator, only list the Dedicated Hosts of these accounts (comma-separated account IDs).", dest="accounts")
+
+    parser.add_argument(
+        "--summary", help="Also write the number of hosts and instances, capacity and packing efficiency by account and instance type next to the output (e.g. hosts.summary.csv).", dest="summary", action="store_true")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--store", help="A SQLite file in which to keep the inventory between runs (default with --diff: {0}).".format(inventory.DEFAULT_STORE), dest="store")
+
+    parser.add_argument(
+        "--diff", help="Only output the rows that were added, removed or changed since the last run recorded in the store.", dest="diff", action="store_true")
 
-# Displays startup paramters
+    parser.add_argument(
+        "--format", help="Output format (default: based on the output filename, otherwise csv).", dest="format",
+        choices=writers.FORMATS)
+
+    parser.add_argument(
+        "--trace", help="Display per-operation API latencies and local timings when done, and optionally write them to a Chrome trace (JSON) file.",
+        dest="trace", nargs='?', const=True, metavar="FILE")
+
+    cassette.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    organization.check_arguments(parser, args)
+    cassette.check_arguments(parser, args)
+
+    if (args.format is None):
+        args.format = writers.format_for(args.output)
+
+    if (args.format == 'parquet' and not writers.parquet_available()):
+        parser.error("Parquet output requires pyarrow (pip install pyarrow)")
+
+    # An aggregator is queried from a single account
+    if (args.aggregator is not None and args.profile is not None and len(args.profile.split(',')) > 1):
+        parser.error("--aggregator takes a single profile (the account the aggregator is in)")
+
+    if (args.aggregator is not None and args.org_role is not None):
+        parser.error("--aggregator cannot be used with --org-role")
+
+    # A diff needs a previous snapshot to compare against
+    if (args.diff and args.store is None):
+        args.store = inventory.DEFAULT_STORE
+
+    return args
+
+# Displays startup parameters
 def display_startup_parameters(args):
     print("*******************************************")
-    print("  Region:     {0}".format(args.region))
+    cli.display_target_parameters(args)
 
-    if (args.profile is None):
-        print("  Profile:    Using env configuration")
+    if (args.aggregator is not None):
+        print("  Aggregator: {0}".format(args.aggregator))
+        print("  Accounts:   {0}".format(args.accounts or "All aggregated accounts"))
     else:
-        print("  Profile:    {0}".format(args.profile))
+        print("  Workers:    {0}".format(args.max_workers))
 
     print("  Date:       {0}".format(datetime.datetime.now().strftime("%c")))
     print("  Output:     {0}".format(args.output))
+
+    if (args.store is not None):
+        print("  Store:      {0}{1}".format(args.store, " (changes only)" if args.diff else ""))
+
     print("*******************************************")
 
-# Display AWS Account settings
-def display_account_info(account):
-    print("Processing...")
-    print("  Account ID: {0}".format(account.account_id))
-    print("  Region:     {0}".format(account.session.region_name))
+# Returns the Name tag of an instance (as returned by describe_instances)
+def get_instance_name(instance):
+    instance_name = ''
 
-    if (account.profile_name is None):
-        print("  Profile:    Using env configuration")
-    else:
-        print("  Profile:    {0}".format(account.profile_name))
-
-# Creates a CSV file with Dedicated Host information
-def write_csv_file(filename, rows, field_names):
-    try:
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
-
-            writer.writerow(field_names)
-            writer.writerows(rows)
-    except BaseException as e:
-        print('An error occurred when writing to ', filename)
-    else:
-        print("{0} rows successfully saved to {1}\r\n".format(len(rows), filename))
+    for tag in instance.get('Tags', []):
+        if (tag['Key'] == 'Name'):
+            instance_name = tag['Value']
 
-class DateTimeEncoder(JSONEncoder):
-        #Override the default method
-        def default(self, obj):
-            if isinstance(obj, (datetime.date, datetime.datetime)):
-                return obj.isoformat()
+    return instance_name
 
-# Returns a list of Dedicated Host details for each of the Dedicated Hosts in the specified account
-def get_dedicated_host_details(client, account_id, region_name):
-    # Get a list of all Dedicated Hosts
-    host_details = client.describe_hosts()
+# Returns the Name tag of every instance in instance_ids, keyed by instance ID. Instances are
+# looked up in batches (rather than one describe_instances call per instance) and the names
+# found are kept in instance_name_cache so they are only looked up once per run.
+def get_instance_names(client, instance_ids, instance_name_cache):
+    missing_ids = [i for i in dict.fromkeys(instance_ids) if i not in instance_name_cache]
+    paginator = client.get_paginator('describe_instances')
+
+    for start in range(0, len(missing_ids), INSTANCE_BATCH_SIZE):
+        batch = missing_ids[start:start + INSTANCE_BATCH_SIZE]
+
+        # Unlike InstanceIds, an instance-id filter does not fail the whole call for unknown IDs
+        pages = paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}],
+                                   PaginationConfig={'PageSize': 1000})
 
+        for instance in pages.search('Reservations[].Instances[]'):
+            instance_name_cache[instance['InstanceId']] = get_instance_name(instance)
+
+        # Remember instances that no longer exist so they are not looked up again
+        for instance_id in batch:
+            instance_name_cache.setdefault(instance_id, '')
+
+    return {i: instance_name_cache[i] for i in instance_ids}
+
+# Returns the rows for a Dedicated Host (as returned by describe_hosts): one for each instance on
+# the host, or a single row if it has no instances. instance_names holds the Name of each instance.
+def get_host_rows(host, account_id, region_name, instance_names):
     instances = []
-    printed = False
-
-    for host in host_details['Hosts']:
-        host_id = ''
-        host_name = ''
-        host_reservation_id = ''
-        availability_zone = ''
-        total_instance_capacity = 0
-        available_instance_capacity = 0
-        instance_name = ''
-        instance_type = ''
-        available_vcpus = 0
-        instance_id = ''
-        total_instance_capacity = 0
-        available_instance_capacity = 0
-        instance_type = ''
-        available_vcpus = 0
-        
-        host_id = host["HostId"]
-        
-        if ('HostReservationId' in host):
-            host_reservation_id = host["HostReservationId"]
-        else:
-            host_reservation_id = "<none>"
-        
-        availability_zone = host["AvailabilityZone"]
-
-        if ('AvailableCapacity' in host):
-            availability = host["AvailableCapacity"]["AvailableInstanceCapacity"]
-            total_instance_capacity = availability[0]["TotalCapacity"]
-            available_instance_capacity = availability[0]["AvailableCapacity"]
-            instance_type = availability[0]["InstanceType"]
-            available_vcpus = host["AvailableCapacity"]["AvailableVCpus"]
-
-        if ('Tags' in host):
-            for tag in host['Tags']:
-                if (tag['Key'] == 'Name'):
-                    host_name = tag['Value']
-
-        if (('Instances' in host) and (len(host['Instances']) > 0)):
-            for instance in host['Instances']:
-                instance_id = instance["InstanceId"]
-
-                # Compute EC2 Instance ARN
-                ec2_arn = "arn:aws:ec2:{0}:{1}:{2}/{3}".format(
-                    region_name,
-                    account_id,
-                    "instance",
-                    instance_id)
-                
-                # Get EC2 Instance Name (from Tags)
-                instance_details = client.describe_instances(
-                    InstanceIds=[instance_id])
-
-                if (not printed):
-                    printed = True
-                    # print(instance_details['Reservations'][0]['Instances'][0]['Tags'])
-                    # with open("C:\\Users\\jeff.bramwell\\Downloads\\random.json", 'w') as outfile:
-                    #     json.dump(instance_details, outfile, cls=DateTimeEncoder)
-
-                if ('Tags' in instance_details['Reservations'][0]['Instances'][0]):
-                    for tag in instance_details['Reservations'][0]['Instances'][0]['Tags']:
-                        if (tag['Key'] == 'Name'):
-                            instance_name = tag['Value']
-
-                instances.append([
-                    account_id,
-                    host_id,
-                    host_name,
-                    host_reservation_id,
-                    availability_zone,
-                    total_instance_capacity,
-                    available_instance_capacity,
-                    instance_type,
-                    available_vcpus,
-                    instance_id,
-                    ec2_arn,
-                    instance_name,
-                    instance["InstanceType"]
-                ])
-        else:
-            instances.append([
+
+    host_id = ''
+    host_name = ''
+    host_reservation_id = ''
+    availability_zone = ''
+    total_instance_capacity = 0
+    available_instance_capacity = 0
+    instance_type = ''
+    available_vcpus = 0
+    instance_id = ''
+    total_instance_capacity = 0
+    available_instance_capacity = 0
+    instance_type = ''
+    available_vcpus = 0
+    capacity = ()
+    
+    host_id = host["HostId"]
+    
+    if ('HostReservationId' in host):
+        host_reservation_id = host["HostReservationId"]
+    else:
+        host_reservation_id = "<none>"
+    
+    availability_zone = host["AvailabilityZone"]
+
+    if ('AvailableCapacity' in host):
+        availability = host["AvailableCapacity"]["AvailableInstanceCapacity"]
+        total_instance_capacity = availability[0]["TotalCapacity"]
+        available_instance_capacity = availability[0]["AvailableCapacity"]
+        instance_type = availability[0]["InstanceType"]
+        available_vcpus = host["AvailableCapacity"]["AvailableVCpus"]
+
+        # Hosts that support several instance types have a capacity entry for each of them
+        capacity = tuple([(records.intern(entry["InstanceType"]), entry["TotalCapacity"], entry["AvailableCapacity"])
+                          for entry in availability])
+
+    if ('Tags' in host):
+        for tag in host['Tags']:
+            if (tag['Key'] == 'Name'):
+                host_name = tag['Value']
+
+    if (('Instances' in host) and (len(host['Instances']) > 0)):
+        for slot, instance in enumerate(host['Instances']):
+            instance_id = instance["InstanceId"]
+
+            # Get EC2 Instance Name (from Tags)
+            instance_name = instance_names[instance_id]
+
+            # The EC2 Instance ARN is formatted by the record when it is written
+            instances.append(records.HostRow(
                 account_id,
+                region_name,
                 host_id,
                 host_name,
                 host_reservation_id,
@@ -165,46 +222,194 @@ def get_dedicated_host_details(client, account_id, region_name):
                 available_instance_capacity,
                 instance_type,
                 available_vcpus,
-                '',
-                '',
-                '',
-                ''
-            ])
+                instance_id,
+                instance_name,
+                instance["InstanceType"],
+                capacity=capacity,
+                slot=slot))
+    else:
+        instances.append(records.HostRow(
+            account_id,
+            region_name,
+            host_id,
+            host_name,
+            host_reservation_id,
+            availability_zone,
+            total_instance_capacity,
+            available_instance_capacity,
+            instance_type,
+            available_vcpus,
+            capacity=capacity))
 
     return instances
 
-# load the environment variables
-dotenv.load_dotenv()
+# Returns a list of Dedicated Host details for each of the Dedicated Hosts in the specified account
+def get_dedicated_host_details(client, account_id, region_name, instance_name_cache=None):
+    if (instance_name_cache is None):
+        instance_name_cache = {}
 
-# Get command-line arguments
-args = setup_cli_args()
+    # Get a list of all Dedicated Hosts
+    paginator = client.get_paginator('describe_hosts')
+    hosts = list(paginator.paginate(PaginationConfig={'PageSize': HOST_PAGE_SIZE}).search('Hosts'))
 
-# Get the list of comma-delimited profiles
-profiles = args.profile.split(',')
+    # Look up the names of all instances on all hosts up front
+    instance_names = get_instance_names(
+        client, [i['InstanceId'] for host in hosts for i in host.get('Instances', [])], instance_name_cache)
 
-# Initialize the list that will hold each data row
-host_rows = []
+    instances = []
 
-display_startup_parameters(args)
+    for host in hosts:
+        instances.extend(get_host_rows(host, account_id, region_name, instance_names))
 
-# Iterate over all AWS profiles and concatenate the data
-for profile in [p.strip() for p in profiles]:
-    # Create AWS Account object using the profile name specified
-    aws_account = account.Account(profile, args.region)
+    return instances
 
-    display_account_info(aws_account)
+# Returns the Name tag of every instance on a Dedicated Host recorded by an AWS Config aggregator in
+# the accounts and regions (all of the aggregator's if None), keyed by instance ID. Instances
+# AWS Config has no record of have no name.
+def get_aggregated_instance_names(client, aggregator_name, account_ids=None, regions=None):
+    expression = aggregator.build_query('AWS::EC2::Instance', account_ids, regions,
+                                        [aggregator.condition('configuration.placement.tenancy', ['host'])],
+                                        ['resourceId', 'tags'])
+    instance_names = collections.defaultdict(str)
 
-    rows = list(get_dedicated_host_details(aws_account.session.client(
-        'ec2'), aws_account.account_id, aws_account.region_name))
+    for item in aggregator.select(client, aggregator_name, expression):
+        instance_names[item['resourceId']] = get_instance_name({'Tags': aggregator.to_api_shape(item.get('tags') or [])})
 
-    print("{0} rows processed.\r\n".format(len(rows)))
+    return instance_names
 
-    host_rows.extend(rows)
+# Returns a list of Dedicated Host details for each of the Dedicated Hosts recorded by an AWS Config
+# aggregator in the accounts and regions (all of the aggregator's if None), as
+# get_dedicated_host_details does for a single account and region
+def get_aggregated_host_details(client, aggregator_name, account_ids=None, regions=None):
+    hosts = list(aggregator.get_resources(client, aggregator_name, 'AWS::EC2::Host', account_ids, regions))
 
-field_names = ['Account ID', 'Host ID', 'Host Name', 'Host Reservation ID',
-               'Availability Zone', 'Total Instance Capacity', 
-               'Available Instance Capacity', 'Instance Type',
-               'Available vCPUs', 'EC2 Instance ID', 'EC2 ARN', 'EC2 Name',
-               'EC2 Instance Type']
+    # Look up the names of all instances on all hosts up front (in a single query)
+    instance_names = get_aggregated_instance_names(client, aggregator_name, account_ids, regions)
+
+    instances = []
+
+    for account_id, region_name, host in hosts:
+        instances.extend(get_host_rows(host, account_id, region_name, instance_names))
+
+    return instances
+
+# Returns the key of a host row in the inventory store: the Host ID and the slot of the row on the
+# host rather than its EC2 Instance ID, so an instance launched on an empty host (or replacing
+# another) is reported as a change to the host's row instead of a removed row and an added one
+def get_host_row_key(row):
+    return "{0}/{1}".format(row.host_id, row.slot)
+
+# Returns the rows for a single account and region (runs on a worker thread)
+def process_region(aws_account, region_name, instance_name_cache):
+    return list(tracing.DEFAULT_TRACER.timed_rows(
+        get_dedicated_host_details(aws_account.client('ec2', region_name),
+                                   aws_account.account_id, region_name, instance_name_cache),
+        'build rows'))
+
+# Returns the rows recorded by the aggregator (--aggregator) for every account and region, read with
+# the profile's account. If a store is given, the rows of each account and region are recorded in
+# it (in account/region order), and only the changes returned for a diff. If a summary is given,
+# every row is added to it.
+def process_aggregator(aws_account, args, store=None, host_summary=None):
+    account_ids = filters.split_list(args.accounts)
+    regions = filters.split_list(args.regions)
+    rows = list(tracing.DEFAULT_TRACER.timed_rows(
+        get_aggregated_host_details(aws_account.client('config'), args.aggregator, account_ids, regions),
+        'build rows'))
+
+    if (host_summary is not None):
+        for row in rows:
+            host_summary.add(row)
+
+    if (store is None):
+        print("{0} rows processed from aggregator {1}.".format(len(rows), args.aggregator))
+        return rows
+
+    host_rows = []
+
+    for (account_id, region_name), scope_rows in aggregator.group_rows(rows, store.scopes(), account_ids, regions):
+        print("{0} rows processed for account {1} in {2}.".format(len(scope_rows), account_id, region_name))
+
+        host_rows.extend(store.track(scope_rows, account_id, region_name, args.diff))
+
+    return host_rows
+
+# Runs the script with the given command-line arguments (defaults to sys.argv)
+def main(argv=None, prog=None):
+    # Load the environment variables and get command-line arguments
+    args = cli.parse_args(setup_cli_args, argv, prog)
+
+    # Start tracing, and record the AWS API responses (or answer the calls from those recorded before)
+    cli.start(args)
+
+    # Get the list of comma-delimited profiles (or the member accounts of the organization)
+    profiles = cli.get_profiles(args)
+
+    # Initialize the list that will hold each data row
+    host_rows = []
+
+    display_startup_parameters(args)
+
+    # With an aggregator, only its own account is used
+    if (args.aggregator is not None):
+        profiles = []
+        aws_account = account.Account(args.profile, args.region)
+
+        cli.display_account_info(aws_account, [aws_account.region_name])
+
+    # Resolve all AWS profiles (and the regions to query for each) in parallel
+    targets = cli.resolve_targets(profiles, args)
+
+    # Instance names are looked up once per run, however many hosts (or regions) reference them
+    instance_name_cache = {}
+
+    # Open the inventory store (rows are keyed by Host ID and slot)
+    store = None
+
+    if (args.store is not None):
+        store = inventory.InventoryStore(args.store, 'hosts', get_host_row_key)
+
+    host_summary = summary.HostSummary() if (args.summary) else None
+
+    if (args.aggregator is not None):
+        host_rows.extend(process_aggregator(aws_account, args, store, host_summary))
+
+    # Query every (account, region) pair in parallel and concatenate the data in profile/region order
+    for (aws_account, region_name), rows, error in fanout.run_all(targets,
+                                                                 lambda target: process_region(*target, instance_name_cache),
+                                                                 args.max_workers):
+        if (error is not None):
+            print("Failed to process account {0} in {1}: {2}\r\n".format(aws_account.account_id, region_name, error))
+            continue
+
+        print("{0} rows processed for account {1} in {2}.".format(len(rows), aws_account.account_id, region_name))
+
+        if (host_summary is not None):
+            for row in rows:
+                host_summary.add(row)
+
+        if (store is not None):
+            rows = list(store.track(rows, aws_account.account_id, region_name, args.diff))
+
+        host_rows.extend(rows)
+
+    print("")
+
+    field_names = FIELD_NAMES
+
+    if (args.diff):
+        field_names = ['Change'] + field_names
+
+    writers.write_file(args.output, host_rows, field_names, args.format)
+
+    if (store is not None):
+        store.close()
+
+    if (host_summary is not None):
+        host_summary.write(args.output, args.format)
+
+    # Display the API call counts and timings
+    cli.finish(args)
 
-write_csv_file(args.output, host_rows, field_names)
\ No newline at end of file
+if (__name__ == "__main__"):
+    main()
@@ -1,17 +1,49 @@
 from datetime import datetime
 import account
+import aggregator
 import argparse
-import dotenv
-import csv
+import cassette
+import cli
+import summary
+import fanout
+import filters
+import inventory
+import organization
+import records
+import tracing
+import writers
 
 # aws-list-ebs
 # Generates a comma-delimited (CSV) file listing all EBS volumes within the specified AWS account.
 
+DEFAULT_PAGE_SIZE = 500
+
+FIELD_NAMES = ['Account ID', 'Region', 'EC2 ARN', 'EC2 Instance ID', 'Volume ARN',
+               'Volume ID', 'Name', 'Device', 'Drive', 'Type', 'Size', 'IOPS', 'State', 'Tags']
+
+# describe_volumes filter name => AWS Config property it tests (for --aggregator)
+AGGREGATOR_FILTER_PROPERTIES = {
+    'volume-id': 'resourceId',
+    'volume-type': 'configuration.volumeType',
+    'status': 'configuration.state',
+    'availability-zone': 'availabilityZone'
+}
+
+# Validates the --page-size command-line value
+def page_size_arg(value):
+    page_size = int(value)
+
+    if (page_size < 5 or page_size > 500):
+        raise ValueError("page size must be between 5 and 500")
+
+    return page_size
+
 # Setup command-line arguments
 
 
-def setup_cli_args():
+def setup_cli_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Creates a comma-delimited (CSV) file listing all EBS volumes in the specified account.')
 
     parser.add_argument(
@@ -21,156 +53,329 @@ def setup_cli_args():
         "-r", "--region", help="Set a region if not already included in profile.", dest="region")
 
     parser.add_argument(
-        "-o", "--output", help="Output (CSV) filename.", dest="output", default="volumes.csv")
+        "-o", "--output", help="Output filename.", dest="output", default="volumes.csv")
 
-    return parser.parse_args()
+    regions = parser.add_mutually_exclusive_group()
 
+    regions.add_argument(
+        "-a", "--all-regions", help="Query every region enabled for each account.", dest="all_regions", action="store_true")
 
-# Displays startup paramters
-def display_startup_parameters(args):
-    print("*******************************************")
-    print("  Region:     {0}".format(args.region))
+    regions.add_argument(
+        "--regions", help="A comma-separated list of regions to query in each account.", dest="regions")
 
-    if (args.profile is None):
-        print("  Profile:    Using env configuration")
-    else:
-        print("  Profile:    {0}".format(args.profile))
+    parser.add_argument(
+        "-w", "--max-workers", help="The maximum number of profiles (and regions) to process in parallel.", dest="max_workers",
+        type=fanout.max_workers_arg, default=fanout.DEFAULT_MAX_WORKERS)
 
-    print("  Date:       {0}".format(datetime.now().strftime("%c")))
-    print("  Output:     {0}".format(args.output))
-    print("*******************************************")
+    organization.add_arguments(parser)
 
-# Display AWS Account settings
+    parser.add_argument(
+        "--page-size", help="The number of volumes to request per describe_volumes call (5-500).", dest="page_size",
+        type=page_size_arg, default=DEFAULT_PAGE_SIZE)
 
+    parser.add_argument(
+        "--volume-types", help="Only list volumes of these types (comma-separated, e.g. gp3,io2).", dest="volume_types")
 
-def display_account_info(account):
-    print("Processing...")
-    print("  Account ID: {0}".format(account.account_id))
-    print("  Region:     {0}".format(account.session.region_name))
+    parser.add_argument(
+        "--status", help="Only list volumes in these states (comma-separated: creating, available, in-use, deleting, deleted, error). Use 'available' for unattached volumes.", dest="status")
 
-    if (account.profile_name is None):
-        print("  Profile:    Using env configuration")
-    else:
-        print("  Profile:    {0}".format(account.profile_name))
+    parser.add_argument(
+        "--availability-zones", help="Only list volumes in these Availability Zones (comma-separated).", dest="availability_zones")
 
-# Creates a CSV file with EBS Volume information
+    parser.add_argument(
+        "--tag", help="Only list volumes with this tag (KEY, or KEY=VALUE). May be repeated; volumes must match every key, and any of the values given for a key.", dest="tags",
+        type=filters.tag_arg, action="append")
 
+    parser.add_argument(
+        "--ec2-filter", help="Any other describe_volumes filter (NAME=VALUE[,VALUE], e.g. encrypted=false). May be repeated.", dest="ec2_filters",
+        type=filters.ec2_filter_arg, action="append")
 
-def write_csv_file(filename, rows, field_names):
-    try:
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
+    parser.add_argument(
+        "--aggregator", help="Read the volumes of every account and region from this AWS Config aggregator (in the account and region of the profile) instead of querying each account.", dest="aggregator")
 
-            writer.writerow(field_names)
-            writer.writerows(rows)
-    except BaseException as e:
-        print('An error occurred when writing to ', filename)
-    else:
-        print("{0} rows successfully saved to {1}\r\n".format(len(rows), filename))
+    parser.add_argument(
+        "--accounts", help="With --aggregator, only list the volumes of these accounts (comma-separated account IDs).", dest="accounts")
 
-# Returns a list of EBS Volume details for each of the EBS Volumes in the specified account
+    parser.add_argument(
+        "--summary", help="Also write the number, size and IOPS of the volumes by account, type, Availability Zone and attachment state next to the output (e.g. volumes.summary.csv).", dest="summary", action="store_true")
 
+    parser.add_argument(
+        "--store", help="A SQLite file in which to keep the inventory between runs (default with --diff: {0}).".format(inventory.DEFAULT_STORE), dest="store")
+
+    parser.add_argument(
+        "--diff", help="Only output the rows that were added, removed or changed since the last run recorded in the store.", dest="diff", action="store_true")
 
-def get_ebs_volume_details(client, account_id, region_name):
-    # Get a list of all EBS Volumes
-    volume_details = client.describe_volumes()
-    volume_rows = []
+    parser.add_argument(
+        "--format", help="Output format (default: based on the output filename, otherwise csv).", dest="format",
+        choices=writers.FORMATS)
 
-    for volume in volume_details['Volumes']:
-        iops = ''
-        name = ''
-        drive = ''
-        instance_id = ''
-        device = ''
-        state = ''
-        tags = ''
+    parser.add_argument(
+        "--trace", help="Display per-operation API latencies and local timings when done, and optionally write them to a Chrome trace (JSON) file.",
+        dest="trace", nargs='?', const=True, metavar="FILE")
 
-        if (volume['VolumeType'] != 'standard'):
-            iops = volume['Iops']
+    cassette.add_arguments(parser)
 
-        if ('Tags' in volume):
-            for tag in volume['Tags']:
-                tags += tag['Key'] + ":" + tag['Value'] + ","
+    args = parser.parse_args(argv)
 
-                if (tag['Key'] == 'Name'):
-                    name = tag['Value']
+    organization.check_arguments(parser, args)
+    cassette.check_arguments(parser, args)
 
-                if (tag['Key'] == 'drive'):
-                    drive = tag['Value']
-        if (len(tags) > 0):
-            tags = tags.rstrip(',')
+    if (args.format is None):
+        args.format = writers.format_for(args.output)
 
-        for attachment in volume['Attachments']:
-            if ('InstanceId' in attachment):
-                instance_id = attachment['InstanceId']
+    if (args.format == 'parquet' and not writers.parquet_available()):
+        parser.error("Parquet output requires pyarrow (pip install pyarrow)")
 
-            if ('Device' in attachment):
-                device = attachment['Device']
+    # Build the filters that describe_volumes applies server-side
+    named_filters = [('volume-type', filters.split_list(args.volume_types)),
+                     ('status', filters.split_list(args.status)),
+                     ('availability-zone', filters.split_list(args.availability_zones))]
 
-            if ('State' in attachment):
-                state = attachment['State']
+    args.filters = filters.ec2_filters([f for f in named_filters if len(f[1]) > 0] + (args.ec2_filters or []),
+                                       args.tags)
 
-        ec2_arn = "arn:aws:ec2:{0}:{1}:{2}/{3}".format(
-            region_name,
-            account_id,
-            "instance",
-            instance_id
-        )
+    # An aggregator is queried from a single account, and the filters become query conditions
+    if (args.aggregator is not None):
+        if (args.profile is not None and len(args.profile.split(',')) > 1):
+            parser.error("--aggregator takes a single profile (the account the aggregator is in)")
 
-        volume_arn = "arn:aws:ec2:{0}:{1}:{2}/{3}".format(
-            region_name,
-            account_id,
-            "volume",
-            volume['VolumeId']
-        )
+        if (args.org_role is not None):
+            parser.error("--aggregator cannot be used with --org-role")
 
-        volume_rows.append([
-            account_id,
-            ec2_arn,
-            instance_id,
-            volume_arn,
-            volume['VolumeId'],
-            name,
-            device,
-            drive,
-            volume['VolumeType'],
-            volume['Size'],
-            iops,
-            state,
-            tags])
+        try:
+            aggregator.ec2_filter_conditions(args.filters, AGGREGATOR_FILTER_PROPERTIES)
+        except ValueError as e:
+            parser.error(e)
 
-    return volume_rows
+    # A diff needs a previous snapshot to compare against
+    if (args.diff and args.store is None):
+        args.store = inventory.DEFAULT_STORE
 
+    return args
 
-# load the environment variables
-dotenv.load_dotenv()
 
-# Get command-line arguments
-args = setup_cli_args()
+# Displays startup parameters
+def display_startup_parameters(args):
+    print("*******************************************")
+    cli.display_target_parameters(args)
 
-# Get the list of comma-delimited profiles
-profiles = args.profile.split(',')
+    if (args.aggregator is not None):
+        print("  Aggregator: {0}".format(args.aggregator))
+        print("  Accounts:   {0}".format(args.accounts or "All aggregated accounts"))
+    else:
+        print("  Workers:    {0}".format(args.max_workers))
 
-# Initialize the list that will hold each data row
-volume_rows = []
+    print("  Date:       {0}".format(datetime.now().strftime("%c")))
+    print("  Output:     {0}".format(args.output))
 
-display_startup_parameters(args)
+    for volume_filter in args.filters:
+        print("  Filter:     {0} = {1}".format(volume_filter['Name'], ", ".join(volume_filter['Values'])))
 
-# Iterate over all AWS profiles and concatenate the data
-for profile in [p.strip() for p in profiles]:
-    # Create AWS Account object using the profile name specified
-    aws_account = account.Account(profile, args.region)
+    if (args.store is not None):
+        print("  Store:      {0}{1}".format(args.store, " (changes only)" if args.diff else ""))
 
-    display_account_info(aws_account)
+    print("*******************************************")
 
-    rows = list(get_ebs_volume_details(aws_account.session.client(
-        'ec2'), aws_account.account_id, aws_account.region_name))
+# Returns the row for an EBS Volume (as returned by describe_volumes)
+def get_volume_row(volume, account_id, region_name):
+    iops = ''
+    name = ''
+    drive = ''
+    instance_id = ''
+    device = ''
+    state = ''
+    tags = volume.get('Tags', [])
+
+    if (volume['VolumeType'] != 'standard'):
+        iops = volume['Iops']
+
+    for tag in tags:
+        if (tag['Key'] == 'Name'):
+            name = tag['Value']
+
+        if (tag['Key'] == 'drive'):
+            drive = tag['Value']
+
+    for attachment in volume['Attachments']:
+        if ('InstanceId' in attachment):
+            instance_id = attachment['InstanceId']
+
+        if ('Device' in attachment):
+            device = attachment['Device']
+
+        if ('State' in attachment):
+            state = attachment['State']
+
+    # The EC2 and volume ARNs are formatted by the record when they are written
+    return records.VolumeRow(
+        account_id,
+        region_name,
+        instance_id,
+        volume['VolumeId'],
+        name,
+        device,
+        drive,
+        volume['VolumeType'],
+        volume['Size'],
+        iops,
+        state,
+        tags,
+        volume.get('AvailabilityZone', ''))
+
+# Returns the describe_volumes parameters for the page size and filters (describe_volumes Filters)
+def get_volume_parameters(page_size=DEFAULT_PAGE_SIZE, volume_filters=None):
+    parameters = {'PaginationConfig': {'PageSize': page_size}}
+
+    if (volume_filters):
+        parameters['Filters'] = volume_filters
+
+    return parameters
+
+# Yields the EBS Volume details for each of the EBS Volumes in the specified account,
+# one page of volumes at a time. If filters are given (describe_volumes Filters), only the
+# matching volumes are returned by EC2.
+
+
+def get_ebs_volume_details(client, account_id, region_name, page_size=DEFAULT_PAGE_SIZE, volume_filters=None):
+    # Page through all (matching) EBS Volumes
+    paginator = client.get_paginator('describe_volumes')
+
+    for volume in paginator.paginate(**get_volume_parameters(page_size, volume_filters)).search('Volumes'):
+        yield get_volume_row(volume, account_id, region_name)
+
+# Yields the EBS Volume details for each of the EBS Volumes recorded by an AWS Config aggregator in
+# the accounts and regions (all of the aggregator's if None), as get_ebs_volume_details does for a
+# single account and region. If filters are given (describe_volumes Filters), only the matching
+# volumes are returned by AWS Config.
+def get_aggregated_volume_details(client, aggregator_name, account_ids=None, regions=None, volume_filters=None,
+                                  page_size=aggregator.DEFAULT_PAGE_SIZE):
+    conditions = aggregator.ec2_filter_conditions(volume_filters, AGGREGATOR_FILTER_PROPERTIES)
+
+    for account_id, region_name, volume in aggregator.get_resources(client, aggregator_name, 'AWS::EC2::Volume',
+                                                                    account_ids, regions, conditions, page_size):
+        yield get_volume_row(volume, account_id, region_name)
+
+# Yields the rows for a single account and region (runs on a worker thread)
+def process_region(aws_account, region_name, page_size, volume_filters):
+    return tracing.DEFAULT_TRACER.timed_rows(get_ebs_volume_details(aws_account.client('ec2', region_name),
+                                                                    aws_account.account_id, region_name, page_size,
+                                                                    volume_filters),
+                                             'build rows')
+
+# Yields the rows for every (account, region) pair in order, while the pairs are queried in parallel.
+# If a store is given, the rows are recorded in it (and only the changes yielded for a diff). If a
+# summary is given, every row is added to it (including those a diff leaves out).
+def stream_rows(targets, args, store=None, volume_summary=None):
+    for (aws_account, region_name), rows in fanout.stream_all(targets,
+                                                             lambda target: process_region(*target, args.page_size, args.filters),
+                                                             args.max_workers):
+        row_count = 0
+
+        if (volume_summary is not None):
+            rows = volume_summary.tap(rows)
+
+        if (store is not None):
+            rows = store.track(rows, aws_account.account_id, region_name, args.diff)
+
+        try:
+            for row in rows:
+                row_count += 1
+                yield row
+        except Exception as e:
+            print("Failed to process account {0} in {1} after {2} rows: {3}\r\n".format(
+                aws_account.account_id, region_name, row_count, e))
+            continue
+
+        print("{0} rows processed for account {1} in {2}.".format(row_count, aws_account.account_id, region_name))
+
+# Yields the rows recorded by the aggregator (--aggregator) for every account and region, read with
+# the profile's account. If a store is given, the rows are grouped by account and region (in
+# account/region order) so that each can be recorded in it (and only the changes yielded for a diff).
+# If a summary is given, every row is added to it.
+def stream_aggregated_rows(aws_account, args, store=None, volume_summary=None):
+    account_ids = filters.split_list(args.accounts)
+    regions = filters.split_list(args.regions)
+    rows = tracing.DEFAULT_TRACER.timed_rows(get_aggregated_volume_details(aws_account.client('config'), args.aggregator,
+                                                                           account_ids, regions, args.filters),
+                                             'build rows')
+
+    if (volume_summary is not None):
+        rows = volume_summary.tap(rows)
+
+    if (store is None):
+        row_count = 0
+
+        for row in rows:
+            row_count += 1
+            yield row
+
+        print("{0} rows processed from aggregator {1}.".format(row_count, args.aggregator))
+        return
+
+    for (account_id, region_name), scope_rows in aggregator.group_rows(rows, store.scopes(), account_ids, regions):
+        row_count = 0
+
+        for row in store.track(scope_rows, account_id, region_name, args.diff):
+            row_count += 1
+            yield row
 
-    print("{0} rows processed.\r\n".format(len(rows)))
+        print("{0} rows processed for account {1} in {2}.".format(row_count, account_id, region_name))
 
-    volume_rows.extend(rows)
+# Runs the script with the given command-line arguments (defaults to sys.argv)
+def main(argv=None, prog=None):
+    # Load the environment variables and get command-line arguments
+    args = cli.parse_args(setup_cli_args, argv, prog)
 
-field_names = ['Account ID', 'EC2 ARN', 'EC2 Instance ID', 'Volume ARN',
-               'Volume ID', 'Name', 'Device', 'Drive', 'Type', 'Size', 'IOPS', 'State', 'Tags']
+    # Start tracing, and record the AWS API responses (or answer the calls from those recorded before)
+    cli.start(args)
+
+    # Get the list of comma-delimited profiles (or the member accounts of the organization)
+    profiles = cli.get_profiles(args)
+
+    display_startup_parameters(args)
+
+    # With an aggregator, only its own account is used
+    if (args.aggregator is not None):
+        profiles = []
+        aws_account = account.Account(args.profile, args.region)
+
+        cli.display_account_info(aws_account, [aws_account.region_name])
+
+    # Resolve all AWS profiles (and the regions to query for each) in parallel
+    targets = cli.resolve_targets(profiles, args)
+
+    field_names = FIELD_NAMES
+
+    # Open the inventory store (volumes are keyed by Volume ID). A filtered run only sees some of
+    # the volumes, so it is kept apart from unfiltered (and differently filtered) snapshots.
+    store = None
+
+    if (args.store is not None):
+        kind = 'ebs' if (len(args.filters) == 0) else 'ebs ' + filters.describe(args.filters)
+        store = inventory.InventoryStore(args.store, kind, lambda row: row[5])
+
+    if (args.diff):
+        field_names = ['Change'] + field_names
+
+    # Query every (account, region) pair in parallel (or the aggregator), writing the rows in profile/region order as they arrive
+    volume_summary = summary.VolumeSummary() if (args.summary) else None
+
+    if (args.aggregator is not None):
+        rows = stream_aggregated_rows(aws_account, args, store, volume_summary)
+    else:
+        rows = stream_rows(targets, args, store, volume_summary)
+
+    writers.write_file(args.output, rows, field_names, args.format)
+
+    if (store is not None):
+        store.close()
+
+    # Write the totals gathered while the rows were written
+    if (volume_summary is not None):
+        volume_summary.write(args.output, args.format)
+
+    # Display the API call counts and timings
+    cli.finish(args)
 
-write_csv_file(args.output, volume_rows, field_names)
+if (__name__ == "__main__"):
+    main()
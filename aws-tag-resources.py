@@ -1,29 +1,75 @@
 from datetime import datetime
-import account
+import aiofanout
 import argparse
-import dotenv
-import csv
+import cassette
+import cli
+import arns
+import asyncio
+import botocore.exceptions
+import collections
+import concurrent.futures
+import contextlib
+import filters
+import journal
+import re
+import threading
+import time
+import records
+import fanout
+import organization
+import tracing
+import writers
 
 # aws-tag-resources
 # Tags all (taggable) resources within an AWS account based on input filters
 
+# Maximum number of resource ARNs accepted by a single tag_resources call
+TAG_RESOURCES_BATCH_SIZE = 20
+
+# Number of pages listed ahead, and of tag_resources calls in progress at once, with --pipeline
+DEFAULT_PREFETCH_PAGES = 4
+DEFAULT_TAG_WORKERS = 4
+
+# Validates the --prefetch and --tag-workers command-line values
+def pipeline_arg(value):
+    number = int(value)
+
+    if (number < 1):
+        raise ValueError("must be at least 1")
+
+    return number
+
 # Setup command-line arguments
 
-def setup_cli_args():
+def setup_cli_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Tags all (taggable) resources based on the collection of tag keys and values passed in.')
 
     parser.add_argument(
         "-t", "--tags", dest="tags", help="A comma-separated list of key/value pairs for tags to be updated. The key/value list must be enclosed in quotes.", default="")
 
     parser.add_argument(
-        "-s", "--services", dest="services", help="A comma-separated list of AWS Services for which the Tags should be updated.", default="all")
+        "-s", "--services", dest="services", help="A comma-separated list of AWS Services (e.g. s3) or resource types (e.g. ec2:volume) for which the Tags should be updated.", default="all")
+
+    parser.add_argument(
+        "-f", "--filter", dest="filter", help="Only tag resources whose ARN matches this pattern: text that must appear within the ARN, a glob (e.g. '*:volume/*') or a regular expression prefixed with 're:'. May be repeated.", action="append")
+
+    parser.add_argument(
+        "--exclude", help="Do not tag resources whose ARN matches this pattern (same forms as --filter). May be repeated.", dest="exclude", action="append")
+
+    parser.add_argument(
+        "--filter-file", help="A file of --filter patterns, one per line. Lines starting with '!' are --exclude patterns.", dest="filter_file")
 
     parser.add_argument(
-        "-f", "--filter", dest="filter", help="The text specified within 'filter' must appear within the resource ARN to be tagged.", default="")
+        "--tag-filter", help="Only tag resources that already have this tag (KEY, or KEY=VALUE). May be repeated; resources must match every key, and any of the values given for a key.", dest="tag_filters",
+        type=filters.tag_arg, action="append")
 
     parser.add_argument(
         "-p", "--profile", dest="profile", help="A comma-separated list of profiles (from credentials file) to be used. If specifying more than one profile, they must be enclosed in quotes.", default="")
+
+    organization.add_arguments(parser)
+
     parser.add_argument(
         "-x", "--eXecute", help="By default, this command runs in 'what if' mode. Set this argument to 'yes' to update the tag values.", dest="execute", default="no")
 
@@ -31,11 +77,88 @@ def setup_cli_args():
         "-r", "--region", help="Set a region if not already included in profile.", dest="region")
 
     parser.add_argument(
-        "-o", "--output", help="Output (CSV) filename.", dest="output", default="resources.csv")
+        "-o", "--output", help="Output filename.", dest="output", default="resources.csv")
+
+    parser.add_argument(
+        "-w", "--max-workers", help="The maximum number of services (or resource types) to list in parallel, each with its own chain of pages.", dest="max_workers",
+        type=fanout.max_workers_arg, default=fanout.DEFAULT_MAX_WORKERS)
+
+    parser.add_argument(
+        "--pipeline", help="List the next pages of resources while the resources already listed are being tagged.", dest="pipeline", action="store_true")
+
+    parser.add_argument(
+        "--prefetch", help="With --pipeline, the maximum number of pages listed ahead of the tagging (default: {0}).".format(DEFAULT_PREFETCH_PAGES), dest="prefetch",
+        type=pipeline_arg, default=DEFAULT_PREFETCH_PAGES)
+
+    parser.add_argument(
+        "--tag-workers", help="With --pipeline, the maximum number of tag_resources calls in progress at once (default: {0}).".format(DEFAULT_TAG_WORKERS), dest="tag_workers",
+        type=pipeline_arg, default=DEFAULT_TAG_WORKERS)
+
+    parser.add_argument(
+        "--journal", help="File in which to record the progress of the run (default: the output filename followed by .journal).", dest="journal")
+
+    parser.add_argument(
+        "--resume", help="Resume the run recorded in the journal, skipping the resources it has already done (and tagging those that failed again).", dest="resume", action="store_true")
+
+    parser.add_argument(
+        "--async", help="List and tag the resources of every profile at once, from a single asyncio event loop (requires aiobotocore). Cannot be used with --resume.", dest="use_async", action="store_true")
+
+    parser.add_argument(
+        "--max-in-flight", help="With --async, the maximum number of API calls in progress at once (default: {0}).".format(aiofanout.DEFAULT_MAX_IN_FLIGHT), dest="max_in_flight",
+        type=aiofanout.max_in_flight_arg, default=aiofanout.DEFAULT_MAX_IN_FLIGHT)
+
+    parser.add_argument(
+        "--max-in-flight-per-account", help="With --async, the maximum number of API calls in progress at once for each account (default: {0}).".format(aiofanout.DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT), dest="max_in_flight_per_account",
+        type=aiofanout.max_in_flight_arg, default=aiofanout.DEFAULT_MAX_IN_FLIGHT_PER_ACCOUNT)
+
+    parser.add_argument(
+        "--format", help="Output format (default: based on the output filename, otherwise csv).", dest="format",
+        choices=writers.FORMATS)
+
+    parser.add_argument(
+        "--trace", help="Display per-operation API latencies and local timings when done, and optionally write them to a Chrome trace (JSON) file.",
+        dest="trace", nargs='?', const=True, metavar="FILE")
+
+    cassette.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    organization.check_arguments(parser, args)
+    cassette.check_arguments(parser, args)
+
+    if (args.format is None):
+        args.format = writers.format_for(args.output)
 
-    return parser.parse_args()
+    if (args.format == 'parquet' and not writers.parquet_available()):
+        parser.error("Parquet output requires pyarrow (pip install pyarrow)")
 
-# Displays startup paramters
+    if (args.use_async and not aiofanout.available()):
+        parser.error("--async requires aiobotocore (pip install aiobotocore)")
+
+    # Replayed runs never change anything
+    if (args.replay is not None and args.execute == "yes"):
+        parser.error("--replay can only be used in 'what if' mode")
+
+    # The asyncio mode already lists and tags at the same time
+    if (args.use_async and args.pipeline):
+        parser.error("--pipeline cannot be used with --async")
+
+    # The asyncio mode tags pages out of order, so it cannot keep a journal
+    if (args.use_async and args.resume):
+        parser.error("--resume cannot be used with --async")
+
+    # Compile all of the ARN patterns into a single matcher
+    try:
+        args.arn_matcher = arns.ArnMatcher.from_args(args.filter, args.exclude, args.filter_file)
+    except (OSError, re.error) as e:
+        parser.error("Invalid ARN filter: {0}".format(e))
+
+    if (args.journal is None):
+        args.journal = args.output + ".journal"
+
+    return args
+
+# Displays startup parameters
 def display_startup_parameters(args):
     print("*******************************************")
     print("  Region:       {0}".format(args.region))
@@ -46,135 +169,641 @@ def display_startup_parameters(args):
         print("  Profile:      {0}".format(args.profile))
 
     print("  AWS Services: {0}".format(args.services))
-    print("  Filter:       {0}".format(args.filter))
+    print("  Filter:       {0}".format(", ".join(args.filter or []) + (" (and {0})".format(args.filter_file) if args.filter_file else "")))
+
+    if (args.exclude):
+        print("  Exclude:      {0}".format(", ".join(args.exclude)))
+
+    for tag_filter in filters.tag_filters(args.tag_filters):
+        print("  Tag Filter:   {0} = {1}".format(tag_filter['Key'], ", ".join(tag_filter.get('Values', ['(any)']))))
+
     print("  Tags:         {0}".format(args.tags))
     print("  Execute:      {0}".format(args.execute))
     print("  Date:         {0}".format(datetime.now().strftime("%c")))
     print("  Output:       {0}".format(args.output))
+    if (args.use_async):
+        print("  In flight:    {0} ({1} per account)".format(args.max_in_flight, args.max_in_flight_per_account))
+    else:
+        print("  Workers:      {0}".format(args.max_workers))
+
+        if (args.pipeline):
+            print("  Pipeline:     {0} pages ahead, {1} tagging workers".format(args.prefetch, args.tag_workers))
+
+        print("  Journal:      {0}{1}".format(args.journal, " (resuming)" if args.resume else ""))
     print("*******************************************")
 
-# Display AWS Account settings
-def display_account_info(account):
-    print("Processing...")
-    print("  Account ID: {0}".format(account.account_id))
-    print("  Region:     {0}".format(account.session.region_name))
+# Parses a list of "key=value" strings into a dictionary of tags (None if any tag is invalid)
+def parse_tags(new_tags):
+    tags = {}
 
-    if (account.profile_name is None):
-        print("  Profile:    Using env configuration")
-    else:
-        print("  Profile:    {0}".format(account.profile_name))
+    for tag in new_tags:
+        tag_parts = tag.split('=')
 
-# Creates a CSV file with EBS Volume information
+        if (len(tag_parts) != 2): # Check for valid tag format
+            print("  Invalid tag: {0}".format(tag))
+            return None
 
+        tags[tag_parts[0]] = tag_parts[1]
 
-# Just a comment, nothing else! 🤪
+    return tags
 
-def write_csv_file(filename, rows, field_names):
-    try:
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
+# Returns the row for a resource (as returned by get_resources) along with the new tags it is
+# missing (or has a different value for)
+def get_resource_row(resource, new_tags):
+    resource_arn = resource['ResourceARN']
+    current_tags = {tag['Key']: tag['Value'] for tag in resource['Tags']}
+    tag_changes = {key: value for key, value in new_tags.items() if current_tags.get(key) != value}
 
-            writer.writerow(field_names)
-            writer.writerows(rows)
-    except BaseException as e:
-        print('An error occurred when writing to ', filename)
-    else:
-        print("{0} rows successfully saved to {1}\r\n".format(len(rows), filename))
+    # The service, region, resource type and ID are taken from the ARN when the row is written
+    row = records.TagResultRow(arns.parse(resource_arn).account_id, resource_arn, {**current_tags, **new_tags})
 
-# Updates the tags for each resource
-def update_resource_tags(client, new_tags, services, arn_filter, execute):
-    resource_rows = []
-    pagination_token = "<first try!>"
+    if (len(tag_changes) == 0):
+        row.set_status(0, "Already Tagged")
+
+    return row, tag_changes
+
+# Applies the same tag changes to every resource in the batch with a single tag_resources call,
+# recording the outcome for each resource in its row
+def tag_resource_batch(client, tags, batch):
+    for resource_arn, row in batch:
+        print("  Tagging {0} {1} {2}".format(row.resource_type, row.resource_id, resource_arn))
 
-    # Get resources that can be tagged
-    resources = client.get_resources(ResourceTypeFilters = services)
+    response = client.tag_resources(ResourceARNList=[resource_arn for resource_arn, row in batch],
+                                    Tags=tags)
+
+    record_batch_outcomes(batch, response)
+
+# Records the outcome of a tag_resources call for each resource in the batch in its row
+def record_batch_outcomes(batch, response):
+    for resource_arn, row in batch:
+        failure = response['FailedResourcesMap'].get(resource_arn)
+
+        # If the tag update failed, display the error message
+        if (failure is not None):
+            print("  Failed to tag {0} {1} {2}".format(row.resource_type, row.resource_id, resource_arn))
+            print("     {0} - {1}\r\n".format(failure.get("ErrorCode"), failure.get("ErrorMessage")))
+
+            row.set_status(failure.get("StatusCode"), failure.get("ErrorCode"), failure.get("ErrorMessage"))
+        else:
+            row.set_status(200, "Ok")
+
+# Records the error of a tag_resources call that failed as a whole for each resource in the batch in
+# its row
+def record_batch_error(batch, error):
+    if (isinstance(error, botocore.exceptions.ClientError)):
+        status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        error_code = error.response.get('Error', {}).get('Code', type(error).__name__)
+    else:
+        status_code = 0
+        error_code = type(error).__name__
+
+    for resource_arn, row in batch:
+        print("  Failed to tag {0} {1} {2}".format(row.resource_type, row.resource_id, resource_arn))
+        print("     {0} - {1}\r\n".format(error_code, error))
+
+        row.set_status(status_code, error_code, str(error))
+
+# Returns the get_resources parameters for the services (or resource types) and tag filters
+def get_resources_parameters(services, tag_filters=None):
+    parameters = {}
+
+    if (services != ['all']):
+        parameters['ResourceTypeFilters'] = services
+
+    if (tag_filters):
+        parameters['TagFilters'] = tag_filters
+
+    return parameters
+
+# Settings and per-stage counters of a pipelined run (--pipeline) of update_resource_tags. Pages
+# are listed ahead (up to prefetch_pages of them) by the listing workers while the resources
+# already listed are tagged by up to tag_workers tagging workers. The counters show the time each
+# stage spent in its API calls and the time the run waited for each stage, which tells which of
+# the two limits the run.
+class Pipeline:
+    def __init__(self, prefetch_pages=DEFAULT_PREFETCH_PAGES, tag_workers=DEFAULT_TAG_WORKERS):
+        self.prefetch_pages = prefetch_pages
+        self.tag_workers = tag_workers
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+        # Pages and resources listed, and seconds spent in get_resources calls
+        self.pages = 0
+        self.listed = 0
+        self.list_time = 0.0
+
+        # Batches and resources tagged, and seconds spent in tag_resources calls
+        self.batches = 0
+        self.tagged = 0
+        self.tag_time = 0.0
+
+        # Seconds the run waited for the next page, and for a free tagging worker
+        self.page_wait = 0.0
+        self.tag_wait = 0.0
+
+    # Yields the pages (as listed by get_resource_pages), counting them and the time taken to list
+    # them (runs on a listing worker)
+    def listed_pages(self, pages):
+        pages = iter(pages)
+
+        while (True):
+            started = time.perf_counter()
+            page = next(pages, None)
+
+            with self._lock:
+                self.list_time += time.perf_counter() - started
+
+                if (page is not None):
+                    self.pages += 1
+                    self.listed += len(page[1])
+
+            if (page is None):
+                return
+
+            yield page
+
+    # Yields the pages as they arrive, counting the time spent waiting for them
+    def waited_pages(self, pages):
+        pages = iter(pages)
+
+        while (True):
+            started = time.perf_counter()
+            page = next(pages, None)
+            self.page_wait += time.perf_counter() - started
+
+            if (page is None):
+                return
+
+            yield page
+
+    # Tags the batch with tag_resource_batch, counting it and the time taken (runs on a tagging worker)
+    def tag_batch(self, client, tags, batch):
+        started = time.perf_counter()
+
+        try:
+            tag_resource_batch(client, tags, batch)
+        finally:
+            with self._lock:
+                self.tag_time += time.perf_counter() - started
+                self.batches += 1
+                self.tagged += len(batch)
+
+    # Counts the time spent waiting for a free tagging worker
+    @contextlib.contextmanager
+    def waiting_for_tagging(self):
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.tag_wait += time.perf_counter() - started
+
+    # Displays the counters of each stage, and which of them limited the run
+    def display(self):
+        elapsed = max(time.perf_counter() - self._started, 0.001)
+
+        print("  Pipeline:   listed {0} resources in {1} pages ({2:.1f}/s, {3:.3f} s in get_resources)".format(
+            self.listed, self.pages, self.listed / elapsed, self.list_time))
+        print("              tagged {0} resources in {1} batches ({2:.1f}/s, {3:.3f} s in tag_resources)".format(
+            self.tagged, self.batches, self.tagged / elapsed, self.tag_time))
+        print("              waited {0:.3f} s for pages and {1:.3f} s for tagging workers ({2} is the bottleneck)".format(
+            self.page_wait, self.tag_wait, "listing" if (self.page_wait >= self.tag_wait) else "tagging"))
+
+# Returns the shards the resources of the services (or resource types) are listed in: one per
+# service or resource type, each listed by its own chain of get_resources pages, or [None] (a
+# single chain for all of them) when every service is listed or there is only one. Resource types
+# already covered by their service (e.g. ec2:volume with ec2) do not get a shard of their own.
+def get_shards(services):
+    if (services == ['all']):
+        return [None]
+
+    shards = [service for service in dict.fromkeys(services)
+              if (service.split(':')[0] == service or service.split(':')[0] not in services)]
+
+    return shards if (len(shards) > 1) else [None]
+
+# Yields a (pagination token, resources, next pagination token) tuple for each page of resources of
+# the shard (all of the services if None), starting from the page with the pagination token (from
+# the first page if None; there are no more pages if "")
+def get_resource_pages(client, services, shard, tag_filters=None, pagination_token=None):
+    parameters = get_resources_parameters(services if (shard is None) else [shard], tag_filters)
+
+    while (pagination_token != ""):
+        if (pagination_token is None):
+            resources = client.get_resources(**parameters)
+        else:
+            resources = client.get_resources(PaginationToken=pagination_token, **parameters)
+
+        yield pagination_token, resources['ResourceTagMappingList'], resources['PaginationToken']
 
-    # Iterate through resources and tag them
-    while(pagination_token != ""):
         pagination_token = resources['PaginationToken']
-        
-        for resource in resources['ResourceTagMappingList']:
-            # Get the resource ARN          
-            resource_arn = resource['ResourceARN']
-            
-            # Filter the resource ARNs based on the filter text (case sensitive)
-            if (len(arn_filter) != 0 and arn_filter not in resource_arn):
-                continue # Go to next resource
-            
-            # Split the ARN into its constituent parts
-            arn_parts = resource_arn.split(':')
-            service = arn_parts[2]
-            region = arn_parts[3]
-            account = arn_parts[4]
-            resource_type = arn_parts[5]
-            resource_id = arn_parts[6] if len(arn_parts) > 6 else ""
-
-            # Get the current set of tags for the resource being processed
-            resource_tags = resource['Tags']
-
-            # Remove duplicate tags (if any exist) and add the new tags to the list
-            for tag in new_tags:
-                tag_parts = tag.split('=')
-
-                if (len(tag_parts) == 2): # Check for valid tag format
-                    new_tag = {'Key': tag_parts[0], 'Value': tag_parts[1]}
-
-                    # Remove dictionaries where 'Key' matches
-                    resource_tags = [tag for tag in resource_tags if tag['Key'] != new_tag['Key']]
-
-                    # Add the de-duped tag
-                    resource_tags.append(new_tag)
-                else:
-                    print("  Invalid tag: {0}".format(tag))
-                    return []
-                
-            # Update the resource with the new tags if execute is set to "yes"
-            if (execute == "yes"):
-                print("  Tagging {0} {1} {2}".format(resource_type, resource_id, resource_arn))
-                
-                response = client.tag_resources(ResourceARNList=[resource_arn], 
-                                                Tags={item['Key']: item['Value'] for item in resource_tags})
-
-                # If the tag update failed, display the error message
-                if (response['FailedResourcesMap'] != {}):
-                    print("  Failed to tag {0} {1} {2}".format(resource_type, resource_id, resource_arn))
-                    print("     {0} - {1}\r\n".format(response['FailedResourcesMap'][resource_arn]["ErrorCode"],
-                                                      response['FailedResourcesMap'][resource_arn]["ErrorMessage"]))
-
-                    # Add the resource to the return list
-                    resource_rows.append([
-                        response['FailedResourcesMap'][resource_arn]["StatusCode"],
-                        response['FailedResourcesMap'][resource_arn]["ErrorCode"],
-                        response['FailedResourcesMap'][resource_arn]["ErrorMessage"],
-                        account, resource_arn, resource_id, service, region, resource_type,
-                        resource_tags])
+
+# Updates the tags for each resource. Only the tags that are missing or different are applied,
+# resources that already have all of the tags are skipped, and resources needing the same
+# changes are tagged together in batches of up to TAG_RESOURCES_BATCH_SIZE. The services (or
+# resource types) and tag filters are applied by the tagging API, so only the matching resources
+# are downloaded; the ARN filter (an arns.ArnMatcher, or text that must appear within the ARN)
+# is then checked locally. When several services (or resource types) are given, each is listed by
+# its own chain of pages (a shard, see get_shards), and the shards are listed in parallel (up to
+# max_workers at a time), so listing takes as long as the largest service rather than all of them.
+# The rows are returned in shard order.
+# If a pipeline (Pipeline) is given, the pages are always listed on listing workers, up to
+# pipeline.prefetch_pages ahead, and the batches are tagged by up to pipeline.tag_workers tagging
+# workers, so that listing and tagging overlap rather than taking turns. Both stages hold back
+# when they are that far ahead, so memory use stays bounded.
+# If a journal (journal.AccountJournal) is given, the outcome for each resource and the point
+# from which the resources still to be done can be listed (in each shard) are recorded as the run
+# progresses, and the resources the journal already has an outcome for are skipped (their rows are
+# reused), except for those whose tagging failed, which are tagged again first.
+def update_resource_tags(client, new_tags, services, arn_filter, execute, tag_filters=None, journal=None,
+                         max_workers=fanout.DEFAULT_MAX_WORKERS, pipeline=None):
+    completed = {} if (journal is None) else journal.completed
+    failed = {} if (journal is None) else dict(journal.failed)
+    resumed_rows = list(completed.values())
+    shards = get_shards(services)
+
+    new_tags = parse_tags(new_tags)
+
+    if (new_tags is None):
+        return []
+
+    if (isinstance(arn_filter, str)):
+        arn_filter = arns.ArnMatcher([arn_filter])
+
+    # The pagination token to start each shard from (an empty token means there are no more pages)
+    start_tokens = {shard: None if (journal is None) else journal.shard_checkpoint_token(shard) for shard in shards}
+
+    # Only the resources whose tagging failed are left to do if every page was done
+    listing_done = journal is not None and (journal.finished or all([token == "" for token in start_tokens.values()]))
+
+    if (listing_done and len(failed) == 0):
+        return resumed_rows
+
+    # The resources whose tagging failed before the run was resumed are tagged with all of the new
+    # tags (their current tags are not known)
+    retried_rows = [records.TagResultRow(row[3], row[4], row[9]) for row in failed.values()]
+
+    # Rows of the resources listed in each shard
+    shard_rows = {shard: [] for shard in shards}
+
+    # Resources waiting to be tagged, grouped by the tag changes they need
+    pending = {}
+
+    # The pagination token of each page listed in each shard (None for the first page) and, for each
+    # resource waiting to be tagged, its shard and the page it was listed on
+    page_tokens = {shard: [] for shard in shards}
+    pending_pages = {}
+
+    # Resource ARNs listed so far, when a resource could be listed by more than one shard
+    listed = set() if (len(shards) > 1) else None
+
+    # The (future, batch) of each batch being tagged by a tagging worker, oldest first (pipelined)
+    tag_calls = collections.deque()
+    tag_executor = None if (pipeline is None) else concurrent.futures.ThreadPoolExecutor(max_workers=pipeline.tag_workers)
+
+    # Records the outcomes of a batch that has been tagged
+    def tagged(batch):
+        for resource_arn, row in batch:
+            pending_pages.pop(resource_arn, None)
+
+        if (journal is not None):
+            journal.record([row for resource_arn, row in batch])
+
+    # Records the outcomes of the batches the tagging workers have finished (in the order they were
+    # started), waiting for all of them if wait is True. Raises the error of a failed batch.
+    def finish_tag_calls(wait=False):
+        while (len(tag_calls) > 0 and (wait or tag_calls[0][0].done())):
+            future, batch = tag_calls.popleft()
+            future.result()
+            tagged(batch)
+
+    # Waits for the batches still being tagged, recording the outcomes of those that were tagged
+    # (after a failure, so a resumed run does not tag them again)
+    def drain_tag_calls():
+        while (len(tag_calls) > 0):
+            future, batch = tag_calls.popleft()
+
+            if (future.exception() is None):
+                tagged(batch)
+
+    # Tags a batch of resources and records the outcomes (once a tagging worker has tagged it, when
+    # pipelined)
+    def tag_batch(tags, batch):
+        if (pipeline is None):
+            tag_resource_batch(client, tags, batch)
+            tagged(batch)
+            return
+
+        # Wait for the oldest batch if every tagging worker is busy
+        if (len(tag_calls) >= pipeline.tag_workers):
+            with pipeline.waiting_for_tagging():
+                future, oldest_batch = tag_calls.popleft()
+                future.result()
+
+            tagged(oldest_batch)
+
+        tag_calls.append((tag_executor.submit(pipeline.tag_batch, client, tags, batch), batch))
+
+    # List the pages of every shard (starting where the journal left off), in parallel if there is
+    # more than one (or ahead of the tagging, when pipelined), and handle the pages as they arrive
+    def list_shard(shard):
+        pages = get_resource_pages(client, services, shard, tag_filters, start_tokens[shard])
+
+        return pages if (pipeline is None) else pipeline.listed_pages(pages)
+
+    if (listing_done):
+        listing = pages = (page for page in [])
+    elif (pipeline is not None):
+        listing = fanout.merge_all(shards, list_shard, max_workers, pipeline.prefetch_pages)
+        pages = pipeline.waited_pages(listing)
+    elif (len(shards) == 1):
+        listing = pages = ((shards[0], page) for page in list_shard(shards[0]))
+    else:
+        listing = pages = fanout.merge_all(shards, list_shard, max_workers)
+
+    try:
+        for start in range(0, len(retried_rows), TAG_RESOURCES_BATCH_SIZE):
+            tag_batch(new_tags, [(row.resource_arn, row) for row in retried_rows[start:start + TAG_RESOURCES_BATCH_SIZE]])
+
+        # Iterate through resources and tag them
+        for shard, (page_token, resources, pagination_token) in pages:
+            if (len(page_tokens[shard]) == 0):
+                page_tokens[shard].append(page_token)
+
+            # Rows of the page that need no tagging
+            done_rows = []
+
+            for resource in resources:
+                # Get the resource ARN
+                resource_arn = resource['ResourceARN']
+
+                # Skip the resources done (or tagged again above) since the run was started, or
+                # listed by another shard
+                if (resource_arn in completed or resource_arn in failed):
+                    continue
+
+                if (listed is not None):
+                    if (resource_arn in listed):
+                        continue
+
+                    listed.add(resource_arn)
+
+                # Filter the resource ARNs based on the filter patterns
+                if (not arn_filter.matches(resource_arn)):
+                    continue # Go to next resource
+
+                # Work out which of the new tags the resource is missing (or has a different value for)
+                row, tag_changes = get_resource_row(resource, new_tags)
+                shard_rows[shard].append(row)
+
+                if (len(tag_changes) == 0):
+                    done_rows.append(row)
+                    continue
+
+                # Update the resource with the new tags if execute is set to "yes"
+                if (execute == "yes"):
+                    change_key = frozenset(tag_changes.items())
+                    batch = pending.setdefault(change_key, [])
+                    batch.append((resource_arn, row))
+                    pending_pages[resource_arn] = (shard, len(page_tokens[shard]) - 1)
+
+                    if (len(batch) == TAG_RESOURCES_BATCH_SIZE):
+                        tag_batch(tag_changes, pending.pop(change_key))
                 else:
-                    resource_rows.append([
-                        200,
-                        "Ok",
-                        "",
-                        account, resource_arn, resource_id, service, region, resource_type,
-                        resource_tags])
-            else:
-                resource_rows.append([
-                    0,
-                    "No Op",
-                    "",
-                    account, resource_arn, resource_id, service, region, resource_type,
-                    resource_tags])
-
-        # Get the next set of resources
-        resources = client.get_resources(ResourceTypeFilters = services,
-                                         PaginationToken=pagination_token)
+                    done_rows.append(row)
+
+            page_tokens[shard].append(pagination_token)
+
+            # Record the outcomes of the batches tagged while the page was handled
+            finish_tag_calls()
+
+            # Resume each shard from the oldest of its pages that still has resources waiting to be tagged
+            if (journal is not None):
+                journal.record(done_rows)
+
+                oldest_pages = {}
+
+                for pending_shard, page in pending_pages.values():
+                    oldest_pages[pending_shard] = min(page, oldest_pages.get(pending_shard, page))
+
+                for listed_shard, tokens in page_tokens.items():
+                    if (len(tokens) > 0):
+                        journal.checkpoint(tokens[oldest_pages.get(listed_shard, len(tokens) - 1)], listed_shard)
+
+            # Report the progress of each shard as it finishes
+            if (shard is not None and pagination_token == ""):
+                print("  Listed {0}: {1} resources in {2} pages".format(shard, len(shard_rows[shard]),
+                                                                      len(page_tokens[shard]) - 1))
+
+        # Tag any partially filled batches (and wait for the tagging workers)
+        for change_key, batch in pending.items():
+            tag_batch(dict(change_key), batch)
+
+        if (tag_executor is not None):
+            with pipeline.waiting_for_tagging():
+                finish_tag_calls(wait=True)
+    finally:
+        # Stop listing (here rather than whenever the listing is garbage collected, which could be on
+        # one of its own workers), and record the outcomes of the batches still being tagged if the
+        # run failed
+        pages.close()
+        listing.close()
+
+        if (tag_executor is not None):
+            drain_tag_calls()
+            tag_executor.shutdown()
+
+    if (journal is not None):
+        journal.finish()
+
+    return resumed_rows + retried_rows + [row for shard in shards for row in shard_rows[shard]]
+
+# Updates the tags for each resource of the account as update_resource_tags does, but using the
+# aiobotocore clients of an aiofanout.ClientPool: each batch is tagged as soon as it is full, while
+# the next pages are being listed, every shard is listed at once and every batch of every account
+# can be in flight at once. A batch that fails does not stop the others: its error is recorded in
+# the rows of its resources. No journal is kept.
+async def update_resource_tags_async(pool, aws_account, new_tags, services, arn_filter, execute, tag_filters=None):
+    shards = get_shards(services)
+    shard_rows = {shard: [] for shard in shards}
+    listed = set() if (len(shards) > 1) else None
+
+    new_tags = parse_tags(new_tags)
+
+    if (new_tags is None):
+        return []
+
+    if (isinstance(arn_filter, str)):
+        arn_filter = arns.ArnMatcher([arn_filter])
+
+    pending = {}
+    tag_calls = []
+
+    # Tags a batch of resources and records the outcomes
+    async def tag_batch(tags, batch):
+        for resource_arn, row in batch:
+            print("  Tagging {0} {1} {2}".format(row.resource_type, row.resource_id, resource_arn))
+
+        try:
+            response = await pool.call(aws_account, 'resourcegroupstaggingapi', None, 'tag_resources',
+                                       ResourceARNList=[resource_arn for resource_arn, row in batch], Tags=tags)
+        except Exception as e:
+            record_batch_error(batch, e)
+            return
+
+        record_batch_outcomes(batch, response)
+
+    async def list_shard(shard):
+        page_count = 0
+
+        async for page in pool.paginate(aws_account, 'resourcegroupstaggingapi', None, 'get_resources',
+                                        **get_resources_parameters(services if (shard is None) else [shard], tag_filters)):
+            page_count += 1
+
+            for resource in page['ResourceTagMappingList']:
+                resource_arn = resource['ResourceARN']
+
+                if (listed is not None):
+                    if (resource_arn in listed):
+                        continue
+
+                    listed.add(resource_arn)
+
+                if (not arn_filter.matches(resource_arn)):
+                    continue
+
+                row, tag_changes = get_resource_row(resource, new_tags)
+                shard_rows[shard].append(row)
+
+                if (len(tag_changes) == 0 or execute != "yes"):
+                    continue
+
+                change_key = frozenset(tag_changes.items())
+                batch = pending.setdefault(change_key, [])
+                batch.append((resource_arn, row))
+
+                if (len(batch) == TAG_RESOURCES_BATCH_SIZE):
+                    tag_calls.append(asyncio.ensure_future(tag_batch(tag_changes, pending.pop(change_key))))
+
+        if (shard is not None):
+            print("  Listed {0}: {1} resources in {2} pages".format(shard, len(shard_rows[shard]), page_count))
+
+    # List every shard, waiting for all of them even if one fails, so no batch is started after the
+    # batches in flight have been waited for
+    listing_errors = [error for error in await asyncio.gather(*[list_shard(shard) for shard in shards],
+                                                              return_exceptions=True)
+                      if (isinstance(error, Exception))]
+
+    # Tag any partially filled batches (unless the listing failed), then wait for every batch
+    if (len(listing_errors) == 0):
+        for change_key, batch in pending.items():
+            tag_calls.append(asyncio.ensure_future(tag_batch(dict(change_key), batch)))
+
+    await asyncio.gather(*tag_calls)
+
+    if (len(listing_errors) > 0):
+        raise listing_errors[0]
+
+    return [row for shard in shards for row in shard_rows[shard]]
+
+# Updates the tags for the resources of each account in turn, recording the progress of the run in
+# the journal. Returns the rows of all of the accounts in profile order.
+def update_all_resource_tags(args, aws_accounts):
+    resource_rows = []
+
+    # Record the progress of the run (a resumed run must use the same options)
+    run_journal = journal.Journal(args.journal, args.resume)
+    run_parameters = {'tags': args.tags, 'services': args.services,
+                      'filter': args.filter, 'exclude': args.exclude, 'filter_file': args.filter_file,
+                      'tag_filters': filters.tag_filters(args.tag_filters), 'execute': args.execute}
+
+    # Iterate over all AWS profiles and concatenate the data
+    for profile, aws_account in aws_accounts:
+        cli.display_account_info(aws_account, [aws_account.region_name])
+
+        try:
+            account_journal = run_journal.start(aws_account.account_id, aws_account.region_name, run_parameters)
+        except ValueError as e:
+            print("Cannot resume: {0}. Exiting...".format(e))
+            exit(1)
+
+        if (len(account_journal.completed) > 0 or len(account_journal.failed) > 0):
+            print("  Resuming:   {0} resources already done, {1} to be tagged again".format(
+                len(account_journal.completed), len(account_journal.failed)))
+
+        # List ahead of the tagging, counting the work of each stage
+        pipeline = Pipeline(args.prefetch, args.tag_workers) if (args.pipeline) else None
+
+        # Update the tags for all desired resources
+        try:
+            with tracing.DEFAULT_TRACER.phase('update tags'):
+                rows = list(update_resource_tags(
+                    aws_account.client('resourcegroupstaggingapi'),
+                    args.tags.split(','),                   # Tag key/value pairs to add to resources
+                    args.services.split(','),               # AWS Services (or resource types) to tag
+                    args.arn_matcher,                       # Filter for resources to tag
+                    args.execute,                           # Execute the tag update if set to "yes"
+                    filters.tag_filters(args.tag_filters),  # Tags the resources must already have
+                    account_journal,                        # Progress of the run
+                    args.max_workers,                       # Services listed in parallel
+                    pipeline))                              # Listing ahead of the tagging
+        except Exception as e:
+            print("Failed to process profile {0}: {1}".format(profile, e))
+            print("Run again with --resume to carry on from where it stopped.\r\n")
+            continue
+
+        if (pipeline is not None):
+            pipeline.display()
+
+        print("{0} rows processed.\r\n".format(len(rows)))
+
+        # Add the updated resources to the list
+        resource_rows.extend(rows)
+
+    run_journal.close()
 
     return resource_rows
 
-if (__name__ == "__main__"):
-    # load the environment variables
-    dotenv.load_dotenv()
+# Updates the tags for the resources of every account concurrently (--async), returning the rows
+# of all of the accounts in profile order
+def update_all_resource_tags_async(args, aws_accounts):
+    for profile, aws_account in aws_accounts:
+        cli.display_account_info(aws_account, [aws_account.region_name])
+
+    def update(pool, item):
+        profile, aws_account = item
+
+        return update_resource_tags_async(
+            pool,
+            aws_account,
+            args.tags.split(','),                   # Tag key/value pairs to add to resources
+            args.services.split(','),               # AWS Services (or resource types) to tag
+            args.arn_matcher,                       # Filter for resources to tag
+            args.execute,                           # Execute the tag update if set to "yes"
+            filters.tag_filters(args.tag_filters))  # Tags the resources must already have
+
+    resource_rows = []
+
+    with tracing.DEFAULT_TRACER.phase('update tags'):
+        for (profile, aws_account), rows, error in aiofanout.run_all(aws_accounts, update, args.max_in_flight,
+                                                                     args.max_in_flight_per_account):
+            if (error is not None):
+                print("Failed to process profile {0}: {1}\r\n".format(profile, error))
+                continue
+
+            print("{0} rows processed for account {1}.\r\n".format(len(rows), aws_account.account_id))
+
+            resource_rows.extend(rows)
+
+    return resource_rows
+
+# Runs the script with the given command-line arguments (defaults to sys.argv)
+def main(argv=None, prog=None):
+    # Load the environment variables and get command-line arguments
+    args = cli.parse_args(setup_cli_args, argv, prog)
 
-    # Get command-line arguments
-    args = setup_cli_args()
+    # Start tracing, and record the AWS API responses (or answer the calls from those recorded before)
+    cli.start(args)
 
     # Exit if no profiles are specified
     if (args.profile.strip() == ""):
@@ -186,36 +815,29 @@ if (__name__ == "__main__"):
         print("No tags specified. Exiting...")
         exit(1)
 
-    # Get the list of comma-delimited profiles
-    profiles = args.profile.split(',')
-
-    # Initialize the list that will hold each data row
-    volume_rows = []
+    # Get the list of comma-delimited profiles (or the member accounts of the organization)
+    profiles = cli.get_profiles(args)
 
     display_startup_parameters(args)
 
-    # Iterate over all AWS profiles and concatenate the data
-    for profile in [p.strip() for p in profiles]:
-        # Create AWS Account object using the profile name specified
-        aws_account = account.Account(profile, args.region)
-
-        display_account_info(aws_account)
+    # Open the account of each profile (or member account) in parallel, as assuming a role in each
+    # takes a call. The accounts are displayed as they are tagged.
+    aws_accounts = [(profile, aws_account) for profile, aws_account, regions in cli.resolve_accounts(profiles, args, None)]
 
-        # Update the tags for all desired resources
-        rows = list(update_resource_tags(
-            aws_account.session.client('resourcegroupstaggingapi', region_name=aws_account.region_name),
-            args.tags.split(','),       # Tag key/value pairs to add to resources
-            args.services.split(','),   # AWS Services to tag
-            args.filter,                # Filter for resources to tag
-            args.execute))              # Execute the tag update if set to "yes"
-
-        print("{0} rows processed.\r\n".format(len(rows)))
-
-        # Add the updated resources to the list
-        volume_rows.extend(rows)
+    # Update the tags for every profile (all at once with --async)
+    if (args.use_async):
+        volume_rows = update_all_resource_tags_async(args, aws_accounts)
+    else:
+        volume_rows = update_all_resource_tags(args, aws_accounts)
 
     field_names = ['Status Code', 'Error Code', 'Error Message', 'Account ID', 'Resource ARN', 'Resource ID', 'Service',
                    'Region', 'Resource Type', 'Tags']
 
-    # Write the updated resources to a CSV file
-    write_csv_file(args.output, volume_rows, field_names)
+    # Write the updated resources to the output file
+    writers.write_file(args.output, volume_rows, field_names, args.format)
+
+    # Display the API call counts and timings
+    cli.finish(args)
+
+if (__name__ == "__main__"):
+    main()
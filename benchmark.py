@@ -0,0 +1,371 @@
+import argparse
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+import botocore.awsrequest
+import writers
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows, so peak RSS is not reported there
+
+# benchmark
+# Offline throughput benchmark for get_ebs_volume_details, get_dedicated_host_details and
+# update_resource_tags (and the AWS Config aggregator versions of the first two). The AWS APIs are
+# replaced by a synthetic stand-in that generates pages of volumes, hosts, instances and taggable
+# resources on demand (no network or credentials are needed). Each scenario runs in its own process so that its peak RSS can be measured, and the
+# results are appended to a JSON Lines file so runs can be compared over time.
+
+DEFAULT_RESULTS = "benchmark-results.jsonl"
+
+# Scenario name => default scales (number of volumes, hosts or taggable resources)
+SCENARIOS = {
+    'ebs': [1000, 10000, 100000, 1000000],
+    'hosts': [100, 1000, 5000],
+    'tag': [1000, 10000, 100000],
+    'ebs-aggregator': [1000, 10000, 100000],
+    'hosts-aggregator': [100, 1000, 5000]
+}
+
+# Number of instances placed on each synthetic Dedicated Host
+INSTANCES_PER_HOST = 20
+
+# Returns the value with the keys of every dictionary in it changed from the PascalCase of the EC2
+# APIs to the camelCase used by AWS Config
+def _config_shape(value):
+    if (isinstance(value, dict)):
+        return {key[:1].lower() + key[1:]: _config_shape(v) for key, v in value.items()}
+
+    if (isinstance(value, list)):
+        return [_config_shape(v) for v in value]
+
+    return value
+
+# Synthetic stand-in for the AWS APIs used by the scripts. It answers calls made through a real
+# boto3 client (before any request is sent) with generated responses, and counts the calls made.
+class SyntheticAWS:
+    def __init__(self, size, account_id='123456789012', region_name='us-east-1'):
+        self._size = size
+        self._account_id = account_id
+        self._region_name = region_name
+        self.calls = {}
+
+    # Creates a client for the service whose calls are answered by this stand-in
+    def client(self, service_name):
+        client = boto3.client(service_name, region_name=self._region_name,
+                              aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+
+        client.meta.events.register('before-parameter-build', self._save_params)
+        client.meta.events.register('before-call', self._handle)
+
+        return client
+
+    # Keeps the API parameters of the call (before-call only sees the serialized request)
+    def _save_params(self, params, context, **kwargs):
+        context['synthetic_params'] = dict(params)
+
+    def _handle(self, model, context, **kwargs):
+        self.calls[model.name] = self.calls.get(model.name, 0) + 1
+
+        handler = getattr(self, '_' + model.name)
+        return (botocore.awsrequest.AWSResponse(None, 200, {}, None), handler(context['synthetic_params']))
+
+    # Returns the start and end index for the page requested, and the token of the next page
+    def _page(self, token, page_size, size):
+        start = int(token or 0)
+        end = min(size, start + page_size)
+
+        return start, end, (str(end) if end < size else None)
+
+    def _DescribeVolumes(self, params):
+        start, end, next_token = self._page(params.get('NextToken'), params.get('MaxResults', 500), self._size)
+        volumes = []
+
+        for i in range(start, end):
+            volume = {
+                'VolumeId': 'vol-{0:017x}'.format(i),
+                'VolumeType': ['gp3', 'gp2', 'io2', 'standard'][i % 4],
+                'Size': 8 + (i % 500),
+                'Iops': 3000,
+                'AvailabilityZone': self._region_name + 'a',
+                'Attachments': [],
+                'Tags': [{'Key': 'Name', 'Value': 'volume-{0}'.format(i)},
+                         {'Key': 'environment', 'Value': ['production', 'staging'][i % 2]}]
+            }
+
+            # Three out of four volumes are attached to an instance
+            if (i % 4 != 0):
+                volume['Attachments'].append({'InstanceId': 'i-{0:017x}'.format(i // 2),
+                                              'Device': '/dev/xvda', 'State': 'attached'})
+
+            volumes.append(volume)
+
+        response = {'Volumes': volumes}
+
+        if (next_token is not None):
+            response['NextToken'] = next_token
+
+        return response
+
+    def _DescribeHosts(self, params):
+        start, end, next_token = self._page(params.get('NextToken'), params.get('MaxResults', 500), self._size)
+        hosts = []
+
+        for i in range(start, end):
+            hosts.append({
+                'HostId': 'h-{0:017x}'.format(i),
+                'AvailabilityZone': self._region_name + 'a',
+                'AvailableCapacity': {
+                    'AvailableInstanceCapacity': [
+                        {'TotalCapacity': INSTANCES_PER_HOST + 2, 'AvailableCapacity': 2, 'InstanceType': 'm5.large'}
+                    ],
+                    'AvailableVCpus': 4
+                },
+                'Instances': [{'InstanceId': 'i-{0:012x}{1:05x}'.format(i, j), 'InstanceType': 'm5.large'}
+                              for j in range(INSTANCES_PER_HOST)],
+                'Tags': [{'Key': 'Name', 'Value': 'host-{0}'.format(i)}]
+            })
+
+        response = {'Hosts': hosts}
+
+        if (next_token is not None):
+            response['NextToken'] = next_token
+
+        return response
+
+    def _DescribeInstances(self, params):
+        instance_ids = []
+
+        for instance_filter in params.get('Filters', []):
+            if (instance_filter['Name'] == 'instance-id'):
+                instance_ids.extend(instance_filter['Values'])
+
+        instance_ids.extend(params.get('InstanceIds', []))
+
+        instances = [{'InstanceId': instance_id, 'Tags': [{'Key': 'Name', 'Value': 'server-' + instance_id}]}
+                     for instance_id in instance_ids]
+
+        return {'Reservations': [{'Instances': instances}]}
+
+    def _GetResources(self, params):
+        start, end, next_token = self._page(params.get('PaginationToken'), params.get('ResourcesPerPage', 100),
+                                            self._size)
+        resources = []
+
+        for i in range(start, end):
+            tags = [{'Key': 'Name', 'Value': 'volume-{0}'.format(i)}]
+
+            # Every other resource already has the tag being applied
+            if (i % 2 == 0):
+                tags.append({'Key': 'environment', 'Value': 'production'})
+
+            resources.append({
+                'ResourceARN': 'arn:aws:ec2:{0}:{1}:volume/vol-{2:017x}'.format(self._region_name, self._account_id, i),
+                'Tags': tags
+            })
+
+        return {'ResourceTagMappingList': resources, 'PaginationToken': next_token or ''}
+
+    def _TagResources(self, params):
+        return {'FailedResourcesMap': {}}
+
+    # Answers the advanced queries of the aggregator module with the configuration items of the
+    # synthetic volumes, hosts or instances (on hosts), whatever the properties and conditions
+    def _SelectAggregateResourceConfig(self, params):
+        expression = params['Expression']
+        page_size = params.get('Limit', 100)
+
+        if ("'AWS::EC2::Volume'" in expression):
+            start, end, next_token = self._page(params.get('NextToken'), page_size, self._size)
+            resources = [(v['VolumeId'], v) for v in
+                         self._DescribeVolumes({'NextToken': start, 'MaxResults': end - start})['Volumes']]
+        elif ("'AWS::EC2::Host'" in expression):
+            start, end, next_token = self._page(params.get('NextToken'), page_size, self._size)
+            resources = [(h['HostId'], h) for h in
+                         self._DescribeHosts({'NextToken': start, 'MaxResults': end - start})['Hosts']]
+        else:
+            start, end, next_token = self._page(params.get('NextToken'), page_size, self._size * INSTANCES_PER_HOST)
+            instance_ids = ['i-{0:012x}{1:05x}'.format(i // INSTANCES_PER_HOST, i % INSTANCES_PER_HOST) for i in range(start, end)]
+            resources = [(i['InstanceId'], i) for i in
+                         self._DescribeInstances({'InstanceIds': instance_ids})['Reservations'][0]['Instances']]
+
+        results = []
+
+        for resource_id, resource in resources:
+            resource = dict(resource)
+            tags = resource.pop('Tags', [])
+
+            results.append(json.dumps({
+                'accountId': self._account_id,
+                'awsRegion': self._region_name,
+                'resourceId': resource_id,
+                'configuration': _config_shape(resource),
+                'tags': _config_shape(tags)
+            }))
+
+        response = {'Results': results}
+
+        if (next_token is not None):
+            response['NextToken'] = next_token
+
+        return response
+
+# Runs the scenario at the given scale, returning its measurements
+def run_scenario(scenario, scale):
+    synthetic = SyntheticAWS(scale)
+    output = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+    output.close()
+
+    # The progress the scripts print (e.g. a line per resource tagged) is discarded, so the time
+    # measured is that of the API work rather than of writing to the terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+
+        if (scenario == 'ebs'):
+            module = importlib.import_module('aws-list-ebs')
+            rows = module.get_ebs_volume_details(synthetic.client('ec2'), '123456789012', 'us-east-1')
+        elif (scenario == 'hosts'):
+            module = importlib.import_module('aws-list-dedicated-hosts')
+            rows = module.get_dedicated_host_details(synthetic.client('ec2'), '123456789012', 'us-east-1')
+        elif (scenario == 'ebs-aggregator'):
+            module = importlib.import_module('aws-list-ebs')
+            rows = module.get_aggregated_volume_details(synthetic.client('config'), 'benchmark')
+        elif (scenario == 'hosts-aggregator'):
+            module = importlib.import_module('aws-list-dedicated-hosts')
+            rows = module.get_aggregated_host_details(synthetic.client('config'), 'benchmark')
+        else:
+            module = importlib.import_module('aws-tag-resources')
+            rows = module.update_resource_tags(synthetic.client('resourcegroupstaggingapi'),
+                                               ['environment=production'], ['ec2:volume'], '', 'yes')
+
+        # Count the rows on their way to the output file
+        row_count = [0]
+
+        def counted(rows):
+            for row in rows:
+                row_count[0] += 1
+                yield row
+
+        writers.write_file(output.name, counted(rows), ['Column'] * 20)
+
+        wall_time = time.perf_counter() - started
+
+    api_calls = sum(synthetic.calls.values())
+
+    os.remove(output.name)
+
+    peak_rss_mb = None
+
+    if (resource is not None):
+        # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        if (sys.platform != 'darwin'):
+            peak_rss *= 1024
+
+        peak_rss_mb = round(peak_rss / (1024 * 1024), 1)
+
+    return {
+        'scenario': scenario,
+        'scale': scale,
+        'rows': row_count[0],
+        'wall_time': round(wall_time, 3),
+        'rows_per_sec': round(row_count[0] / wall_time, 1) if (wall_time > 0) else None,
+        'api_calls': api_calls,
+        'api_calls_per_row': round(api_calls / row_count[0], 4) if (row_count[0] > 0) else None,
+        'api_calls_by_operation': synthetic.calls,
+        'peak_rss_mb': peak_rss_mb
+    }
+
+# Setup command-line arguments
+def setup_cli_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the AWS Buddy scripts against a synthetic (offline) stand-in for AWS.')
+
+    parser.add_argument(
+        "-s", "--scenarios", help="A comma-separated list of scenarios to run ({0}).".format(", ".join(SCENARIOS)),
+        dest="scenarios", default=",".join(SCENARIOS))
+
+    parser.add_argument(
+        "--scales", help="A comma-separated list of scales (volumes, hosts or resources) overriding the defaults.",
+        dest="scales")
+
+    parser.add_argument(
+        "-o", "--output", help="JSON Lines file the results are appended to.", dest="output", default=DEFAULT_RESULTS)
+
+    # Used internally to run a single scenario in a child process
+    parser.add_argument("--run-one", help=argparse.SUPPRESS, dest="run_one", nargs=2)
+
+    return parser.parse_args(argv)
+
+# Displays the results as a table
+def display_results(results):
+    print("{0:<18}{1:>10}{2:>10}{3:>12}{4:>14}{5:>12}{6:>14}".format(
+        "Scenario", "Scale", "Rows", "Wall (s)", "Rows/sec", "Calls/row", "Peak RSS (MB)"))
+
+    for result in results:
+        print("{0:<18}{1:>10}{2:>10}{3:>12}{4:>14}{5:>12}{6:>14}".format(
+            result['scenario'], result['scale'], result['rows'], result['wall_time'],
+            result['rows_per_sec'], result['api_calls_per_row'], result['peak_rss_mb']))
+
+# Runs the benchmark with the given command-line arguments (defaults to sys.argv)
+def main(argv=None):
+    args = setup_cli_args(argv)
+
+    if (args.run_one is not None):
+        print(json.dumps(run_scenario(args.run_one[0], int(args.run_one[1]))))
+        return
+
+    # Identify the run so results can be compared over time
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    run_info = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform()
+    }
+
+    results = []
+
+    for scenario in [s.strip() for s in args.scenarios.split(',')]:
+        if (scenario not in SCENARIOS):
+            print("Unknown scenario: {0}".format(scenario))
+            return 1
+
+        scales = SCENARIOS[scenario] if (args.scales is None) else [int(s) for s in args.scales.split(',')]
+
+        for scale in scales:
+            # Run each scenario in a fresh process so its peak RSS is its own
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', scenario, str(scale)],
+                                   capture_output=True, text=True)
+
+            if (child.returncode != 0):
+                print("Scenario {0} ({1}) failed:\r\n{2}".format(scenario, scale, child.stderr))
+                continue
+
+            result = dict(run_info, **json.loads(child.stdout.strip().splitlines()[-1]))
+            results.append(result)
+
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + "\n")
+
+    display_results(results)
+    print("\r\nResults appended to {0}".format(args.output))
+
+if (__name__ == "__main__"):
+    sys.exit(main())
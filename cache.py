@@ -0,0 +1,236 @@
+import bisect
+import concurrent.futures
+import datetime
+import threading
+import time
+
+import fanout
+
+# cache
+# In-memory inventory kept warm by a long-running process (aws-inventory-server). The rows of each
+# collector for each (account, region) scope are refreshed in the background once they are older
+# than the TTL, and are indexed by the keys their collector names (collectors.Collector.index_keys)
+# so that lookups by instance, volume, host, tag or ARN prefix take a few dictionary lookups rather
+# than a scan of every account. A scope is replaced in one step once all of its rows have been
+# read, so lookups never see a partial refresh, and a failed refresh keeps the previous rows.
+
+# Number of seconds after which a scope is refreshed
+DEFAULT_TTL = 15 * 60
+
+# Number of seconds after which a scope whose refresh failed is tried again (or the TTL, if shorter)
+RETRY_INTERVAL = 60
+
+# Validates the --ttl command-line value
+def ttl_arg(value):
+    ttl = int(value)
+
+    if (ttl < 1):
+        raise ValueError("TTL must be at least 1 second")
+
+    return ttl
+
+# Returns the time.time() value as an ISO 8601 (UTC) string
+def _timestamp(seconds):
+    if (seconds is None):
+        return None
+
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+# The rows of one collector for one account and region, and the state of their refreshes
+class Scope:
+    def __init__(self, collector, aws_account, region_name):
+        self.collector = collector
+        self.aws_account = aws_account
+        self.region_name = region_name
+        self.rows = []
+        self.row_keys = []
+        self.refreshed_at = None
+        self.duration = None
+        self.error = None
+        self.next_refresh = 0
+        self.refreshing = False
+
+    # Identifies the scope (and orders the results of lookups)
+    @property
+    def key(self):
+        return (self.collector.name, self.aws_account.account_id, self.region_name)
+
+    def status(self):
+        return {
+            'collector': self.collector.name,
+            'account_id': self.aws_account.account_id,
+            'region': self.region_name,
+            'rows': len(self.rows),
+            'refreshed_at': _timestamp(self.refreshed_at),
+            'duration': None if (self.duration is None) else round(self.duration, 3),
+            'next_refresh': _timestamp(self.next_refresh) if (self.refreshed_at or self.error) else None,
+            'error': self.error
+        }
+
+class InventoryCache:
+    # targets:      (account.Account, region name) pairs to be kept in memory
+    # collector_list: collectors (collectors.Collector) run for each target
+    def __init__(self, targets, collector_list, ttl=DEFAULT_TTL, max_workers=fanout.DEFAULT_MAX_WORKERS):
+        self._scopes = [Scope(collector, aws_account, region_name)
+                        for aws_account, region_name in targets for collector in collector_list]
+        self._collectors = {collector.name: collector for collector in collector_list}
+        self._ttl = ttl
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Index name => value => scope key => rows with that value
+        self._indexes = {}
+
+        # ARNs (keys of the arn index) in order, for prefix lookups; rebuilt after a change
+        self._sorted_arns = None
+
+    # Starts refreshing the scopes in the background (every scope is loaded straight away)
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cache-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if (self._thread is not None):
+            self._thread.join()
+
+    # Refreshes the scopes that are due (at most max_workers at a time) until stopped
+    def _run(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while (not self._stopped.is_set()):
+                now = time.time()
+
+                with self._lock:
+                    due = [scope for scope in self._scopes if (not scope.refreshing and scope.next_refresh <= now)]
+
+                    for scope in due:
+                        scope.refreshing = True
+
+                for scope in due:
+                    executor.submit(self._refresh, scope)
+
+                with self._lock:
+                    waiting = [scope.next_refresh for scope in self._scopes if (not scope.refreshing)]
+
+                # Wake up when the next scope is due, or at least once a second to pick up the
+                # scopes whose refresh has finished
+                self._stopped.wait(min([1.0] + [max(0, t - now) for t in waiting]))
+
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Reads all of the rows of the scope (runs on a worker thread), then swaps them in
+    def _refresh(self, scope):
+        started = time.time()
+
+        try:
+            rows = list(scope.collector.collect(scope.aws_account, scope.region_name))
+
+            # Work out the index keys before taking the lock, so lookups are held up as little as possible
+            row_keys = [tuple(scope.collector.index_keys(row)) for row in rows]
+        except Exception as e:
+            with self._lock:
+                scope.error = str(e)
+                scope.next_refresh = time.time() + min(self._ttl, RETRY_INTERVAL)
+                scope.refreshing = False
+
+            print("Failed to refresh {0} for account {1} in {2}: {3}".format(
+                scope.collector.name, scope.aws_account.account_id, scope.region_name, e))
+            return
+
+        ended = time.time()
+
+        with self._lock:
+            self._replace(scope, rows, row_keys)
+
+            scope.refreshed_at = ended
+            scope.duration = ended - started
+            scope.error = None
+            scope.next_refresh = ended + self._ttl
+            scope.refreshing = False
+
+    # Replaces the rows of the scope, and the index entries of their keys (called with the lock held)
+    def _replace(self, scope, rows, row_keys):
+        key = scope.key
+
+        for keys in scope.row_keys:
+            for name, value in keys:
+                values = self._indexes[name]
+                scopes = values.get(value)
+
+                if (scopes is not None and scopes.pop(key, None) is not None and len(scopes) == 0):
+                    del values[value]
+
+                    if (name == 'arn'):
+                        self._sorted_arns = None
+
+        for row, keys in zip(rows, row_keys):
+            for name, value in keys:
+                values = self._indexes.setdefault(name, {})
+                scopes = values.get(value)
+
+                if (scopes is None):
+                    scopes = values[value] = {}
+
+                    if (name == 'arn'):
+                        self._sorted_arns = None
+
+                scope_rows = scopes.get(key)
+
+                if (scope_rows is None):
+                    scopes[key] = [row]
+                elif (scope_rows[-1] is not row): # A row may yield the same key more than once
+                    scope_rows.append(row)
+
+        scope.rows = rows
+        scope.row_keys = row_keys
+
+    # Returns the (collector, row) pairs for each of the scope => rows dictionaries, in scope order
+    def _results(self, scope_rows_list):
+        results = []
+
+        for scope_rows in scope_rows_list:
+            for key in sorted(scope_rows):
+                results.extend([(self._collectors[key[0]], row) for row in scope_rows[key]])
+
+        return results
+
+    # Returns the (collector, row) pairs with the value in the index (instance, volume, host, tag,
+    # tag-key or arn)
+    def lookup(self, index, value):
+        with self._lock:
+            scope_rows = self._indexes.get(index, {}).get(value)
+
+            return self._results([] if (scope_rows is None) else [scope_rows])
+
+    # Returns the (collector, row) pairs with an ARN starting with the prefix, in ARN order (at
+    # most limit ARNs, if given)
+    def lookup_arn_prefix(self, prefix, limit=None):
+        with self._lock:
+            if (self._sorted_arns is None):
+                self._sorted_arns = sorted(self._indexes.get('arn', {}))
+
+            start = bisect.bisect_left(self._sorted_arns, prefix)
+            end = start
+
+            while (end < len(self._sorted_arns) and self._sorted_arns[end].startswith(prefix) and
+                   (limit is None or end - start < limit)):
+                end += 1
+
+            arn_index = self._indexes['arn'] if (end > start) else {}
+
+            return self._results([arn_index[arn] for arn in self._sorted_arns[start:end]])
+
+    # Returns the state of every scope, and whether all of them have been loaded at least once
+    def status(self):
+        with self._lock:
+            scopes = [scope.status() for scope in sorted(self._scopes, key=lambda scope: scope.key)]
+
+        return {
+            'ready': all([scope['refreshed_at'] is not None for scope in scopes]),
+            'rows': sum([scope['rows'] for scope in scopes]),
+            'ttl': self._ttl,
+            'scopes': scopes
+        }
@@ -0,0 +1,254 @@
+import atexit
+import botocore.awsrequest
+import gzip
+import json
+import os
+import threading
+
+# cassette
+# Recording (--record DIR) and replay (--replay DIR) of the AWS API responses received by the
+# clients of account.Account. While recording, the response to every read-only call (Describe*,
+# Get*, List* and Select*) is saved, along with the parameters of the call, to a gzip-compressed
+# JSON Lines cassette for each account and region (DIR/<account ID>/<region>.jsonl.gz). When
+# replaying, each call is answered from the cassettes before any request is sent, so the scripts
+# build exactly the same rows with no network access or credentials, in a fraction of the time. The
+# account ID and region of each profile are saved too (DIR/accounts.json), so neither STS nor the
+# AWS configuration files are needed either: a cassette can be replayed on any machine.
+
+ACCOUNTS_FILE = "accounts.json"
+
+# Key of the account in the accounts file when the credentials cannot be identified (the env
+# configuration without an access key or profile; see account.Account.cache_key)
+ENV_KEY = "env"
+
+# Prefixes of the API operations whose responses are recorded (calls that change nothing)
+READ_ONLY_PREFIXES = ('Describe', 'Get', 'List', 'Select')
+
+# Returns the key of an API call in a cassette: the operation and its parameters
+def call_key(operation_name, parameters):
+    return "{0} {1}".format(operation_name, json.dumps(parameters, sort_keys=True, default=str))
+
+# Records or replays the API responses of the clients attached to it (by account.Account)
+class Cassettes:
+    def __init__(self):
+        self._directory = None
+        self._replaying = False
+        self._lock = threading.Lock()
+        self._files = {}
+        self._responses = {}
+        self._accounts = {}
+
+    @property
+    def recording(self):
+        return self._directory is not None and not self._replaying
+
+    @property
+    def replaying(self):
+        return self._replaying
+
+    # Starts recording the responses to the cassettes in the directory (the cassettes are closed
+    # when the process exits)
+    def record(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        self._directory = directory
+        self._replaying = False
+        self._accounts = _read_json(os.path.join(directory, ACCOUNTS_FILE))
+
+        atexit.register(self.close)
+
+    # Starts answering calls from the cassettes in the directory
+    def replay(self, directory):
+        self._directory = directory
+        self._replaying = True
+        self._accounts = _read_json(os.path.join(directory, ACCOUNTS_FILE))
+
+    # Returns the account recorded for the credentials (account.Account.cache_key), as a dictionary
+    # with its account ID and region. Raises LookupError if the credentials were not recorded.
+    def _account(self, cache_key):
+        cache_key = cache_key or ENV_KEY
+
+        if (cache_key not in self._accounts):
+            raise LookupError("the account of {0} was not recorded in {1}".format(cache_key, self._directory))
+
+        entry = self._accounts[cache_key]
+
+        # Cassettes recorded before the region was saved only have the account ID
+        return {'account_id': entry, 'region': None} if (isinstance(entry, str)) else entry
+
+    # Returns the account ID recorded for the credentials (account.Account.cache_key) when
+    # replaying, otherwise None. Raises LookupError if the credentials were not recorded.
+    def account_id(self, cache_key):
+        if (not self._replaying):
+            return None
+
+        return self._account(cache_key)['account_id']
+
+    # Returns the region the credentials (account.Account.cache_key) were recorded with, or the only
+    # region recorded for their account. Raises LookupError if there is no such region.
+    def region_name(self, cache_key):
+        entry = self._account(cache_key)
+
+        if (entry['region'] is not None):
+            return entry['region']
+
+        directory = os.path.join(self._directory, entry['account_id'])
+        regions = [filename[:-len(".jsonl.gz")] for filename in os.listdir(directory)
+                   if (filename.endswith(".jsonl.gz"))] if (os.path.isdir(directory)) else []
+
+        if (len(regions) != 1):
+            raise LookupError("the region of {0} was not recorded in {1} (use -r to choose one)".format(
+                cache_key or ENV_KEY, self._directory))
+
+        return regions[0]
+
+    # Saves the account ID and region of the credentials (account.Account.cache_key) when recording
+    def add_account(self, cache_key, account_id, region_name):
+        if (not self.recording):
+            return
+
+        cache_key = cache_key or ENV_KEY
+        entry = {'account_id': account_id, 'region': region_name}
+
+        with self._lock:
+            if (self._accounts.get(cache_key) != entry):
+                self._accounts[cache_key] = entry
+
+                with open(os.path.join(self._directory, ACCOUNTS_FILE), 'w') as f:
+                    json.dump(self._accounts, f, indent=2, sort_keys=True)
+
+    def _filename(self, account_id, region_name):
+        return os.path.join(self._directory, account_id, "{0}.jsonl.gz".format(region_name))
+
+    # Hooks the client's events to record its responses, or to answer its calls from the cassette of
+    # the account and the client's region (if recording or replaying). get_account_id returns the
+    # account's ID; it is only called once a call is made.
+    def attach(self, client, get_account_id):
+        if (self._directory is None):
+            return client
+
+        region_name = client.meta.region_name
+
+        # Keeps the API parameters of the call (before-call only sees the serialized request)
+        def save_parameters(params, context, **kwargs):
+            context['cassette_parameters'] = dict(params)
+
+        def after_call(model, context, parsed, http_response=None, **kwargs):
+            if ('cassette_parameters' not in context or not model.name.startswith(READ_ONLY_PREFIXES)):
+                return
+
+            if (http_response is None or http_response.status_code != 200 or 'Error' in parsed):
+                return
+
+            response = {key: value for key, value in parsed.items() if (key != 'ResponseMetadata')}
+
+            self._write(get_account_id(), region_name, model.name, context['cassette_parameters'], response)
+
+        def before_call(model, context, **kwargs):
+            account_id = get_account_id()
+            response = self._read(account_id, region_name).get(
+                call_key(model.name, context.get('cassette_parameters', {})))
+
+            if (response is None):
+                raise LookupError("no recorded response to {0} for account {1} in {2} (record again with the same options)".format(
+                    model.name, account_id, region_name))
+
+            return (botocore.awsrequest.AWSResponse(None, 200, {}, None), response)
+
+        client.meta.events.register('before-parameter-build', save_parameters)
+
+        if (self._replaying):
+            client.meta.events.register('before-call', before_call)
+        else:
+            client.meta.events.register('after-call', after_call)
+
+        return client
+
+    # Appends a call to the cassette of the account and region
+    def _write(self, account_id, region_name, operation_name, parameters, response):
+        entry = json.dumps({'operation': operation_name, 'parameters': parameters, 'response': response},
+                           separators=(',', ':'), default=str)
+
+        with self._lock:
+            key = (account_id, region_name)
+
+            if (key not in self._files):
+                filename = self._filename(account_id, region_name)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+                # Add to the cassette, so that several scripts (or runs) can be recorded to the same
+                # directory (the latest response to a call is the one replayed)
+                self._files[key] = gzip.open(filename, 'at')
+
+            self._files[key].write(entry)
+            self._files[key].write("\n")
+
+    # Returns the responses recorded for the account and region (call key => response), loading
+    # them on first use
+    def _read(self, account_id, region_name):
+        with self._lock:
+            key = (account_id, region_name)
+
+            if (key not in self._responses):
+                responses = {}
+                filename = self._filename(account_id, region_name)
+
+                if (os.path.exists(filename)):
+                    with gzip.open(filename, 'rt') as f:
+                        for line in f:
+                            entry = json.loads(line)
+                            responses[call_key(entry['operation'], entry['parameters'])] = entry['response']
+
+                self._responses[key] = responses
+
+            return self._responses[key]
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+
+            self._files = {}
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Adds the --record and --replay command-line arguments
+def add_arguments(parser):
+    cassettes = parser.add_mutually_exclusive_group()
+
+    cassettes.add_argument(
+        "--record", help="Save the AWS API responses, one compressed cassette per account and region, in this directory.", dest="record", metavar="DIR")
+
+    cassettes.add_argument(
+        "--replay", help="Answer the AWS API calls from the cassettes saved in this directory by --record, without using the network.", dest="replay", metavar="DIR")
+
+# Checks the --record and --replay command-line arguments
+def check_arguments(parser, args):
+    if (args.record is None and args.replay is None):
+        return
+
+    # The aiobotocore clients are not created through account.Account
+    if (getattr(args, 'use_async', False)):
+        parser.error("--record and --replay cannot be used with --async")
+
+    # The assumed role credentials are never recorded
+    if (args.replay is not None and getattr(args, 'org_role', None) is not None):
+        parser.error("--replay cannot be used with --org-role")
+
+    if (args.replay is not None and not os.path.isdir(args.replay)):
+        parser.error("no cassettes in {0}".format(args.replay))
+
+# Starts recording or replaying, if requested on the command line
+def start(args):
+    if (args.record is not None):
+        DEFAULT_CASSETTES.record(args.record)
+    elif (args.replay is not None):
+        DEFAULT_CASSETTES.replay(args.replay)
+
+# The cassettes of every client created through account.Account
+DEFAULT_CASSETTES = Cassettes()
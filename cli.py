@@ -0,0 +1,117 @@
+import cassette
+import dotenv
+import fanout
+import organization
+import scheduler
+import tracing
+
+# cli
+# The steps the scripts share around their own work: loading the environment and the command-line
+# arguments, starting the tracer and the cassettes, listing the profiles (or member accounts),
+# opening the account of each in parallel along with the regions to query, and displaying the API
+# call counts and timings once the work is done.
+
+# Loads the environment variables, then returns the command-line arguments parsed by the script's
+# setup_cli_args
+def parse_args(setup_cli_args, argv=None, prog=None):
+    dotenv.load_dotenv()
+
+    return setup_cli_args(argv, prog)
+
+# Starts tracing (--trace) and recording (--record) or replaying (--replay) the AWS API responses
+def start(args):
+    if (args.trace is not None):
+        tracing.DEFAULT_TRACER.enable()
+
+    cassette.start(args)
+
+# Returns the profile names, or with --org-role the member accounts, to be processed (exits if
+# the accounts of the organization cannot be listed)
+def get_profiles(args):
+    try:
+        return organization.get_profiles(args)
+    except Exception as e:
+        print("Failed to list the accounts of the organization: {0}".format(e))
+        exit(1)
+
+# Displays the regions and profiles the script was started with
+def display_target_parameters(args):
+    if (args.all_regions):
+        print("  Region:     All enabled regions")
+    elif (args.regions is not None):
+        print("  Region:     {0}".format(args.regions))
+    else:
+        print("  Region:     {0}".format(args.region))
+
+    if (args.profile is None):
+        print("  Profile:    Using env configuration")
+    else:
+        print("  Profile:    {0}".format(args.profile))
+
+# Display AWS Account settings
+def display_account_info(account, regions, heading="Processing..."):
+    print(heading)
+    print("  Account ID: {0}".format(account.account_id))
+    print("  Region:     {0}".format(", ".join(regions)))
+
+    if (account.profile_name is None):
+        print("  Profile:    Using env configuration")
+    else:
+        print("  Profile:    {0}".format(account.profile_name))
+
+# Returns the AWS Account for a profile along with the regions to be queried (runs on a worker
+# thread). Scripts without the -a/--regions options only query the account's region.
+def resolve_account(profile, args):
+    # Create AWS Account object using the profile name specified (or assume the role in the member account)
+    aws_account = organization.open_account(profile, args)
+
+    # Resolve the account ID now, while on the worker thread (it may call STS)
+    aws_account.account_id
+
+    if (getattr(args, 'all_regions', False)):
+        regions = aws_account.enabled_regions
+    elif (getattr(args, 'regions', None) is not None):
+        regions = [r.strip() for r in args.regions.split(',')]
+    else:
+        regions = [aws_account.region_name]
+
+    return aws_account, regions
+
+# Resolves all of the profiles (and the regions to query for each) in parallel, returning a
+# (profile, account, regions) tuple for each profile that could be opened, in profile order. Each
+# account is displayed under the heading as it is returned, unless the heading is None.
+def resolve_accounts(profiles, args, heading="Processing..."):
+    accounts = []
+
+    for profile, result, error in fanout.run_all(profiles,
+                                                 lambda profile: resolve_account(profile, args),
+                                                 args.max_workers):
+        if (error is not None):
+            print("Failed to process profile {0}: {1}\r\n".format(profile, error))
+            continue
+
+        aws_account, regions = result
+
+        if (heading is not None):
+            display_account_info(aws_account, regions, heading)
+
+        accounts.append((profile, aws_account, regions))
+
+    return accounts
+
+# Returns the (account, region) pairs to query for all of the profiles, in profile/region order,
+# as resolve_accounts does
+def resolve_targets(profiles, args, heading="Processing..."):
+    return [(aws_account, region_name)
+            for profile, aws_account, regions in resolve_accounts(profiles, args, heading)
+            for region_name in regions]
+
+# Displays the API call, throttling and retry counts, and the API call latencies and local timings
+# (saved as a Chrome trace with --trace FILE)
+def finish(args):
+    scheduler.DEFAULT_SCHEDULER.display_stats()
+
+    tracing.DEFAULT_TRACER.display_summary()
+
+    if (isinstance(args.trace, str)):
+        tracing.DEFAULT_TRACER.write_chrome_trace(args.trace)
@@ -0,0 +1,203 @@
+import arns
+import asyncio
+import importlib
+import records
+
+# collectors
+# Plug-ins for the single-pass inventory engine (aws-inventory). A collector lists one kind of
+# resource for an account and region, using the clients of a shared account.Account, so every
+# collector run against the same account reuses its session, account ID and clients (and the
+# shared scheduler). The EBS and Dedicated Host collectors reuse the logic of aws-list-ebs and
+# aws-list-dedicated-hosts, which are only imported once a collector that needs them is created.
+# Collectors can also run on the asyncio engine (aiofanout, with --async), where the same rows
+# are built from the responses of the aiobotocore clients of an aiofanout.ClientPool.
+# Collectors also name the keys their rows can be looked up by in the inventory cache (cache).
+
+# Number of resources requested per get_resources call (max 100)
+RESOURCES_PAGE_SIZE = 100
+
+# EC2 resource type (of a tagging API ARN) => the inventory cache index of its resource ID
+EC2_INDEXES = {'instance': 'instance', 'volume': 'volume', 'dedicated-host': 'host'}
+
+class Collector:
+    # Name used on the command line and as the inventory store kind
+    name = None
+
+    description = None
+
+    # Output filename (without the format's extension)
+    output = None
+
+    field_names = []
+
+    def __init__(self, args):
+        self._args = args
+
+    # Returns the unique key of a row (for the inventory store)
+    def key(self, row):
+        raise NotImplementedError()
+
+    # Yields the (index, value) pairs the row can be looked up by in the inventory cache (instance,
+    # volume, host, tag, tag-key or arn)
+    def index_keys(self, row):
+        return ()
+
+    # Returns the rows for the account and region (runs on a worker thread)
+    def collect(self, aws_account, region_name):
+        raise NotImplementedError()
+
+    # Returns an asynchronous iterator of the rows for the account and region, using the clients of
+    # the pool (runs on the event loop)
+    def collect_async(self, pool, aws_account, region_name):
+        raise NotImplementedError()
+
+class EbsCollector(Collector):
+    name = 'ebs'
+    description = 'EBS volumes (as aws-list-ebs)'
+    output = 'volumes'
+
+    def __init__(self, args):
+        super().__init__(args)
+        self._module = importlib.import_module('aws-list-ebs')
+        self.field_names = self._module.FIELD_NAMES
+
+    def key(self, row):
+        return row[5]
+
+    def index_keys(self, row):
+        yield 'volume', row.volume_id
+        yield 'arn', row.volume_arn
+
+        if (row.instance_id != ''):
+            yield 'instance', row.instance_id
+            yield 'arn', row.ec2_arn
+
+        yield from _tag_keys(row._tags)
+
+    def collect(self, aws_account, region_name):
+        return self._module.get_ebs_volume_details(aws_account.client('ec2', region_name),
+                                                   aws_account.account_id, region_name)
+
+    async def collect_async(self, pool, aws_account, region_name):
+        async for page in pool.paginate(aws_account, 'ec2', region_name, 'describe_volumes',
+                                        **self._module.get_volume_parameters()):
+            for volume in page.get('Volumes', []):
+                yield self._module.get_volume_row(volume, aws_account.account_id, region_name)
+
+class HostsCollector(Collector):
+    name = 'hosts'
+    description = 'Dedicated Hosts and their instances (as aws-list-dedicated-hosts)'
+    output = 'hosts'
+
+    def __init__(self, args):
+        super().__init__(args)
+        self._module = importlib.import_module('aws-list-dedicated-hosts')
+        self.field_names = self._module.FIELD_NAMES
+
+        # Instance names are looked up once per run, however many hosts (or regions) reference them
+        self._instance_name_cache = {}
+
+    def key(self, row):
+        return self._module.get_host_row_key(row)
+
+    def index_keys(self, row):
+        yield 'host', row.host_id
+
+        if (row.instance_id != ''):
+            yield 'instance', row.instance_id
+            yield 'arn', row.ec2_arn
+
+    def collect(self, aws_account, region_name):
+        return self._module.get_dedicated_host_details(aws_account.client('ec2', region_name),
+                                                       aws_account.account_id, region_name,
+                                                       self._instance_name_cache)
+
+    async def collect_async(self, pool, aws_account, region_name):
+        hosts = []
+
+        async for page in pool.paginate(aws_account, 'ec2', region_name, 'describe_hosts',
+                                        PaginationConfig={'PageSize': self._module.HOST_PAGE_SIZE}):
+            hosts.extend(page.get('Hosts', []))
+
+        # Look up the names of the instances not already known, a batch per call (all at once)
+        instance_ids = [i['InstanceId'] for host in hosts for i in host.get('Instances', [])]
+        missing_ids = [i for i in dict.fromkeys(instance_ids) if i not in self._instance_name_cache]
+        batch_size = self._module.INSTANCE_BATCH_SIZE
+
+        await asyncio.gather(*[self._get_instance_names(pool, aws_account, region_name, missing_ids[start:start + batch_size])
+                               for start in range(0, len(missing_ids), batch_size)])
+
+        instance_names = {i: self._instance_name_cache[i] for i in instance_ids}
+
+        for host in hosts:
+            for row in self._module.get_host_rows(host, aws_account.account_id, region_name, instance_names):
+                yield row
+
+    # Adds the Name of each instance in the batch to the instance name cache
+    async def _get_instance_names(self, pool, aws_account, region_name, batch):
+        async for page in pool.paginate(aws_account, 'ec2', region_name, 'describe_instances',
+                                        Filters=[{'Name': 'instance-id', 'Values': batch}],
+                                        PaginationConfig={'PageSize': 1000}):
+            for reservation in page.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    self._instance_name_cache[instance['InstanceId']] = self._module.get_instance_name(instance)
+
+        # Remember instances that no longer exist so they are not looked up again
+        for instance_id in batch:
+            self._instance_name_cache.setdefault(instance_id, '')
+
+# Lists every resource the tagging API knows about (the resources aws-tag-resources can tag)
+class ResourcesCollector(Collector):
+    name = 'resources'
+    description = 'All taggable resources and their tags (from the tagging API)'
+    output = 'resources'
+    field_names = ['Account ID', 'Region', 'Resource ARN', 'Service', 'Resource Type', 'Resource ID', 'Tags']
+
+    def key(self, row):
+        return row[2]
+
+    def index_keys(self, row):
+        yield 'arn', row.resource_arn
+
+        arn = arns.parse(row.resource_arn)
+
+        if (arn is not None and arn.service == 'ec2' and arn.resource_type in EC2_INDEXES):
+            yield EC2_INDEXES[arn.resource_type], arn.resource_id
+
+        yield from _tag_keys(row._tags)
+
+    def collect(self, aws_account, region_name):
+        return get_resources(aws_account.client('resourcegroupstaggingapi', region_name),
+                             aws_account.account_id, region_name, self._args.services)
+
+    async def collect_async(self, pool, aws_account, region_name):
+        async for page in pool.paginate(aws_account, 'resourcegroupstaggingapi', region_name, 'get_resources',
+                                        **get_resources_parameters(self._args.services)):
+            for resource in page.get('ResourceTagMappingList', []):
+                yield records.ResourceRow(aws_account.account_id, region_name, resource['ResourceARN'],
+                                          resource.get('Tags', []))
+
+# Yields the tag and tag-key index keys of the tags (as kept by the records)
+def _tag_keys(tags):
+    for key, value in tags:
+        yield 'tag', (key, value)
+        yield 'tag-key', key
+
+# Returns the get_resources parameters for the services (or resource types)
+def get_resources_parameters(services=None):
+    parameters = {'ResourcesPerPage': RESOURCES_PAGE_SIZE}
+
+    if (services):
+        parameters['ResourceTypeFilters'] = services
+
+    return parameters
+
+# Yields a row for each resource returned by the tagging API, one page at a time
+def get_resources(client, account_id, region_name, services=None):
+    paginator = client.get_paginator('get_resources')
+
+    for resource in paginator.paginate(**get_resources_parameters(services)).search('ResourceTagMappingList'):
+        yield records.ResourceRow(account_id, region_name, resource['ResourceARN'], resource.get('Tags', []))
+
+# Collector name => collector class
+COLLECTORS = {collector.name: collector for collector in [EbsCollector, HostsCollector, ResourcesCollector]}
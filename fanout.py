@@ -0,0 +1,144 @@
+import concurrent.futures
+import itertools
+import queue
+import threading
+
+# fanout
+# Helpers for running per-account work on a bounded pool of worker threads.
+
+DEFAULT_MAX_WORKERS = 8
+
+# Validates the --max-workers command-line value
+def max_workers_arg(value):
+    workers = int(value)
+
+    if (workers < 1):
+        raise ValueError("max workers must be at least 1")
+
+    return workers
+
+# Runs task(item) for every item using at most max_workers threads.
+# Yields (item, result, error) tuples in the same order the items were passed in,
+# so the merged output is deterministic regardless of which task finishes first.
+# A failing task is reported through 'error' and does not cancel the others.
+def run_all(items, task, max_workers=DEFAULT_MAX_WORKERS):
+    items = list(items)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(task, item) for item in items]
+
+        for item, future in zip(items, futures):
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_BUFFER_SIZE = 4
+
+_DONE = object()
+
+# Runs task(item) for every item using at most max_workers threads, where task returns an
+# iterable of rows. Yields (item, rows) tuples in the same order the items were passed in;
+# 'rows' is an iterator that yields each row as soon as its worker has produced it and
+# raises the worker's exception (if any) once the rows produced before the failure are read.
+# Each worker may only get buffer_size chunks of chunk_size rows ahead of the consumer,
+# so memory stays bounded no matter how many rows are produced.
+def stream_all(items, task, max_workers=DEFAULT_MAX_WORKERS,
+               chunk_size=DEFAULT_CHUNK_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+    items = list(items)
+    stopped = threading.Event()
+    queues = [queue.Queue(maxsize=buffer_size) for item in items]
+
+    # Waits for room in the queue, giving up if the consumer has gone away
+    def put(q, value):
+        while (not stopped.is_set()):
+            try:
+                q.put(value, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def produce(item, q):
+        try:
+            rows = iter(task(item))
+            chunk = list(itertools.islice(rows, chunk_size))
+
+            while (len(chunk) > 0 and not stopped.is_set()):
+                put(q, chunk)
+                chunk = list(itertools.islice(rows, chunk_size))
+
+            put(q, _DONE)
+        except Exception as e:
+            put(q, e)
+
+    def consume(q):
+        while (True):
+            chunk = q.get()
+
+            if (chunk is _DONE):
+                return
+            if (isinstance(chunk, Exception)):
+                raise chunk
+
+            yield from chunk
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item, q in zip(items, queues):
+            executor.submit(produce, item, q)
+
+        try:
+            for item, q in zip(items, queues):
+                yield item, consume(q)
+        finally:
+            stopped.set()
+
+# Runs task(item) for every item using at most max_workers threads, where task returns an
+# iterable of values. Yields (item, value) tuples as soon as any worker has produced them, so the
+# values of the different items are interleaved in the order they arrive (the values of each item
+# stay in order). The first exception raised by a task is raised once the values produced before
+# it have been read, and the other workers are stopped. At most buffer_size values are buffered.
+def merge_all(items, task, max_workers=DEFAULT_MAX_WORKERS, buffer_size=DEFAULT_BUFFER_SIZE):
+    items = list(items)
+    stopped = threading.Event()
+    q = queue.Queue(maxsize=buffer_size)
+
+    # Waits for room in the queue, giving up if the consumer has gone away
+    def put(value):
+        while (not stopped.is_set()):
+            try:
+                q.put(value, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def produce(item):
+        try:
+            for value in task(item):
+                if (stopped.is_set()):
+                    return
+
+                put((item, value))
+
+            put(_DONE)
+        except Exception as e:
+            put(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            executor.submit(produce, item)
+
+        try:
+            remaining = len(items)
+
+            while (remaining > 0):
+                value = q.get()
+
+                if (value is _DONE):
+                    remaining -= 1
+                elif (isinstance(value, Exception)):
+                    raise value
+                else:
+                    yield value
+        finally:
+            stopped.set()
@@ -0,0 +1,71 @@
+import json
+
+# filters
+# Builds the server-side filters passed to the AWS APIs (describe_* Filters and the tagging API's
+# TagFilters) from the command-line options, so that only the matching resources are returned.
+
+# Validates a --tag / --tag-filter command-line value ("KEY" or "KEY=VALUE")
+def tag_arg(value):
+    key, separator, tag_value = value.partition('=')
+
+    if (key.strip() == ""):
+        raise ValueError("tag filters must be KEY or KEY=VALUE")
+
+    return key.strip(), (tag_value if separator else None)
+
+# Validates a --ec2-filter command-line value ("NAME=VALUE,VALUE")
+def ec2_filter_arg(value):
+    name, separator, values = value.partition('=')
+
+    if (name.strip() == "" or not separator or values.strip() == ""):
+        raise ValueError("EC2 filters must be NAME=VALUE[,VALUE]")
+
+    return name.strip(), [v.strip() for v in values.split(',')]
+
+# Splits a comma-separated command-line value into a list (empty if the value is None)
+def split_list(value):
+    if (value is None):
+        return []
+
+    return [v.strip() for v in value.split(',') if v.strip() != ""]
+
+# Groups (key, value) tag filters by key. A key given without a value matches any value, otherwise
+# the resource must have one of the values given for the key.
+def _group_tags(tags):
+    grouped = {}
+
+    for key, value in tags or []:
+        values = grouped.setdefault(key, [])
+
+        if (value is None):
+            grouped[key] = None
+        elif (values is not None):
+            values.append(value)
+
+    return grouped
+
+# Returns the EC2 describe_* Filters for the given (name, values) pairs and (key, value) tag filters.
+# The values of a filter are ORed by EC2, so each tag key given without a value gets a tag-key filter
+# of its own (the filters are ANDed).
+def ec2_filters(named_filters=None, tags=None):
+    filters = {}
+
+    for name, values in named_filters or []:
+        filters.setdefault((name, None), []).extend(values)
+
+    for key, values in _group_tags(tags).items():
+        if (values is None):
+            filters[('tag-key', key)] = [key]
+        else:
+            filters.setdefault(('tag:' + key, None), []).extend(values)
+
+    return [{'Name': name, 'Values': values} for (name, tag_key), values in filters.items()]
+
+# Returns the tagging API TagFilters for the given (key, value) tag filters
+def tag_filters(tags=None):
+    return [{'Key': key} if values is None else {'Key': key, 'Values': values}
+            for key, values in _group_tags(tags).items()]
+
+# Returns a short, stable description of the filters (used to keep filtered inventories apart)
+def describe(filters):
+    return json.dumps(filters, sort_keys=True, separators=(',', ':'))
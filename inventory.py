@@ -0,0 +1,128 @@
+import datetime
+import json
+import sqlite3
+
+# inventory
+# Local SQLite store of the rows produced by the inventory scripts. Each run records the rows
+# it finds (keyed by VolumeId, HostId/slot, ...) along with the time they were scanned,
+# which allows a run to report just the rows that were added, removed or changed since the
+# previous snapshot.
+
+DEFAULT_STORE = "inventory.db"
+
+ADDED = "Added"
+REMOVED = "Removed"
+CHANGED = "Changed"
+
+class InventoryStore:
+    # kind:     The type of row being stored (e.g. 'ebs' or 'hosts')
+    # key:      Function returning the unique key of a row
+    def __init__(self, filename, kind, key):
+        self._kind = kind
+        self._key = key
+        self._connection = sqlite3.connect(filename)
+
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS scans (
+                scan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                scanned_at TEXT NOT NULL);
+
+            CREATE TABLE IF NOT EXISTS items (
+                kind TEXT NOT NULL,
+                item_key TEXT NOT NULL,
+                account_id TEXT NOT NULL,
+                region TEXT NOT NULL,
+                row TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                scan_id INTEGER NOT NULL,
+                PRIMARY KEY (kind, item_key));
+
+            CREATE INDEX IF NOT EXISTS items_scope ON items (kind, account_id, region, scan_id);
+        """)
+
+        # Record the start of this scan
+        self._scanned_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO scans (kind, scanned_at) VALUES (?, ?)", (kind, self._scanned_at))
+
+        self._scan_id = cursor.lastrowid
+
+    @property
+    def scanned_at(self):
+        return self._scanned_at
+
+    # Records the rows found for one account and region, passing them through as they are stored.
+    # If diff is True, only the rows that were added or changed since the last scan are yielded
+    # (prefixed with ADDED or CHANGED), followed by the rows that are no longer present (prefixed
+    # with REMOVED). Removed rows are only detected once all of the rows have been read, so a
+    # failed or partial scan of an account never reports its missing rows as removed.
+    #
+    # A row is only stored once the consumer has asked for the next one (i.e. has written it), and
+    # what has been stored is committed even if the scan (or the consumer) fails part way through,
+    # so the next diff neither reports the rows already written again nor misses the others.
+    def track(self, rows, account_id, region_name, diff=False):
+        try:
+            for row in rows:
+                item_key = self._key(row)
+                row_json = json.dumps(list(row))
+                change = self._change(item_key, row_json)
+
+                if (not diff):
+                    yield row
+                elif (change is not None):
+                    yield [change] + list(row)
+
+                self._record(item_key, row_json, change, account_id, region_name)
+
+            for item_key, row in self._unseen(account_id, region_name):
+                if (diff):
+                    yield [REMOVED] + row
+
+                self._connection.execute(
+                    "DELETE FROM items WHERE kind = ? AND item_key = ?", (self._kind, item_key))
+        finally:
+            self._connection.commit()
+
+    # Returns ADDED, CHANGED or None (unchanged) for the row with the key
+    def _change(self, item_key, row_json):
+        existing = self._connection.execute(
+            "SELECT row FROM items WHERE kind = ? AND item_key = ?", (self._kind, item_key)).fetchone()
+
+        if (existing is None):
+            return ADDED
+
+        return CHANGED if (existing[0] != row_json) else None
+
+    # Stores the row, as last seen by this scan
+    def _record(self, item_key, row_json, change, account_id, region_name):
+        if (change == ADDED):
+            self._connection.execute(
+                "INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._kind, item_key, account_id, region_name, row_json,
+                 self._scanned_at, self._scanned_at, self._scan_id))
+            return
+
+        self._connection.execute(
+            "UPDATE items SET account_id = ?, region = ?, row = ?, last_seen = ?, scan_id = ? "
+            "WHERE kind = ? AND item_key = ?",
+            (account_id, region_name, row_json, self._scanned_at, self._scan_id, self._kind, item_key))
+
+    # Returns the (key, row) of each stored row for the account and region that this scan did not see
+    def _unseen(self, account_id, region_name):
+        scope = (self._kind, account_id, region_name, self._scan_id)
+
+        return [(item_key, json.loads(row)) for item_key, row in self._connection.execute(
+            "SELECT item_key, row FROM items WHERE kind = ? AND account_id = ? AND region = ? AND scan_id <> ?",
+            scope)]
+
+    # Returns the (account ID, region) pairs with rows in the store
+    def scopes(self):
+        return [tuple(scope) for scope in self._connection.execute(
+            "SELECT DISTINCT account_id, region FROM items WHERE kind = ?", (self._kind,))]
+
+    def close(self):
+        self._connection.close()
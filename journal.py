@@ -0,0 +1,140 @@
+import json
+import os
+
+# journal
+# Append-only journal of a tagging run, so that a run which fails partway through (an error,
+# throttling or expired credentials) can be resumed without repeating the work already done.
+# Each line is a JSON object recording, for one account and region, the run's parameters, the
+# final row of each resource (tagged, failed, already tagged or skipped in 'what if' mode) and
+# the pagination token from which the resources still to be done can be listed again (for each
+# shard, when the resources are listed in several independent shards). The resources whose tagging
+# failed are recorded too, but are not done: a resumed run tags them again.
+
+# Outcomes (the error code of the row) of the resources that need nothing more done: tagged,
+# already tagged and not tagged in 'what if' mode
+DONE_ERROR_CODES = ('Ok', 'Already Tagged', 'No Op')
+
+class Journal:
+    # resume:   If True, the entries already in the file are loaded and added to, otherwise
+    #           the file is started afresh
+    def __init__(self, filename, resume=False):
+        self._filename = filename
+        self._entries = []
+
+        if (resume and os.path.exists(filename)):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        self._entries.append(json.loads(line))
+                    except ValueError:
+                        break # A partially written line (the run stopped while writing it)
+
+        self._file = open(filename, 'a' if resume else 'w')
+
+    @property
+    def filename(self):
+        return self._filename
+
+    # Returns the journal of the given account and region. Raises ValueError if the journal
+    # being resumed was written by a run with different parameters.
+    def start(self, account_id, region_name, parameters):
+        key = "{0}/{1}".format(account_id, region_name)
+        entries = [entry for entry in self._entries if entry['key'] == key]
+
+        if (len(entries) > 0 and entries[0]['parameters'] != parameters):
+            raise ValueError("the journal for account {0} in {1} was written with different options: {2}".format(
+                account_id, region_name, json.dumps(entries[0]['parameters'])))
+
+        if (len(entries) == 0):
+            self._write({'key': key, 'type': 'start', 'parameters': parameters})
+
+        return AccountJournal(self, key, entries)
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry))
+        self._file.write("\n")
+
+    # Hands the entries written so far to the operating system, so they survive the process
+    # stopping (the file is not fsync'ed, as that would slow every page down)
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+# The journal of a single account and region
+class AccountJournal:
+    def __init__(self, journal, key, entries):
+        self._journal = journal
+        self._key = key
+        self._completed = {}
+        self._failed = {}
+        self._checkpoint_tokens = {}
+        self._finished = False
+
+        for entry in entries:
+            if (entry['type'] == 'row'):
+                self._add(entry['row'])
+            elif (entry['type'] == 'checkpoint'):
+                self._checkpoint_tokens[entry.get('shard')] = entry['token']
+            elif (entry['type'] == 'finish'):
+                self._finished = True
+
+    # Resource ARN => final row of each resource already done
+    @property
+    def completed(self):
+        return self._completed
+
+    # Resource ARN => row of each resource whose tagging failed (and has not been done since)
+    @property
+    def failed(self):
+        return self._failed
+
+    # The pagination token to resume listing resources from (None for the first page)
+    @property
+    def checkpoint_token(self):
+        return self._checkpoint_tokens.get(None)
+
+    # Returns the pagination token to resume listing the resources of the shard from (None for the
+    # first page)
+    def shard_checkpoint_token(self, shard):
+        return self._checkpoint_tokens.get(shard)
+
+    # True if every resource has been listed (and tagged, unless its tagging failed)
+    @property
+    def finished(self):
+        return self._finished
+
+    # Records the final row of each resource (a list or records.TagResultRow, with the resource ARN in row[4])
+    def record(self, rows):
+        for row in rows:
+            self._add(row)
+            self._journal._write({'key': self._key, 'type': 'row', 'row': list(row)})
+
+        self._journal.flush()
+
+    def _add(self, row):
+        if (row[1] in DONE_ERROR_CODES):
+            self._completed[row[4]] = row
+            self._failed.pop(row[4], None)
+        else:
+            self._failed[row[4]] = row
+            self._completed.pop(row[4], None)
+
+    # Records that every resource (of the shard, if given) before the page with the given token
+    # has been done
+    def checkpoint(self, token, shard=None):
+        if (token != self._checkpoint_tokens.get(shard)):
+            self._checkpoint_tokens[shard] = token
+            entry = {'key': self._key, 'type': 'checkpoint', 'token': token}
+
+            if (shard is not None):
+                entry['shard'] = shard
+
+            self._journal._write(entry)
+            self._journal.flush()
+
+    def finish(self):
+        self._finished = True
+        self._journal._write({'key': self._key, 'type': 'finish'})
+        self._journal.flush()
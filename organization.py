@@ -0,0 +1,241 @@
+import account
+import boto3
+import botocore.credentials
+import collections
+import datetime
+import filters
+import json
+import os
+import threading
+
+# organization
+# Covers every account of an AWS Organization without a profile per account. The member accounts
+# are listed with the Organizations API (from the management account, or a delegated administrator
+# account) and a role is assumed in each of them. The temporary credentials are kept in memory and
+# on disk until shortly before they expire, and are refreshed automatically during long runs, so
+# repeated runs against hundreds of accounts make few AssumeRole calls. The scripts resolve their
+# accounts on worker threads, so the AssumeRole calls that are needed are made concurrently.
+
+# Role created in every member account by AWS Organizations
+DEFAULT_ROLE_NAME = "OrganizationAccountAccessRole"
+
+ROLE_SESSION_NAME = "aws-buddy"
+
+# Location of the on-disk credential cache (in the account ID cache's directory)
+CREDENTIALS_CACHE_FILE = os.path.join(account.CACHE_DIR, 'credentials.json')
+
+# Number of seconds before they expire that credentials are refreshed (botocore's advisory refresh
+# time, so credentials handed to botocore are never refreshed again straight away)
+REFRESH_MARGIN = 15 * 60
+
+# A member account of the organization, to be accessed from the source account (account.Account)
+class Member(collections.namedtuple('Member', ['account_id', 'name', 'source_account'])):
+    def __str__(self):
+        return "{0} ({1})".format(self.account_id, self.name)
+
+# Temporary credentials, keyed by the source credentials, account and role, kept in memory and in
+# a file that only the user can read. Credentials expiring within REFRESH_MARGIN are not returned.
+class CredentialCache:
+    def __init__(self, filename=CREDENTIALS_CACHE_FILE):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._credentials = None
+
+    # Returns the credentials (as botocore credential metadata) cached for the key, or None
+    def get(self, key):
+        with self._lock:
+            metadata = self._load().get(key)
+
+        if (metadata is None or _seconds_left(metadata) <= REFRESH_MARGIN):
+            return None
+
+        return metadata
+
+    # Saves the credentials (botocore credential metadata) for the key
+    def put(self, key, metadata):
+        with self._lock:
+            credentials = self._load()
+            credentials[key] = metadata
+
+            # Leave out the credentials that have expired
+            for expired_key in [k for k, m in credentials.items() if (_seconds_left(m) <= 0)]:
+                del credentials[expired_key]
+
+            try:
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+
+                # Write to a temporary file first so a crash never leaves a partial cache behind
+                temp_file = '{0}.{1}.tmp'.format(self._filename, os.getpid())
+
+                with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                    json.dump(credentials, f)
+
+                os.replace(temp_file, self._filename)
+            except OSError:
+                pass # The on-disk cache is only an optimization
+
+    def _load(self):
+        if (self._credentials is None):
+            try:
+                with open(self._filename) as f:
+                    self._credentials = json.load(f)
+            except (OSError, ValueError):
+                self._credentials = {}
+
+        return self._credentials
+
+# Returns the number of seconds until the credentials (botocore credential metadata) expire
+def _seconds_left(metadata):
+    expiry_time = datetime.datetime.fromisoformat(metadata['expiry_time'])
+
+    return (expiry_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+DEFAULT_CREDENTIAL_CACHE = CredentialCache()
+
+# Provides the credentials of an assumed role to a botocore session (through its credential
+# resolver), starting with the given credential metadata and refreshing them before they expire
+class RoleCredentialProvider(botocore.credentials.CredentialProvider):
+    METHOD = 'assume-role-organization'
+    CANONICAL_NAME = 'AssumeRoleOrganization'
+
+    # refresh: returns up to date credential metadata
+    def __init__(self, metadata, refresh):
+        super().__init__()
+        self._metadata = metadata
+        self._refresh = refresh
+
+    def load(self):
+        return botocore.credentials.RefreshableCredentials.create_from_metadata(
+            self._metadata, self._refresh, self.METHOD)
+
+# An account accessed by assuming a role in it from a source account (account.Account). The
+# account ID is already known, so STS is not asked for it, and the role's credentials are taken
+# from the credential cache if possible, otherwise from AssumeRole (when the account is created).
+class RoleAccount(account.Account):
+    def __init__(self, member, role_name, region_name, credential_cache=DEFAULT_CREDENTIAL_CACHE):
+        self._member = member
+        self._role_name = role_name
+        self._credential_cache = credential_cache
+
+        metadata = self._credential_metadata()
+
+        # Let botocore refresh the credentials (from the cache, or with AssumeRole) before they expire
+        region_name = region_name or member.source_account.region_name
+        botocore_session = account.create_botocore_session()
+        botocore_session.get_component('credential_provider').insert_before(
+            'env', RoleCredentialProvider(metadata, self._credential_metadata))
+
+        super().__init__(member.source_account.profile_name, region_name,
+                         boto3.session.Session(botocore_session=botocore_session, region_name=region_name))
+
+        self._account_id = member.account_id
+
+    @property
+    def account_name(self):
+        return self._member.name
+
+    # The account ID is already known
+    @property
+    def account_key(self):
+        return self._member.account_id
+
+    @property
+    def role_arn(self):
+        return "arn:aws:iam::{0}:role/{1}".format(self._member.account_id, self._role_name)
+
+    # Identifies the role and the credentials it is assumed with (None if those credentials cannot
+    # be identified, see account.Account.cache_key)
+    @property
+    def cache_key(self):
+        source_key = self._member.source_account.cache_key
+
+        if (source_key is None):
+            return None
+
+        return "role:{0}:{1}".format(source_key, self.role_arn)
+
+    # Used by the clients that are not created from the session (e.g. by aiofanout) to refresh
+    # the credentials
+    @property
+    def credential_source(self):
+        return self._credential_metadata
+
+    # Returns the role's credentials (as botocore credential metadata): from the credential cache
+    # if possible, otherwise from AssumeRole
+    def _credential_metadata(self):
+        metadata = self._credential_cache.get(self.cache_key) if (self.cache_key is not None) else None
+
+        if (metadata is None):
+            metadata = self._assume_role()
+
+        return metadata
+
+    # Assumes the role, caching and returning its credentials (as botocore credential metadata)
+    def _assume_role(self):
+        response = self._member.source_account.client('sts').assume_role(RoleArn=self.role_arn,
+                                                                         RoleSessionName=ROLE_SESSION_NAME)
+        credentials = response['Credentials']
+
+        metadata = {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+        if (self.cache_key is not None):
+            self._credential_cache.put(self.cache_key, metadata)
+
+        return metadata
+
+# Returns the active accounts of the organization (Members) listed with the source account
+# (account.Account), in account ID order. If account IDs are given only those accounts are
+# returned, and any excluded account IDs are left out.
+def list_members(source_account, account_ids=None, exclude=None):
+    paginator = source_account.client('organizations').get_paginator('list_accounts')
+    members = []
+
+    for organization_account in paginator.paginate().search('Accounts'):
+        account_id = organization_account['Id']
+
+        if (organization_account.get('Status', 'ACTIVE') != 'ACTIVE'):
+            continue
+
+        if ((account_ids and account_id not in account_ids) or (exclude and account_id in exclude)):
+            continue
+
+        members.append(Member(account_id, organization_account.get('Name', ''), source_account))
+
+    return sorted(members, key=lambda member: member.account_id)
+
+# Adds the --org-role, --org-accounts and --org-exclude command-line arguments
+def add_arguments(parser):
+    parser.add_argument(
+        "--org-role", help="List the accounts of the organization with the profile (the management or a delegated administrator account) and assume this role in each of them (e.g. {0}) instead of using a profile per account.".format(DEFAULT_ROLE_NAME), dest="org_role")
+
+    parser.add_argument(
+        "--org-accounts", help="With --org-role, only process these member accounts (comma-separated account IDs).", dest="org_accounts")
+
+    parser.add_argument(
+        "--org-exclude", help="With --org-role, skip these member accounts (comma-separated account IDs).", dest="org_exclude")
+
+# Checks the --org-role command-line arguments
+def check_arguments(parser, args):
+    if (args.org_role is not None and args.profile is not None and len(args.profile.split(',')) > 1):
+        parser.error("--org-role takes a single profile (the account the organization is listed with)")
+
+# Returns the profile names, or with --org-role the member accounts, to be processed
+def get_profiles(args):
+    if (args.org_role is None):
+        return [None] if (args.profile is None) else [p.strip() for p in args.profile.split(',')]
+
+    source_account = account.Account(args.profile, args.region)
+
+    return list_members(source_account, filters.split_list(args.org_accounts), filters.split_list(args.org_exclude))
+
+# Returns the account for a profile name, or a member account (Member) when using --org-role
+def open_account(profile, args):
+    if (isinstance(profile, Member)):
+        return RoleAccount(profile, args.org_role, args.region)
+
+    return account.Account(profile, args.region)
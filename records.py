@@ -0,0 +1,205 @@
+import arns
+import operator
+import sys
+
+# records
+# Compact row records for the volume, host and tagging rows. A million-row inventory held as
+# lists of strings and dictionaries costs gigabytes, so each record keeps its values in
+# __slots__, repeated values (account IDs, regions, types, tag keys, ...) are interned so that
+# every row shares a single copy, tags are kept as a tuple of (key, value) pairs, and ARNs are
+# only formatted when they are read. Records behave like the lists they replace: they can be
+# iterated (in FIELDS order), indexed and measured with len(), so the writers and the inventory
+# store consume them directly.
+
+# Returns the single, shared copy of a repeated string value
+def intern(value):
+    return sys.intern(value) if (type(value) is str) else value
+
+# Returns the tags (a list of {'Key': ..., 'Value': ...} or a dictionary) as a tuple of
+# (key, value) pairs, interning the keys
+def compact_tags(tags):
+    if (isinstance(tags, dict)):
+        tags = tags.items()
+    else:
+        tags = [(tag['Key'], tag['Value']) for tag in tags]
+
+    return tuple([(sys.intern(key), value) for key, value in tags])
+
+class Record:
+    __slots__ = ()
+
+    # The names of the values (attributes or properties) of the record, in column order
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._values = operator.attrgetter(*cls.FIELDS)
+
+    def __iter__(self):
+        return iter(self._values(self))
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            return list(self._values(self))[index]
+
+        return getattr(self, self.FIELDS[index])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, list(self))
+
+# Returns the ARN of an EC2 instance or volume
+def _ec2_arn(region_name, account_id, resource_type, resource_id):
+    return "arn:aws:ec2:{0}:{1}:{2}/{3}".format(region_name, account_id, resource_type, resource_id)
+
+# A row of aws-list-ebs. The Availability Zone is not written, but is kept for the summary.
+class VolumeRow(Record):
+    __slots__ = ('account_id', 'region_name', 'instance_id', 'volume_id', 'name', 'device', 'drive',
+                 'volume_type', 'size', 'iops', 'state', '_tags', 'availability_zone')
+
+    FIELDS = ('account_id', 'region_name', 'ec2_arn', 'instance_id', 'volume_arn', 'volume_id', 'name',
+              'device', 'drive', 'volume_type', 'size', 'iops', 'state', 'tags')
+
+    def __init__(self, account_id, region_name, instance_id, volume_id, name, device, drive,
+                 volume_type, size, iops, state, tags, availability_zone=''):
+        self.account_id = intern(account_id)
+        self.region_name = intern(region_name)
+        self.instance_id = instance_id
+        self.volume_id = volume_id
+        self.name = name
+        self.device = intern(device)
+        self.drive = intern(drive)
+        self.volume_type = intern(volume_type)
+        self.size = size
+        self.iops = iops
+        self.state = intern(state)
+        self._tags = compact_tags(tags)
+        self.availability_zone = intern(availability_zone)
+
+    @property
+    def ec2_arn(self):
+        return _ec2_arn(self.region_name, self.account_id, "instance", self.instance_id)
+
+    @property
+    def volume_arn(self):
+        return _ec2_arn(self.region_name, self.account_id, "volume", self.volume_id)
+
+    @property
+    def tags(self):
+        return dict(self._tags)
+
+# A row of aws-list-dedicated-hosts (one per instance on a host, or one for an empty host). The
+# capacity columns are those of the host's first instance type, but every (instance type, total,
+# available) capacity entry of the host is kept (shared by the host's rows) for the summary, along
+# with the position of the row on its host (its slot, 0 for an empty host), which is not written.
+class HostRow(Record):
+    __slots__ = ('account_id', 'region_name', 'host_id', 'host_name', 'host_reservation_id',
+                 'availability_zone', 'total_instance_capacity', 'available_instance_capacity',
+                 'instance_type', 'available_vcpus', 'instance_id', 'instance_name', 'ec2_instance_type',
+                 'capacity', 'slot')
+
+    FIELDS = ('account_id', 'region_name', 'host_id', 'host_name', 'host_reservation_id',
+              'availability_zone', 'total_instance_capacity', 'available_instance_capacity',
+              'instance_type', 'available_vcpus', 'instance_id', 'ec2_arn', 'instance_name', 'ec2_instance_type')
+
+    def __init__(self, account_id, region_name, host_id, host_name, host_reservation_id,
+                 availability_zone, total_instance_capacity, available_instance_capacity,
+                 instance_type, available_vcpus, instance_id='', instance_name='', ec2_instance_type='', capacity=(), slot=0):
+        self.account_id = intern(account_id)
+        self.region_name = intern(region_name)
+        self.host_id = host_id
+        self.host_name = host_name
+        self.host_reservation_id = intern(host_reservation_id)
+        self.availability_zone = intern(availability_zone)
+        self.total_instance_capacity = total_instance_capacity
+        self.available_instance_capacity = available_instance_capacity
+        self.instance_type = intern(instance_type)
+        self.available_vcpus = available_vcpus
+        self.instance_id = instance_id
+        self.instance_name = instance_name
+        self.ec2_instance_type = intern(ec2_instance_type)
+        self.capacity = capacity
+        self.slot = slot
+
+    @property
+    def ec2_arn(self):
+        if (self.instance_id == ''):
+            return ''
+
+        return _ec2_arn(self.region_name, self.account_id, "instance", self.instance_id)
+
+# A row of aws-tag-resources. The service, region, resource type and resource ID are taken from
+# the resource ARN (by the memoized arns.parse) when they are read.
+class TagResultRow(Record):
+    __slots__ = ('status_code', 'error_code', 'error_message', 'account_id', 'resource_arn', '_tags')
+
+    FIELDS = ('status_code', 'error_code', 'error_message', 'account_id', 'resource_arn', 'resource_id',
+              'service', 'region_name', 'resource_type', 'tags')
+
+    def __init__(self, account_id, resource_arn, tags, status_code=0, error_code="No Op", error_message=""):
+        self.status_code = status_code
+        self.error_code = intern(error_code)
+        self.error_message = error_message
+        self.account_id = intern(account_id)
+        self.resource_arn = resource_arn
+        self._tags = compact_tags(tags)
+
+    # Records the outcome of tagging the resource
+    def set_status(self, status_code, error_code, error_message=""):
+        self.status_code = status_code
+        self.error_code = intern(error_code)
+        self.error_message = error_message
+
+    @property
+    def service(self):
+        return arns.parse(self.resource_arn).service
+
+    @property
+    def region_name(self):
+        return arns.parse(self.resource_arn).region
+
+    @property
+    def resource_type(self):
+        return arns.parse(self.resource_arn).resource_type
+
+    @property
+    def resource_id(self):
+        return arns.parse(self.resource_arn).resource_id
+
+    @property
+    def tags(self):
+        return dict(self._tags)
+
+# A resource listed by the tagging API (aws-inventory). The service, resource type and resource ID
+# are taken from the resource ARN when they are read.
+class ResourceRow(Record):
+    __slots__ = ('account_id', 'region_name', 'resource_arn', '_tags')
+
+    FIELDS = ('account_id', 'region_name', 'resource_arn', 'service', 'resource_type', 'resource_id', 'tags')
+
+    def __init__(self, account_id, region_name, resource_arn, tags):
+        self.account_id = intern(account_id)
+        self.region_name = intern(region_name)
+        self.resource_arn = resource_arn
+        self._tags = compact_tags(tags)
+
+    @property
+    def service(self):
+        return arns.parse(self.resource_arn).service
+
+    @property
+    def resource_type(self):
+        return arns.parse(self.resource_arn).resource_type
+
+    @property
+    def resource_id(self):
+        return arns.parse(self.resource_arn).resource_id
+
+    @property
+    def tags(self):
+        return dict(self._tags)
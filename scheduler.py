@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+
+# scheduler
+# Shared rate limiting and retry scheduling for the AWS clients created by account.Account.
+# Every (account, region, API operation) gets its own token bucket whose rate adapts to the
+# throttling responses received: it grows steadily while calls succeed and is cut back
+# whenever AWS throttles a call, which keeps concurrent runs close to the service quota.
+
+# Error codes AWS uses to signal that a call was throttled
+THROTTLING_ERROR_CODES = set([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestThrottled',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'BandwidthLimitExceeded',
+    'SlowDown'
+])
+
+DEFAULT_INITIAL_RATE = 10.0    # Calls per second before any feedback has been received
+DEFAULT_MIN_RATE = 0.5         # Calls per second never to drop below
+DEFAULT_MAX_RATE = 100.0       # Calls per second never to exceed
+DEFAULT_MAX_ATTEMPTS = 10      # Attempts (including the first) before a throttled call fails
+DEFAULT_BASE_DELAY = 0.2       # Seconds; backoff doubles with each attempt
+DEFAULT_MAX_DELAY = 20.0       # Seconds; upper bound on a single backoff
+
+# Token bucket with an adaptive (additive increase, multiplicative decrease) fill rate
+class TokenBucket:
+    def __init__(self, rate, min_rate, max_rate):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    # Blocks until a token is available and takes it
+    def acquire(self):
+        while (True):
+            with self._lock:
+                now = time.monotonic()
+                capacity = max(1.0, self._rate)
+
+                self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+
+                if (self._tokens >= 1.0):
+                    self._tokens -= 1.0
+                    return
+
+                wait = (1.0 - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+    # Speeds up gradually after a successful call
+    def on_success(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + 1.0 / max(1.0, self._rate))
+
+    # Backs off sharply after a throttled call
+    def on_throttle(self):
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate * 0.5)
+            self._tokens = min(self._tokens, 0.0)
+
+# Hands out tokens and retry delays for all of the clients attached to it
+class Scheduler:
+    def __init__(self, initial_rate=DEFAULT_INITIAL_RATE, min_rate=DEFAULT_MIN_RATE,
+                 max_rate=DEFAULT_MAX_RATE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._counters = {}
+        self._initial_rate = initial_rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    # Returns the token bucket for the key, creating it on first use
+    def bucket(self, key):
+        with self._lock:
+            if (key not in self._buckets):
+                self._buckets[key] = TokenBucket(self._initial_rate, self._min_rate, self._max_rate)
+
+            return self._buckets[key]
+
+    # Returns a copy of the counters (calls, throttles, retries, failures) for each key
+    def counters(self):
+        with self._lock:
+            return {key: dict(counts) for key, counts in self._counters.items()}
+
+    def _count(self, key, name):
+        with self._lock:
+            counts = self._counters.setdefault(key, {'calls': 0, 'throttles': 0, 'retries': 0, 'failures': 0})
+            counts[name] += 1
+
+    # Returns the (jittered) number of seconds to wait before the given attempt is retried
+    def backoff(self, attempts):
+        return random.uniform(0, min(self._max_delay, self._base_delay * (2 ** attempts)))
+
+    # Hooks the client's events so that every attempt waits for a token from the bucket for its
+    # (account, region, operation) and throttled attempts are retried with backoff
+    def attach(self, client, account_key):
+        region_name = client.meta.region_name
+
+        def key_for(event_name):
+            # Event names look like 'before-send.ec2.DescribeVolumes'
+            return (account_key, region_name, event_name.split('.')[-1])
+
+        def before_send(event_name, **kwargs):
+            key = key_for(event_name)
+
+            self._count(key, 'calls')
+            self.bucket(key).acquire()
+
+        def needs_retry(event_name, response, attempts, **kwargs):
+            key = key_for(event_name)
+
+            if (not is_throttled(response)):
+                if (response is not None):
+                    self.bucket(key).on_success()
+                return None
+
+            self._count(key, 'throttles')
+            self.bucket(key).on_throttle()
+
+            if (attempts >= self._max_attempts):
+                self._count(key, 'failures')
+                return None
+
+            self._count(key, 'retries')
+            return self.backoff(attempts)
+
+        client.meta.events.register('before-send', before_send)
+
+        # Registered first so throttling is handled here rather than by botocore's own retry handler
+        client.meta.events.register_first('needs-retry', needs_retry)
+
+        return client
+
+    # Displays the call, throttle and retry counts for each (account, region, operation)
+    def display_stats(self):
+        counters = self.counters()
+
+        if (len(counters) == 0):
+            return
+
+        print("API calls (account / region / operation: calls, throttles, retries, failures)")
+
+        for key in sorted(counters, key=lambda k: tuple(str(part) for part in k)):
+            counts = counters[key]
+            print("  {0} / {1} / {2}: {3}, {4}, {5}, {6} (rate {7:.1f}/s)".format(
+                key[0], key[1], key[2], counts['calls'], counts['throttles'],
+                counts['retries'], counts['failures'], self.bucket(key).rate))
+
+        print("")
+
+# Returns True if the (http_response, parsed) response tuple is a throttling error
+def is_throttled(response):
+    if (response is None):
+        return False
+
+    http_response, parsed = response
+    error_code = parsed.get('Error', {}).get('Code')
+
+    return (error_code in THROTTLING_ERROR_CODES) or (http_response.status_code == 429)
+
+# The scheduler shared by every client created through account.Account
+DEFAULT_SCHEDULER = Scheduler()
@@ -0,0 +1,177 @@
+import array
+import tracing
+import writers
+
+# summary
+# Rollups of the EBS volume and Dedicated Host rows (--summary), written next to the detail output.
+# The rows are tallied as they stream past on their way to the detail output, so the summary takes
+# no extra pass over the data and no memory per row: the totals of all of the groups are kept in
+# typed arrays (one per measure, indexed by group) rather than in an object per group.
+
+# Account ID of the groups totalled over every account
+ALL_ACCOUNTS = "(all)"
+
+# Returns the filename of the summary written next to the detail output (e.g. volumes.csv becomes
+# volumes.summary.csv)
+def summary_filename(filename, output_format):
+    extension = '.' + output_format
+
+    if (filename.lower().endswith(extension)):
+        return filename[:-len(extension)] + '.summary' + filename[-len(extension):]
+
+    return filename + '.summary'
+
+# Totals of a number of measures for any number of groups
+class Rollup:
+    def __init__(self, measure_count, typecode='d'):
+        self._groups = {}
+        self._totals = [array.array(typecode) for i in range(measure_count)]
+
+    # Adds the values (one per measure) to the totals of the group
+    def add(self, group, values):
+        index = self._groups.get(group)
+
+        if (index is None):
+            index = len(self._groups)
+            self._groups[group] = index
+
+            for totals in self._totals:
+                totals.append(0)
+
+        for totals, value in zip(self._totals, values):
+            totals[index] += value
+
+    # Yields each group along with its totals, in group order (or in the order of the sort key of
+    # the groups)
+    def items(self, key=None):
+        for group, index in sorted(self._groups.items(), key=lambda item: item[0] if (key is None) else key(item[0])):
+            yield group, [totals[index] for totals in self._totals]
+
+# Summary rows are grouped by (group by, account ID, value), where 'group by' is one of the
+# dimensions, which are listed in the order their rows are written
+class Summary:
+    field_names = []
+
+    dimensions = []
+
+    # Returns the key by which the rows of the group are sorted
+    def _sort_key(self, group):
+        return (self.dimensions.index(group[0]),) + group
+
+    # Adds the row to the totals
+    def add(self, row):
+        raise NotImplementedError()
+
+    # Returns the summary rows
+    def rows(self):
+        raise NotImplementedError()
+
+    # Yields the rows, adding each one to the totals as it passes
+    def tap(self, rows):
+        for row in rows:
+            self.add(row)
+            yield row
+
+    # Writes the summary next to the detail output
+    def write(self, filename, output_format):
+        filename = summary_filename(filename, output_format)
+
+        with tracing.DEFAULT_TRACER.phase('write summary'):
+            writers.write_file(filename, self.rows(), self.field_names, output_format)
+
+# Volumes, size and IOPS of the EBS volumes (records.VolumeRow) of each account (and of all of
+# them), in total and by volume type, Availability Zone and attachment state. Each row is only
+# added to the totals of its (account, type, Availability Zone, attachment state) group, which are
+# rolled up into the totals of each dimension when the summary is written.
+class VolumeSummary(Summary):
+    field_names = ['Group By', 'Account ID', 'Value', 'Volumes', 'Size (GiB)', 'IOPS']
+
+    dimensions = ['Total', 'Type', 'Availability Zone', 'Attachment State']
+
+    def __init__(self):
+        self._rollup = Rollup(3, 'q')
+
+    def add(self, row):
+        self._rollup.add((row.account_id, row.volume_type, row.availability_zone, row.state or 'unattached'),
+                         (1, row.size or 0, row.iops or 0))
+
+    def rows(self):
+        dimensions = Rollup(3, 'q')
+
+        for (account_id, volume_type, availability_zone, state), totals in self._rollup.items():
+            for group_account_id in (account_id, ALL_ACCOUNTS):
+                dimensions.add(('Total', group_account_id, ''), totals)
+                dimensions.add(('Type', group_account_id, volume_type), totals)
+                dimensions.add(('Availability Zone', group_account_id, availability_zone), totals)
+                dimensions.add(('Attachment State', group_account_id, state), totals)
+
+        return [list(group) + list(totals) for group, totals in dimensions.items(self._sort_key)]
+
+# Hosts, instances, capacity and packing efficiency of the Dedicated Hosts (records.HostRow) of each
+# account (and of all of them), in total and by instance type. Every capacity entry of a host counts,
+# not just the first one. By instance type, the packing efficiency is the share of the capacity for
+# that type that is used. In total, it is the average over the hosts of the share of each host that
+# is used, taken from whichever of its capacity entries has the least room left (so the part of a
+# host that no longer fits a larger instance type counts as used).
+class HostSummary(Summary):
+    field_names = ['Group By', 'Account ID', 'Value', 'Hosts', 'Instances', 'Total Capacity', 'Used Capacity',
+                   'Available Capacity', 'Packing Efficiency (%)', 'Available vCPUs']
+
+    dimensions = ['Total', 'Instance Type']
+
+    def __init__(self):
+        # Hosts, instances, total, used and available capacity, sum of the host usage and available
+        # vCPUs of each (group by, account ID, value) group
+        self._rollup = Rollup(7)
+        self._hosts = set()
+
+    def add(self, row):
+        add = self._rollup.add
+
+        if (row.instance_id != ''):
+            add(('Instance Type', row.account_id, row.ec2_instance_type), (0, 1))
+
+        # A host has a row for each of its instances, but its capacity is only counted once
+        host_key = (row.account_id, row.host_id)
+
+        if (host_key in self._hosts):
+            return
+
+        self._hosts.add(host_key)
+
+        usage = max([(total - available) / total for instance_type, total, available in row.capacity if (total > 0)],
+                    default=0)
+
+        add(('Total', row.account_id, ''), (1, 0, 0, 0, 0, usage, row.available_vcpus or 0))
+
+        for instance_type, total, available in row.capacity:
+            add(('Instance Type', row.account_id, instance_type), (1, 0, total, total - available, available))
+
+    def rows(self):
+        groups = Rollup(7)
+        instances = {}
+
+        for (group_by, account_id, value), totals in self._rollup.items():
+            for group_account_id in (account_id, ALL_ACCOUNTS):
+                groups.add((group_by, group_account_id, value), totals)
+
+                if (group_by == 'Instance Type'):
+                    instances[group_account_id] = instances.get(group_account_id, 0) + totals[1]
+
+        rows = []
+
+        for (group_by, account_id, value), totals in groups.items(self._sort_key):
+            hosts, instance_count, total, used, available, usage, vcpus = totals
+
+            if (group_by == 'Total'):
+                # Capacity is counted in instances of different sizes, so it is only totalled by type
+                rows.append([group_by, account_id, value, int(hosts), int(instances.get(account_id, 0)), '', '', '',
+                             round(100 * usage / hosts, 1) if (hosts > 0) else '', int(vcpus)])
+            else:
+                rows.append([group_by, account_id, value, int(hosts), int(instance_count), int(total), int(used),
+                             int(available), round(100 * used / total, 1) if (total > 0) else '', ''])
+
+        return rows
+
+# Summary class for each collector (of aws-inventory) that has one
+SUMMARIES = {'ebs': VolumeSummary, 'hosts': HostSummary}
@@ -0,0 +1,76 @@
+import csv
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+import cassette
+import writers
+
+# test_cassette
+# Replays a cassette with aws-list-ebs on a "machine" with no AWS configuration at all (no config or
+# credentials files, no access key and an unknown AWS_PROFILE). The cassette is recorded from the
+# synthetic stand-in for the AWS APIs used by the benchmark.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ACCOUNT_ID = '123456789012'
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.cassettes = os.path.join(self._directory.name, 'cassettes')
+
+        # Record the volumes of the 'test' profile, as `aws-list-ebs.py -p test --record DIR` would
+        cassettes = cassette.Cassettes()
+        cassettes.record(self.cassettes)
+        cassettes.add_account('profile:test', ACCOUNT_ID, 'us-east-1')
+
+        module = importlib.import_module('aws-list-ebs')
+        client = cassettes.attach(benchmark.SyntheticAWS(250, ACCOUNT_ID).client('ec2'), lambda: ACCOUNT_ID)
+        recorded = os.path.join(self._directory.name, 'recorded.csv')
+
+        writers.write_file(recorded, module.get_ebs_volume_details(client, ACCOUNT_ID, 'us-east-1'),
+                           module.FIELD_NAMES)
+        cassettes.close()
+
+        self.rows = self.read_rows(recorded)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    # Runs aws-list-ebs with the arguments and no AWS configuration, returning the rows written
+    def replay(self, *arguments):
+        output = os.path.join(self._directory.name, 'volumes.csv')
+        missing = os.path.join(self._directory.name, 'missing')
+        env = {key: value for key, value in os.environ.items() if (not key.startswith('AWS_'))}
+        env.update({
+            'AWS_CONFIG_FILE': missing,
+            'AWS_SHARED_CREDENTIALS_FILE': missing,
+            'AWS_PROFILE': 'unknown',
+            'AWS_BUDDY_CACHE_DIR': missing,
+            'HOME': missing
+        })
+
+        subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'aws-list-ebs.py'), '-p', 'test',
+                        '--replay', self.cassettes, '-o', output] + list(arguments),
+                       env=env, cwd=self._directory.name, stdout=subprocess.PIPE, check=True)
+
+        return self.read_rows(output)
+
+    def read_rows(self, filename):
+        with open(filename, newline='') as f:
+            return list(csv.reader(f))[1:]
+
+    def test_replay_without_aws_configuration(self):
+        self.assertEqual(len(self.rows), 250)
+        self.assertEqual(self.replay(), self.rows)
+
+    def test_replay_with_region(self):
+        self.assertEqual(self.replay('-r', 'us-east-1'), self.rows)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import importlib
+import unittest
+
+import benchmark
+import botocore.exceptions
+
+# test_tag_async
+# Tags the resources of the synthetic stand-in for the AWS APIs used by the benchmark with
+# aws-tag-resources' asyncio path, through a stand-in for aiofanout.ClientPool that answers with the
+# (synchronous) synthetic clients, and checks a failed batch does not lose the outcomes of the others.
+
+ACCOUNT_ID = '123456789012'
+
+class StubClientPool:
+    def __init__(self, synthetic, failed_batches=()):
+        self._synthetic = synthetic
+        self._clients = {}
+        self._failed_batches = set(failed_batches)
+        self.batches = 0
+
+    def client(self, service_name):
+        if (service_name not in self._clients):
+            self._clients[service_name] = self._synthetic.client(service_name)
+
+        return self._clients[service_name]
+
+    # Fails the tag_resources calls of the failed batches (in the order they were made) at once, while
+    # the other batches are still in flight
+    async def call(self, aws_account, service_name, region_name, operation_name, **parameters):
+        if (operation_name == 'tag_resources'):
+            batch = self.batches
+            self.batches += 1
+
+            if (batch in self._failed_batches):
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'},
+                     'ResponseMetadata': {'HTTPStatusCode': 400}}, 'TagResources')
+
+            await asyncio.sleep(0.01)
+
+        return getattr(self.client(service_name), operation_name)(**parameters)
+
+    async def paginate(self, aws_account, service_name, region_name, operation_name, **parameters):
+        for page in self.client(service_name).get_paginator(operation_name).paginate(**parameters):
+            await asyncio.sleep(0)
+            yield page
+
+class TagAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.module = importlib.import_module('aws-tag-resources')
+
+    def tag(self, pool):
+        return asyncio.run(self.module.update_resource_tags_async(
+            pool, None, ['environment=production'], ['ec2:volume'], '', 'yes'))
+
+    def error_codes(self, rows):
+        counts = {}
+
+        for row in rows:
+            counts[row.error_code] = counts.get(row.error_code, 0) + 1
+
+        return counts
+
+    def test_tags_every_batch(self):
+        rows = self.tag(StubClientPool(benchmark.SyntheticAWS(100, ACCOUNT_ID)))
+
+        self.assertEqual(self.error_codes(rows), {'Already Tagged': 50, 'Ok': 50})
+
+    def test_failed_batch_keeps_other_outcomes(self):
+        pool = StubClientPool(benchmark.SyntheticAWS(100, ACCOUNT_ID), failed_batches=[0])
+        rows = self.tag(pool)
+
+        self.assertEqual(pool.batches, 3)
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(self.error_codes(rows), {'Already Tagged': 50, 'Ok': 30, 'ThrottlingException': 20})
+
+        failed = [row for row in rows if (row.error_code == 'ThrottlingException')]
+        self.assertEqual({row.status_code for row in failed}, {400})
+
+if (__name__ == "__main__"):
+    unittest.main()
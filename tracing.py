@@ -0,0 +1,257 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# tracing
+# Optional (--trace) instrumentation of the AWS API calls made through account.Account clients,
+# and of local phases such as building rows and writing the output file. At the end of a run a
+# summary table is displayed and, if requested, a Chrome trace (chrome://tracing, Perfetto) is
+# written with one event per API call.
+
+# Upper bounds (in milliseconds) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+class Tracer:
+    def __init__(self):
+        self._enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started = time.perf_counter()
+        self._calls = {}
+        self._phases = {}
+        self._events = []
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def enable(self):
+        self._enabled = True
+        self._started = time.perf_counter()
+
+    # Microseconds since tracing was enabled (the Chrome trace time base)
+    def _timestamp(self, perf_time):
+        return int((perf_time - self._started) * 1000000)
+
+    # Seconds this thread has spent waiting on API calls
+    def _api_time(self):
+        return getattr(self._local, 'api_time', 0.0)
+
+    # Hooks the client's events to record the calls made through it (if tracing is enabled)
+    def attach(self, client, account_key):
+        if (not self._enabled):
+            return client
+
+        region_name = client.meta.region_name
+
+        def before_call(context, **kwargs):
+            context['trace_started'] = time.perf_counter()
+            context['trace_attempts'] = 0
+            context['trace_bytes_sent'] = 0
+
+        def before_send(request, **kwargs):
+            context = request.context or {}
+
+            if ('trace_started' in context):
+                context['trace_attempts'] += 1
+
+                if (isinstance(request.body, (bytes, str))):
+                    context['trace_bytes_sent'] += len(request.body)
+
+        # Also handles after-call-error (raised for connection errors), which has no response
+        def after_call(event_name, context, http_response=None, **kwargs):
+            if ('trace_started' not in context):
+                return
+
+            ended = time.perf_counter()
+            started = context.pop('trace_started')
+            status_code = http_response.status_code if (http_response is not None) else None
+            bytes_received = len(http_response.content or b'') if (http_response is not None and
+                                                                   http_response.raw is not None) else 0
+
+            self._local.api_time = self._api_time() + (ended - started)
+
+            # Event names look like 'after-call.ec2.DescribeVolumes'
+            self._record_call((account_key, region_name, event_name.split('.')[-1]), started, ended,
+                              context['trace_attempts'], status_code,
+                              context['trace_bytes_sent'], bytes_received)
+
+        # Registered first so the timing also covers any other before-call handlers
+        client.meta.events.register_first('before-call', before_call)
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call)
+
+        return client
+
+    def _record_call(self, key, started, ended, attempts, status_code, bytes_sent, bytes_received):
+        latency_ms = (ended - started) * 1000
+
+        with self._lock:
+            stats = self._calls.get(key)
+
+            if (stats is None):
+                stats = {'calls': 0, 'retries': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                         'latencies': [], 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+                self._calls[key] = stats
+
+            stats['calls'] += 1
+            stats['retries'] += max(0, attempts - 1)
+            stats['errors'] += 1 if (status_code is None or status_code >= 300) else 0
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['latencies'].append(latency_ms)
+            stats['histogram'][_bucket(latency_ms)] += 1
+
+            self._events.append({
+                'name': key[2], 'cat': 'api', 'ph': 'X',
+                'ts': self._timestamp(started), 'dur': int(latency_ms * 1000),
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {'account': key[0], 'region': key[1], 'attempts': attempts, 'status': status_code}
+            })
+
+    def _record_phase(self, name, seconds, started=None, count=1):
+        with self._lock:
+            phase = self._phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+            phase['count'] += count
+            phase['seconds'] += seconds
+
+            if (started is not None):
+                self._events.append({
+                    'name': name, 'cat': 'phase', 'ph': 'X',
+                    'ts': self._timestamp(started), 'dur': int(seconds * 1000000),
+                    'pid': os.getpid(), 'tid': threading.get_ident()
+                })
+
+    # Times the enclosed block as one occurrence of the named phase
+    @contextlib.contextmanager
+    def phase(self, name):
+        if (not self._enabled):
+            yield
+            return
+
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self._record_phase(name, time.perf_counter() - started, started)
+
+    # Yields the rows, timing the work done to produce each one under the named phase. Time
+    # spent waiting on API calls (made while producing the rows) is left out.
+    def timed_rows(self, rows, name):
+        if (not self._enabled):
+            yield from rows
+            return
+
+        rows = iter(rows)
+        row_count = 0
+        seconds = 0.0
+
+        try:
+            while (True):
+                started = time.perf_counter()
+                api_time = self._api_time()
+
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += (time.perf_counter() - started) - (self._api_time() - api_time)
+
+                row_count += 1
+                yield row
+        finally:
+            self._record_phase(name, seconds, count=row_count)
+
+    # Returns the function, wrapped so each call is timed under the named phase (if tracing is enabled)
+    def timed(self, function, name):
+        if (not self._enabled):
+            return function
+
+        def timed_function(*args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._record_phase(name, time.perf_counter() - started)
+
+        return timed_function
+
+    # Displays the API call statistics for each (account, region, operation) and the local phase timings
+    def display_summary(self):
+        if (not self._enabled):
+            return
+
+        with self._lock:
+            calls = dict(self._calls)
+            phases = dict(self._phases)
+
+        print("Trace: API calls")
+        print("  {0:<14}{1:<16}{2:<28}{3:>7}{4:>8}{5:>7}{6:>9}{7:>9}{8:>9}{9:>10}{10:>10}".format(
+            "Account", "Region", "Operation", "Calls", "Retries", "Errors",
+            "p50 ms", "p95 ms", "Max ms", "KB sent", "KB recv"))
+
+        for key in sorted(calls, key=lambda k: tuple(str(part) for part in k)):
+            stats = calls[key]
+            latencies = sorted(stats['latencies'])
+
+            print("  {0:<14}{1:<16}{2:<28}{3:>7}{4:>8}{5:>7}{6:>9.1f}{7:>9.1f}{8:>9.1f}{9:>10.1f}{10:>10.1f}".format(
+                str(key[0]), str(key[1]), key[2], stats['calls'], stats['retries'], stats['errors'],
+                _percentile(latencies, 0.50), _percentile(latencies, 0.95), latencies[-1],
+                stats['bytes_sent'] / 1024, stats['bytes_received'] / 1024))
+
+        print("")
+        print("Trace: Latency histogram (calls per bucket, ms)")
+        print("  {0:<58}{1}".format("", "".join(["{0:>7}".format("<" + str(b)) for b in LATENCY_BUCKETS] +
+                                             ["{0:>7}".format(">=" + str(LATENCY_BUCKETS[-1]))])))
+
+        for key in sorted(calls, key=lambda k: tuple(str(part) for part in k)):
+            print("  {0:<58}{1}".format(" / ".join([str(part) for part in key])[:57],
+                                        "".join(["{0:>7}".format(c) for c in calls[key]['histogram']])))
+
+        print("")
+        print("Trace: Local phases")
+
+        for name in sorted(phases):
+            print("  {0:<30}{1:>10} x {2:>10.3f} s".format(name, phases[name]['count'], phases[name]['seconds']))
+
+        print("")
+
+    # Writes the recorded API calls and phases as a Chrome trace (JSON) file
+    def write_chrome_trace(self, filename):
+        if (not self._enabled):
+            return
+
+        with self._lock:
+            events = list(self._events)
+
+        try:
+            with open(filename, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        except OSError as e:
+            print('An error occurred when writing to {0}: {1}'.format(filename, e))
+        else:
+            print("{0} trace events saved to {1}\r\n".format(len(events), filename))
+
+# Returns the index of the histogram bucket for the latency
+def _bucket(latency_ms):
+    for index, upper_bound in enumerate(LATENCY_BUCKETS):
+        if (latency_ms < upper_bound):
+            return index
+
+    return len(LATENCY_BUCKETS)
+
+# Returns the given percentile (0-1) of the sorted values
+def _percentile(values, fraction):
+    if (len(values) == 0):
+        return 0.0
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# The tracer shared by every client created through account.Account (enabled by --trace)
+DEFAULT_TRACER = Tracer()
@@ -0,0 +1,174 @@
+import csv
+import gzip
+import json
+import tracing
+
+# writers
+# Streaming output writers shared by all of the scripts. Rows are written as they arrive and
+# are never all held in memory. Tags are passed in as a dictionary: the CSV formats flatten them
+# to a 'key:value,...' string, while the structured formats keep them as a map.
+
+FORMATS = ['csv', 'csv.gz', 'jsonl', 'jsonl.gz', 'parquet']
+
+# Number of rows buffered before a Parquet row group is written
+PARQUET_BATCH_SIZE = 10000
+
+# Returns the output format implied by the filename's extension (csv if there isn't one)
+def format_for(filename):
+    for output_format in sorted(FORMATS, key=len, reverse=True):
+        if (filename.lower().endswith('.' + output_format)):
+            return output_format
+
+    return 'csv'
+
+# Returns True if the optional Parquet dependency (pyarrow) is installed
+def parquet_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+
+    return True
+
+# Returns the tags dictionary as a 'key:value,key:value' string
+def format_tags(tags):
+    return ",".join([key + ":" + value for key, value in tags.items()])
+
+class CsvWriter:
+    def __init__(self, filename, field_names, compress=False):
+        if (compress):
+            self._file = gzip.open(filename, 'wt', newline='')
+        else:
+            self._file = open(filename, 'w', newline='')
+
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(field_names)
+
+    def write(self, row):
+        self._writer.writerow([format_tags(value) if isinstance(value, dict) else value for value in row])
+
+    def close(self):
+        self._file.close()
+
+# Writes one JSON object per line, keyed by field name
+class JsonLinesWriter:
+    def __init__(self, filename, field_names, compress=False):
+        if (compress):
+            self._file = gzip.open(filename, 'wt')
+        else:
+            self._file = open(filename, 'w')
+
+        self._field_names = field_names
+
+    def write(self, row):
+        self._file.write(json.dumps(dict(zip(self._field_names, row)), default=str))
+        self._file.write("\n")
+
+    def close(self):
+        self._file.close()
+
+# Writes Parquet row groups of PARQUET_BATCH_SIZE rows. Column types are taken from the first
+# batch: dictionaries become map<string, string> columns, columns holding only integers (or
+# blanks) become int64 and everything else is a string. Blank values are written as nulls.
+class ParquetWriter:
+    def __init__(self, filename, field_names):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._filename = filename
+        self._field_names = field_names
+        self._schema = None
+        self._writer = None
+        self._batch = []
+
+    def write(self, row):
+        self._batch.append(row)
+
+        if (len(self._batch) >= PARQUET_BATCH_SIZE):
+            self._flush()
+
+    def close(self):
+        self._flush()
+
+        if (self._writer is None):
+            # No rows were written, but the file should still exist (with a schema)
+            self._schema = self._infer_schema()
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._filename, self._schema)
+
+        self._writer.close()
+
+    def _infer_schema(self):
+        pa = self._pyarrow
+        fields = []
+
+        for index, name in enumerate(self._field_names):
+            values = [row[index] for row in self._batch if row[index] not in ('', None)]
+
+            if (any(isinstance(value, dict) for value in values)):
+                fields.append(pa.field(name, pa.map_(pa.string(), pa.string())))
+            elif (len(values) > 0 and all(isinstance(value, int) and not isinstance(value, bool) for value in values)):
+                fields.append(pa.field(name, pa.int64()))
+            else:
+                fields.append(pa.field(name, pa.string()))
+
+        return pa.schema(fields)
+
+    def _flush(self):
+        if (len(self._batch) == 0):
+            return
+
+        if (self._writer is None):
+            self._schema = self._infer_schema()
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._filename, self._schema)
+
+        columns = []
+
+        for index, field in enumerate(self._schema):
+            values = [row[index] for row in self._batch]
+
+            if (field.type == self._pyarrow.int64()):
+                values = [None if value in ('', None) else int(value) for value in values]
+            elif (isinstance(field.type, self._pyarrow.MapType)):
+                values = [None if value in ('', None) else list(value.items()) for value in values]
+            else:
+                values = [None if value in ('', None) else str(value) for value in values]
+
+            columns.append(self._pyarrow.array(values, type=field.type))
+
+        self._writer.write_table(self._pyarrow.Table.from_arrays(columns, schema=self._schema))
+        self._batch = []
+
+# Returns a writer for the given output format
+def open_writer(filename, field_names, output_format='csv'):
+    if (output_format == 'csv'):
+        return CsvWriter(filename, field_names)
+    elif (output_format == 'csv.gz'):
+        return CsvWriter(filename, field_names, compress=True)
+    elif (output_format == 'jsonl'):
+        return JsonLinesWriter(filename, field_names)
+    elif (output_format == 'jsonl.gz'):
+        return JsonLinesWriter(filename, field_names, compress=True)
+    elif (output_format == 'parquet'):
+        return ParquetWriter(filename, field_names)
+
+    raise ValueError("Unknown output format: {0}".format(output_format))
+
+# Writes the rows (which may be a generator) to the file as they arrive
+def write_file(filename, rows, field_names, output_format='csv'):
+    row_count = 0
+
+    try:
+        writer = open_writer(filename, field_names, output_format)
+        write = tracing.DEFAULT_TRACER.timed(writer.write, 'write rows')
+
+        try:
+            for row in rows:
+                write(row)
+                row_count += 1
+        finally:
+            writer.close()
+    except OSError as e:
+        print('An error occurred when writing to {0}: {1}'.format(filename, e))
+    else:
+        print("{0} rows successfully saved to {1}\r\n".format(row_count, filename))